@@ -2,7 +2,7 @@ import streamlit as st
 from st_aggrid import AgGrid, GridOptionsBuilder
 import pandas as pd
 import json
-import load, components
+import load, components, vecna_api, s3
 from tools.tools import setup_ambient
 
 ARAUCO = True
@@ -13,4 +13,18 @@ st.write("# Integraciones de datos KLog.co")
 
 st.write("Bienvenido al centro de integración de datos.")
 
-st.write("En el menú de la izquierda podrá encontrar el reporte de calidad de datos.")
\ No newline at end of file
+st.write("En el menú de la izquierda podrá encontrar el reporte de calidad de datos.")
+
+with st.expander("Conexiones a bases de datos"):
+    # Pools are shared by every session of this process, see load.ENGINE_POOL to size them
+    st.dataframe(load.engine_pool_stats(), hide_index=True)
+    # Point lookups prepared on the server, and how often they are executed without preparing them again
+    st.dataframe(load.prepared_statement_stats(), hide_index=True)
+
+with st.expander("Fuentes de datos"):
+    # Sources fetched concurrently by the pages, see load.SOURCE_TIMEOUTS to change how long they are waited for
+    st.dataframe(load.data_source_stats(), hide_index=True)
+    # Responses of the Vecna back API served from the cache, revalidated with their ETag, or requested
+    st.dataframe(pd.DataFrame([vecna_api.cache_stats()]), hide_index=True)
+    # Raw events read from the disk cache instead of S3, see s3.S3_CACHE_BYTES to change its size
+    st.dataframe(pd.DataFrame([s3.disk_cache_stats()]), hide_index=True)
@@ -0,0 +1,804 @@
+import os
+import json
+import time
+import random
+import logging
+import tempfile
+import argparse
+from datetime import datetime, timedelta, timezone
+
+import duckdb
+import pandas as pd
+
+import database
+
+logging.basicConfig(level=logging.INFO)
+
+POLS = [("CLCNL", "Coronel"), ("CLLQN", "Lirquén"), ("CLSVE", "San Vicente"), ("CLSAI", "San Antonio"), ("CLVAP", "Valparaiso")]
+PODS = [("CNSHA", "Shanghai"), ("KRPUS", "Busan"), ("NLRTM", "Rotterdam"), ("USLAX", "Los Angeles"), ("MXZLO", "Manzanillo"), ("JPYOK", "Yokohama")]
+TRANSHIPMENTS = [("PECLL", "Callao"), ("PABLB", "Balboa"), ("SGSIN", "Singapore"), ("KRPUS", "Busan")]
+CARRIERS = [("CMDU", "CMA CGM"), ("COSU", "COSCO"), ("EVRG", "Evergreen"), ("HLCU", "Hapag-Lloyd"), ("MAEU", "Maersk"), ("MSCU", "MSC"), ("ONEY", "ONE")]
+SERVICES = ["AMERICAS XL SERVICE", "ATACAMA SERVICE", "ANDES EXPRESS SERVICE", "CONOSUR SERVICE - LOOP1", "ASIA LATIN AMERICA EXPRESS SERVICE 1 - ALX1"]
+# Services whitelist shipped with the repository, whatever the working directory
+ALLOWED_SERVICES = os.path.join(os.path.dirname(os.path.abspath(__file__)), database.ALLOWED_SERVICES)
+
+def _p44_timestamp(t, offset_hours=0):
+    """ Timestamp in the format returned by Project44, e.g. 2023-08-01T10:00-04:00 """
+    t = t.astimezone(timezone(timedelta(hours=offset_hours)))
+    return t.strftime("%Y-%m-%dT%H:%M") + f"{'+' if offset_hours >= 0 else '-'}{abs(offset_hours):02d}:00"
+
+def make_itinerarios_corpus(data_dir, n_itineraries=1000000, per_file=500, seed=0, start=datetime(2023, 1, 1, tzinfo=timezone.utc), days=365, etd_offsets=(0,), first_id=0):
+    """ Write a synthetic corpus of Project44 itinerary files, one file per POL/POD batch of per_file itineraries
+
+    Args:
+        data_dir (str): Directory where JSON files are written
+        n_itineraries (int): Total number of itineraries
+        per_file (int): Number of itineraries per file
+        seed (int): Random seed
+        start (datetime): First ETD
+        days (int): ETDs are spread uniformly over this many days after start
+        etd_offsets (tuple): UTC offsets in hours of etd and eta, one drawn at random for each itinerary
+        first_id (int): Number of the first itinerary, so several corpora can be loaded together
+    """
+    rng = random.Random(seed)
+    os.makedirs(data_dir, exist_ok=True)
+    for f in range(0, n_itineraries, per_file):
+        pol, pod = rng.choice(POLS), rng.choice(PODS)
+        results = []
+        for i in range(f, min(f + per_file, n_itineraries)):
+            carrier = rng.choice(CARRIERS)
+            ports = [pol] + rng.sample(TRANSHIPMENTS, rng.randint(0, 2)) + [pod]
+            etd = start + timedelta(hours=rng.randint(0, 24 * days - 1))
+            transit_time = rng.randint(15, 60)
+            eta = etd + timedelta(days=transit_time)
+            # Only drawn with several offsets, so the default corpus stays the same for a given seed
+            offset = rng.choice(etd_offsets) if len(etd_offsets) > 1 else etd_offsets[0]
+            results += [{
+                "id": f"itinerary-{first_id + i}",
+                "uuid_p2p": f"p2p-{first_id + i}",
+                "p2p_id": first_id + i,
+                "alliance": None,
+                "carrier": {"scac": carrier[0], "short_name": carrier[1]},
+                "pol": {"locode": pol[0], "name": pol[1]},
+                "pod": {"locode": pod[0], "name": pod[1]},
+                "etd": _p44_timestamp(etd, offset),
+                "eta": _p44_timestamp(eta, offset),
+                "etd_local": _p44_timestamp(etd, -4),
+                "eta_local": _p44_timestamp(eta, 8),
+                "transit_time": transit_time,
+                "transshipment_count": len(ports) - 2,
+                "legs": [{
+                    "pol": {"locode": a[0], "name": a[1]},
+                    "pod": {"locode": b[0], "name": b[1]},
+                    "vessel": {"shipname": f"VESSEL {rng.randint(1, 200)}", "imo": rng.randint(9000000, 9999999)},
+                    "service_name": rng.choice(SERVICES),
+                } for a, b in zip(ports[:-1], ports[1:])],
+            }]
+        with open(os.path.join(data_dir, f"{pol[0]}_{pod[0]}_{f // per_file}.json"), "w") as out:
+            json.dump({"results": results}, out)
+
+def benchmark_ingest(n_itineraries=1000000, per_file=500, engines=("pool", "duckdb"), workers=None):
+    """ Compare ingest engines of database.ingest_itinerarios on a synthetic corpus
+
+    Args:
+        n_itineraries (int): Total number of itineraries in the corpus
+        per_file (int): Number of itineraries per file
+        engines (tuple): Engines to compare
+        workers (int): Number of worker processes for the "pool" engine
+
+    Returns:
+        dict: Result of ingest_itinerarios for each engine
+    """
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        data_dir = os.path.join(tmp, "data")
+        logging.info(f"Writing synthetic corpus of {n_itineraries} itineraries to {data_dir}")
+        make_itinerarios_corpus(data_dir, n_itineraries=n_itineraries, per_file=per_file)
+        for engine in engines:
+            results[engine] = database.ingest_itinerarios(data_dir=data_dir, database=os.path.join(tmp, f"{engine}.db"), workers=workers, full=True, engine=engine, parquet_dir=None)
+    for engine, r in results.items():
+        logging.info(f"{engine}: {r['seconds']:.2f}s, {r['files']/r['seconds']:.1f} files/s, {r['rows']/r['seconds']:.1f} rows/s")
+    return results
+
+def _itinerarios_baseline_database(data_dir, database_name, table="itineraries"):
+    """ Itineraries of data_dir in the single table of nested results written by database.py before the ingest was
+    rewritten (the database read by _load_itinerarios_baseline) """
+    results = []
+    for subdir, dirs, files in os.walk(data_dir):
+        for file in [f for f in files if f.endswith(".json")]:
+            with open(f"{subdir}/{file}") as f:
+                results += json.load(f)["results"]
+    df = pd.DataFrame(results)
+    del results
+    con = duckdb.connect(database_name)
+    con.execute(f"CREATE OR REPLACE TABLE {table} AS SELECT * FROM df")
+    con.close()
+
+def _select_service_baseline(x):
+    """ August service whitelist of a row, as applied before the transform was vectorized """
+    servicios_in = {
+        "CMDU": [
+            "AMERICAS XL SERVICE",
+            "ASIA CENTRAL SOUTH AMERICA 2",
+            "ASIA CENTRAL SOUTH AMERICA SERVICE 3",
+            "EUROSAL XL SERVICE",
+        ],
+        "COSU": [
+            "ASIA - MIDDLE AND SOUTH AMERICA WEST COAST WEEKLY SERVICE 3",
+            "ASIA - SOUTH AMERICA WEST COAST SERVICE",
+        ],
+        "EVRG": [
+            "ASIA - SOUTH AMERICA WEST COAST SERVICE",
+            "ASIA - SOUTH AMERICA WEST COAST SERVICE 3",
+        ],
+        "EGLV": [
+            "ASIA - SOUTH AMERICA WEST COAST SERVICE",
+            "ASIA - SOUTH AMERICA WEST COAST SERVICE 3",
+        ],
+        "SUDU": [
+            "ATACAMA SERVICE"
+        ],
+        "HLCU": [
+            "CONOSUR SERVICE - LOOP1",
+            "CONOSUR SERVICE - LOOP2",
+            "SOUTH AMERICA - ASIA - LOOP 2",
+            "SOUTH AMERICA - ASIA SERVICE - LOOP 1",
+            "WEST COAST SOUTH AMERICA FEEDER SERVICE 3",
+        ],
+        "MAEU": [
+            "ATACAMA SERVICE",
+            "WEST COAST LATIN AMERICA-NORTH EUROPE EXPRESS SERVICE",
+        ],
+        "MSCU": [
+            "ANDES EXPRESS SERVICE",
+            "ASIA - LATIN AMERICA - INCA SERVICE",
+            "NORTH EUROPE WEST COAST - UNITED STATES OF AMERICA - SOUTH AMERICA WEST COAST SERVICE",
+        ],
+        "ONEY": [
+            "ASIA LATIN AMERICA EXPRESS SERVICE 1 - ALX1",
+            "ASIA LATIN AMERICA EXPRESS SERVICE 2 - ALX2",
+        ],
+    }
+
+    carrier_scac = x["carrier_scac"]
+    if carrier_scac in servicios_in:
+        s = [c for c in x["service"] if c in servicios_in[carrier_scac]]
+        if len(s) > 0:
+            return s
+        else:
+            return None
+    else:
+        return x["service"]
+
+def _load_itinerarios_baseline(month, year=2023, database_name="itineraries.db"):
+    """ load_itinerarios of pages/Itinerarios.py as it was before the ingest and the transform were rewritten, reading
+    the database written by _itinerarios_baseline_database """
+    con = duckdb.connect(database_name)
+    query = f"""--sql
+SELECT
+    *
+FROM
+    itineraries
+WHERE
+    -- We convert the timestamp to a string and then we remove the timezone
+    date_part('year', (replace(left(etd,position('+' in etd)-1),'T',' ') || ':00')::timestamp) = {year} and
+    date_part('month',(replace(left(etd,position('+' in etd)-1),'T',' ') || ':00')::timestamp) = {month};
+"""
+    df = con.execute(query).fetchdf()
+    con.close()
+
+    df.loc[:,"carrier_scac"] = df.loc[:,"carrier"].apply(lambda x: x["scac"])
+    df.loc[:,"carrier"] = df.loc[:,"carrier"].apply(lambda x: x["short_name"])
+    df.loc[:,"pol_name"] = df.loc[:,"pol"].apply(lambda x: x["name"])
+    df.loc[:,"pol"] = df.loc[:,"pol"].apply(lambda x: x["locode"])
+    df.loc[:,"pod_name"] = df.loc[:,"pod"].apply(lambda x: x["name"])
+    df.loc[:,"pod"] = df.loc[:,"pod"].apply(lambda x: x["locode"])
+    df = df.drop(columns=["alliance","uuid_p2p","p2p_id","id"])
+    df["etd"] = df["etd"].apply(lambda x: pd.to_datetime(x))
+    df["eta"] = df["eta"].apply(lambda x: pd.to_datetime(x))
+    df["etd_local"] = df["etd_local"].apply(lambda x: pd.to_datetime(x))
+    df["eta_local"] = df["eta_local"].apply(lambda x: pd.to_datetime(x))
+    df.loc[:,"transhipments"] = df.loc[:,"legs"].apply(lambda x: [[y["pol"]["locode"]+"-"+y["pod"]["locode"]] for y in x])
+    df.loc[:,"transhipments_name"] = df.loc[:,"legs"].apply(lambda x: [[y["pol"]["name"]+"-"+y["pod"]["name"]] for y in x])
+    for i in range(5):
+        df["transhipments_name_"+str(i+1)] = df["legs"].apply(lambda x: x[i]["pod"]["name"] if len(x)>i+1 else None)
+    df["transhipments_name_1"] = df["transhipments_name_1"].apply(lambda x: x if x is not None else "DIRECT")
+    df.loc[:,"vessel"] = df.loc[:,"legs"].apply(lambda x: [y["vessel"]["shipname"] for y in x])
+    df["service"] = df.apply(lambda y: [x["service_name"] for x in y["legs"]], axis=1)
+    if month == 8:
+        df["service"] = df.apply(lambda x: _select_service_baseline(x), axis=1)
+    df = df[~pd.isnull(df["service"])]
+    df = df.drop(columns=["legs"])
+    datetime_columns = ["etd", "eta", "etd_local", "eta_local"]
+    for datetime_column in datetime_columns:
+        df[datetime_column] = df[datetime_column].apply(lambda x: x.replace(tzinfo=None))
+    df = df[df["pol_name"].isin(["Coronel","Lirquén","San Vicente","Talcahuano","Talcahuano (San Vicente)","San Antonio","Valparaiso"])].copy()
+    df = df[df["carrier_scac"].isin(["CMDU","COSU","EGLV","EVRG","HLCU","SUDU","MSCU","MAEU","ONEY","ZIMU"])].copy()
+    df["service_first"] = df["service"].apply(lambda x: x[0])
+    df["transhipments_name_1"].fillna("-", inplace=True)
+    df["transhipments_name_2"].fillna("-", inplace=True)
+    df["transhipments_name_3"].fillna("-", inplace=True)
+    df["transhipments_name_4"].fillna("-", inplace=True)
+    return df
+
+def _sorted_frame(df):
+    """ Rows of df in a canonical order, to compare frames regardless of row order and index """
+    order = df.astype(str).sort_values(list(df.columns)).index
+    return df.loc[order].reset_index(drop=True)
+
+def benchmark_itinerarios_transform(n_itineraries=500000, per_file=500, month=8, year=2023):
+    """ Compare load.load_itinerarios with the original implementation on a month of synthetic itineraries
+
+    The original implementation (_load_itinerarios_baseline) reads the single table of nested results that database.py
+    wrote before the ingest was rewritten, so the same corpus is loaded both ways first. Fails if both frames are not
+    identical (up to row order, index and integer widths).
+
+    Args:
+        n_itineraries (int): Number of itineraries in the month
+        per_file (int): Number of itineraries per file
+        month (int): Month of the itineraries
+        year (int): Year of the itineraries
+
+    Returns:
+        dict: Seconds taken by each implementation and speedup
+    """
+    import load
+
+    with tempfile.TemporaryDirectory() as tmp:
+        data_dir = os.path.join(tmp, "data")
+        database_name = os.path.join(tmp, "itineraries.db")
+        baseline_database_name = os.path.join(tmp, "itineraries_baseline.db")
+        start = datetime(year, month, 1, tzinfo=timezone.utc)
+        logging.info(f"Writing synthetic corpus of {n_itineraries} itineraries in {year}-{month:02d} to {data_dir}")
+        make_itinerarios_corpus(data_dir, n_itineraries=n_itineraries, per_file=per_file, start=start, days=28)
+        database.ingest_itinerarios(data_dir=data_dir, database=database_name, full=True, engine="duckdb", allowed_services=ALLOWED_SERVICES, parquet_dir=None)
+        _itinerarios_baseline_database(data_dir, baseline_database_name)
+
+        t = time.perf_counter()
+        baseline = _load_itinerarios_baseline(month, year, database_name=baseline_database_name)
+        baseline_seconds = time.perf_counter() - t
+
+        load_itinerarios = getattr(load.load_itinerarios, "__wrapped__", load.load_itinerarios)
+        t = time.perf_counter()
+        vectorized = load_itinerarios(month, year, database=database_name, parquet_dir=os.path.join(tmp, "itineraries_parquet"))
+        vectorized_seconds = time.perf_counter() - t
+
+    pd.testing.assert_frame_equal(_sorted_frame(vectorized), _sorted_frame(baseline), check_dtype=False)
+    logging.info(f"{len(vectorized)} itineraries: original {baseline_seconds:.2f}s, vectorized {vectorized_seconds:.2f}s ({baseline_seconds/vectorized_seconds:.1f}x), frames are identical")
+    return {"baseline": baseline_seconds, "vectorized": vectorized_seconds, "speedup": baseline_seconds / vectorized_seconds}
+
+def _itinerarios_month_counts(data_dir):
+    """ Itineraries of the JSON files in data_dir kept by the Itinerarios page, counted in Python by month of ETD in
+    UTC, POL, POD and carrier, and number of them whose ETD has a local month other than its UTC month """
+    counts, local_months = {}, 0
+    for subdir, dirs, files in os.walk(data_dir):
+        for file in [f for f in files if f.endswith(".json")]:
+            with open(os.path.join(subdir, file)) as f:
+                results = json.load(f)["results"]
+            for r in results:
+                if r["pol"]["name"] not in database.ITINERARIES_POL_NAMES or r["carrier"]["scac"] not in database.ITINERARIES_CARRIERS:
+                    continue
+                etd = datetime.strptime(r["etd"], "%Y-%m-%dT%H:%M%z")
+                utc = etd.astimezone(timezone.utc)
+                key = (utc.year, utc.month, r["pol"]["locode"], r["pod"]["locode"], r["carrier"]["short_name"])
+                counts[key] = counts.get(key, 0) + 1
+                local_months += (etd.year, etd.month) != (utc.year, utc.month)
+    return counts, local_months
+
+def _check_itinerarios_months(data_dir, database_name, parquet_dir):
+    """ Fail unless the rollups of database_name and the itineraries of each month read by load.load_itinerarios, from
+    the database and from the Parquet partitions, count the itineraries of data_dir by month of ETD in UTC """
+    import load
+
+    expected, local_months = _itinerarios_month_counts(data_dir)
+    con = duckdb.connect(database_name, read_only=True)
+    rollups = {tuple(r[:5]): r[5] for r in con.execute("SELECT year, month, pol, pod, carrier, sum(transit_time_count)::INTEGER FROM itineraries_transit_times GROUP BY ALL").fetchall()}
+    destinations = {tuple(r[:3]): r[3] for r in con.execute("SELECT year, month, pod, sum(transit_time_count)::INTEGER FROM itineraries_destination_times GROUP BY ALL").fetchall()}
+    con.close()
+    assert rollups == expected, "Transit time rollups do not count itineraries by month of ETD in UTC"
+    expected_destinations = {}
+    for (year, month, pol, pod, carrier), n in expected.items():
+        expected_destinations[(year, month, pod)] = expected_destinations.get((year, month, pod), 0) + n
+    assert destinations == expected_destinations, "Destination time rollups do not count itineraries by month of ETD in UTC"
+
+    for year, month in sorted({k[:2] for k in expected}):
+        month_expected = {k[2:]: n for k, n in expected.items() if k[:2] == (year, month)}
+        for source, directory in [("database", os.path.join(os.path.dirname(parquet_dir), "no_parquet")), ("Parquet", parquet_dir)]:
+            df = load.load_itinerarios(month, year, database=database_name, parquet_dir=directory)
+            counts = df.groupby(["pol", "pod", "carrier"]).size().to_dict()
+            assert counts == month_expected, f"Itineraries of {year}-{month:02d} read from the {source} are not those with ETD in that month in UTC"
+    return sum(expected.values()), local_months
+
+def check_itinerarios_months(n_itineraries=20000, per_file=500, etd_offsets=(-11, -4, 8, 12), boundaries=(datetime(2023, 8, 1, tzinfo=timezone.utc), datetime(2024, 1, 1, tzinfo=timezone.utc))):
+    """ Check that itineraries are bucketed by month of ETD in UTC on a corpus with non-UTC offsets near month boundaries
+
+    The ETDs of the corpus are written with the offsets in etd_offsets and fall within a day of each boundary, so many
+    of them have a local date in another month than in UTC. The transit and destination time rollups written by
+    database.py, and the itineraries of each month read by load.load_itinerarios from the database and from the Parquet
+    partitions, must count each itinerary in the month of its ETD in UTC, as counted in Python from the JSON files.
+    This is checked after a full ingest, and after an incremental one that deletes a file near each boundary and adds
+    another. Fails otherwise.
+
+    Args:
+        n_itineraries (int): Number of itineraries around each boundary
+        per_file (int): Number of itineraries per file
+        etd_offsets (tuple): UTC offsets in hours of the ETDs
+        boundaries (tuple): First instants in UTC of the months whose boundary is checked
+
+    Returns:
+        dict: Number of itineraries checked and number of them whose ETD has a local month other than its UTC month
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        data_dir = os.path.join(tmp, "data")
+        database_name = os.path.join(tmp, "itineraries.db")
+        parquet_dir = os.path.join(tmp, "itineraries_parquet")
+        # An empty whitelist, so every service is kept and counts only depend on the month
+        allowed_services = os.path.join(tmp, "servicios_in.csv")
+        with open(allowed_services, "w") as f:
+            f.write("year,month,carrier_scac,service_name\n")
+        os.makedirs(parquet_dir)
+
+        for i, boundary in enumerate(boundaries):
+            logging.info(f"Writing synthetic corpus of {n_itineraries} itineraries around {boundary:%Y-%m-%d} with ETD offsets {etd_offsets}")
+            make_itinerarios_corpus(os.path.join(data_dir, f"{boundary:%Y-%m}"), n_itineraries=n_itineraries, per_file=per_file, seed=i, start=boundary - timedelta(days=1), days=2, etd_offsets=etd_offsets, first_id=i * n_itineraries)
+        database.ingest_itinerarios(data_dir=data_dir, database=database_name, full=True, engine="duckdb", allowed_services=allowed_services, parquet_dir=parquet_dir)
+        n, local_months = _check_itinerarios_months(data_dir, database_name, parquet_dir)
+        logging.info(f"Full ingest: {n} itineraries counted by month of ETD in UTC, {local_months} of them with a local ETD in another month")
+
+        for i, boundary in enumerate(boundaries):
+            subdir = os.path.join(data_dir, f"{boundary:%Y-%m}")
+            os.remove(os.path.join(subdir, sorted(os.listdir(subdir))[0]))
+            make_itinerarios_corpus(os.path.join(subdir, "new"), n_itineraries=per_file, per_file=per_file, seed=len(boundaries) + i, start=boundary - timedelta(days=1), days=2, etd_offsets=etd_offsets, first_id=(len(boundaries) + i) * n_itineraries)
+        database.ingest_itinerarios(data_dir=data_dir, database=database_name, allowed_services=allowed_services, parquet_dir=parquet_dir)
+        n, local_months = _check_itinerarios_months(data_dir, database_name, parquet_dir)
+        logging.info(f"Incremental ingest: {n} itineraries counted by month of ETD in UTC, {local_months} of them with a local ETD in another month")
+    return {"itineraries": n, "local_months": local_months}
+
+def _export_frame(n_rows, seed=0):
+    """ Synthetic frame shaped like the Itinerarios table: text, timestamps, numbers and list columns """
+    rng = random.Random(seed)
+    etd = pd.Timestamp("2023-08-01") + pd.to_timedelta([rng.randrange(31 * 24 * 3600) for _ in range(n_rows)], unit="s")
+    transit_time = pd.Series([rng.randint(10, 60) for _ in range(n_rows)])
+    return pd.DataFrame({
+        "Naviera": [rng.choice(CARRIERS)[1] for _ in range(n_rows)],
+        "POL": [rng.choice(POLS)[0] for _ in range(n_rows)],
+        "POD": [rng.choice(PODS)[0] for _ in range(n_rows)],
+        "ETD": etd,
+        "ETA": etd + pd.to_timedelta(transit_time, unit="D"),
+        "Tiempo de tránsito": transit_time,
+        "Trasbordo 1": [rng.choice(TRANSHIPMENTS)[1] for _ in range(n_rows)],
+        "Nave": [[f"VESSEL {rng.randrange(500)}"] for _ in range(n_rows)],
+        "Servicio": [str([rng.choice(SERVICES)]) for _ in range(n_rows)],
+    })
+
+def benchmark_export(n_rows=1000000, extensions=("csv", "csv.gz", "parquet")):
+    """ Compare the peak memory (traced by tracemalloc) of export.export_dataframe with rendering the whole CSV in memory
+
+    Fails if the CSV export is not byte for byte the legacy CSV of the Itinerarios page.
+
+    Args:
+        n_rows (int): Number of rows of the exported frame
+        extensions (tuple): Formats to export
+
+    Returns:
+        dict: Peak memory (bytes), seconds and output size (bytes) by format, and for the legacy CSV
+    """
+    import tracemalloc
+    import export
+
+    df = _export_frame(n_rows)
+    results = {}
+
+    tracemalloc.start()
+    t = time.perf_counter()
+    legacy = df[df.columns].copy().to_csv(index=False, sep=";", quotechar='"').encode('utf-8')
+    results["legacy csv"] = {"seconds": time.perf_counter() - t, "peak": tracemalloc.get_traced_memory()[1], "size": len(legacy)}
+    tracemalloc.stop()
+
+    for extension in extensions:
+        tracemalloc.start()
+        t = time.perf_counter()
+        with export.export_dataframe(df, extension) as f:
+            results[extension] = {"seconds": time.perf_counter() - t, "peak": tracemalloc.get_traced_memory()[1], "size": os.fstat(f.fileno()).st_size}
+            tracemalloc.stop()
+            if extension == "csv":
+                assert f.read() == legacy, "CSV export differs from the legacy CSV"
+    del legacy
+
+    chunk = export.EXPORT_CHUNK_ROWS
+    for name, r in results.items():
+        logging.info(f"{n_rows} rows, {name}: peak {r['peak'] / 2**20:.0f} MiB, {r['seconds']:.2f}s, {r['size'] / 2**20:.0f} MiB written")
+    logging.info(f"Chunks of {chunk} rows, CSV export is identical to the legacy CSV")
+    return results
+
+def _use_engine(database, url, env="prod", schema=None):
+    """ Point load's engine of database in env to url, with schema first in the search path """
+    import load
+    from sqlalchemy import create_engine
+
+    connect_args = {"options": f"-csearch_path={schema},public"} if schema else {}
+    with load._engines_lock:
+        load._engines[(database, env)] = create_engine(url, connect_args=connect_args, **load.ENGINE_POOL)
+        load._engines_stats[(database, env)] = {"checkouts": 0, "timeouts": 0, "wait_seconds": 0.0, "max_wait_seconds": 0.0}
+    return load._engines[(database, env)]
+
+def benchmark_events_prisma(url, n_events=1000000, n_containers=50000, n_lookups=50, schema="benchmark", seed=0):
+    """ Compare container lookups of load.load_events_prisma through the local container index with the JSON scan query
+
+    A synthetic "OiEvent" table is written in schema of the Postgres database at url (a local stand-in of Prisma, the
+    schema is dropped and created again), and the index is built in a temporary mirror database. Fails if any lookup
+    returns a different frame than the JSON scan.
+
+    Args:
+        url (str): SQLAlchemy URL of a Postgres database
+        n_events (int): Number of OiEvents, created over the last year
+        n_containers (int): Number of distinct containers
+        n_lookups (int): Number of containers looked up
+        schema (str): Schema of the synthetic table
+        seed (int): Random seed
+
+    Returns:
+        dict: Seconds of the index build, of an incremental sync, and mean seconds by lookup of each query
+    """
+    import load, mirror
+
+    engine = _use_engine("prisma", url, schema=schema)
+    with engine.begin() as con:
+        con.exec_driver_sql(f'DROP SCHEMA IF EXISTS "{schema}" CASCADE')
+        con.exec_driver_sql(f'CREATE SCHEMA "{schema}"')
+        # Bodies padded to about 1 KB, like the events list of an Ocean Insights payload
+        con.exec_driver_sql(f'''CREATE TABLE "{schema}"."OiEvent" AS SELECT
+            'oi' || i AS "id",
+            json_build_object('shipment', json_build_object('container_number', 'CONT' || mod(i::bigint * 7919, {int(n_containers)})), 'events', repeat('x', 1000))::text AS "body",
+            (now() AT TIME ZONE 'UTC') - (i * interval '1 year' / {int(n_events)}) AS "createdAt"
+            FROM generate_series(1, {int(n_events)}) i''')
+        con.exec_driver_sql(f'ALTER TABLE "{schema}"."OiEvent" ADD PRIMARY KEY ("id")')
+        con.exec_driver_sql(f'CREATE INDEX ON "{schema}"."OiEvent" ("createdAt")')
+        con.exec_driver_sql(f'ANALYZE "{schema}"."OiEvent"')
+
+    rng = random.Random(seed)
+    containers = [f"CONT{rng.randrange(n_containers)}" for _ in range(n_lookups)]
+    since = (datetime.utcnow() - timedelta(days=180)).strftime("%Y-%m-%d")
+    scan_query = load._EVENTS_PRISMA_QUERY.format(container_filter='"a"."container_number" = $2')
+    results = {}
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp:
+        # The mirror database is relative to the working directory
+        os.chdir(tmp)
+        try:
+            t = time.perf_counter()
+            mirror.sync_table("oi_event_containers", "prod", full=True)
+            results["index build"] = time.perf_counter() - t
+
+            with engine.begin() as con:
+                con.exec_driver_sql(f'''INSERT INTO "{schema}"."OiEvent" SELECT 'new' || i, json_build_object('shipment', json_build_object('container_number', 'CONT' || i))::text,
+                    (now() AT TIME ZONE 'UTC') FROM generate_series(1, 1000) i''')
+            t = time.perf_counter()
+            mirror.sync_table("oi_event_containers", "prod")
+            results["incremental sync"] = time.perf_counter() - t
+
+            scan, index = 0.0, 0.0
+            for container in containers:
+                t = time.perf_counter()
+                expected = load.query_prepared("prisma", "prod", scan_query, (since, container))
+                scan += time.perf_counter() - t
+                t = time.perf_counter()
+                events = load.load_events_prisma.__wrapped__(container, since)
+                index += time.perf_counter() - t
+                pd.testing.assert_frame_equal(events, expected)
+            results["json scan lookup"] = scan / n_lookups
+            results["index lookup"] = index / n_lookups
+        finally:
+            mirror._connections.pop(mirror.MIRROR_DATABASE).close()
+            os.chdir(cwd)
+
+    logging.info(f"{n_events} OiEvents: index built in {results['index build']:.2f}s, 1000 new events synced in {results['incremental sync']:.2f}s")
+    logging.info(f"{n_lookups} lookups since {since}: JSON scan {results['json scan lookup'] * 1000:.1f} ms, index {results['index lookup'] * 1000:.1f} ms ({results['json scan lookup'] / results['index lookup']:.0f}x), frames are identical")
+    return results
+
+def _vecna_api_stub(latency=0.05):
+    """ Local stub of the Vecna back API, in a background thread. Returns the server, whose requests and connections
+    are counted in server.counts
+
+    /subscriptions/<id> answers after latency seconds with an ETag, and 304 when If-None-Match matches it. Ids starting
+    with "flaky" answer 503 to their first two requests, and ids starting with "slow" take 30 seconds.
+    """
+    import hashlib, threading
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    counts = {"requests": 0, "connections": 0, "by_id": {}}
+    lock = threading.Lock()
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        # Headers and body are written separately, which would wait for delayed ACKs on kept-alive connections
+        disable_nagle_algorithm = True
+
+        def setup(self):
+            super().setup()
+            with lock:
+                counts["connections"] += 1
+
+        def do_GET(self):
+            subscription_id = self.path.rsplit("/", 1)[-1]
+            with lock:
+                counts["requests"] += 1
+                n = counts["by_id"][subscription_id] = counts["by_id"].get(subscription_id, 0) + 1
+            time.sleep(30 if subscription_id.startswith("slow") else latency)
+            body = json.dumps({"id": subscription_id, "events": list(range(50))}).encode()
+            etag = '"' + hashlib.sha1(body).hexdigest() + '"'
+            if subscription_id.startswith("flaky") and n <= 2:
+                status, body = 503, b""
+            elif self.headers.get("If-None-Match") == etag:
+                status, body = 304, b""
+            else:
+                status = 200
+            self.send_response(status)
+            self.send_header("ETag", etag)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    server.daemon_threads = True
+    server.counts = counts
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def benchmark_vecna_api(n_subscriptions=40, latency=0.05):
+    """ Compare the Vecna back API client (vecna_api) with one requests.get by subscription, on a local stub server
+
+    Fails if the client doesn't reuse connections, serve hits from the cache, revalidate with the ETag, retry 503s,
+    give up on a hung request within its timeouts, or keep bulk requests within its workers.
+
+    Args:
+        n_subscriptions (int): Number of subscriptions fetched
+        latency (float): Seconds the stub takes to answer
+
+    Returns:
+        dict: Seconds and connections of each mode
+    """
+    import requests
+    import vecna_api
+
+    server = _vecna_api_stub(latency)
+    counts = server.counts
+    vecna_api.VECNA_API["stub"] = (f"http://127.0.0.1:{server.server_address[1]}", "token")
+    ids = [f"s{i}" for i in range(n_subscriptions)]
+    results = {}
+
+    def measure(name, function):
+        before = dict(counts)
+        t = time.perf_counter()
+        function()
+        results[name] = {"seconds": time.perf_counter() - t, "requests": counts["requests"] - before["requests"], "connections": counts["connections"] - before["connections"]}
+        logging.info(f"{name}: {results[name]['seconds']:.2f}s, {results[name]['requests']} requests, {results[name]['connections']} connections")
+
+    base = vecna_api.VECNA_API["stub"][0]
+    measure("requests.get", lambda: [requests.get(f"{base}/subscriptions/{i}", headers={"Authorization": "Token token"}).text for i in ids])
+    measure("client", lambda: [vecna_api.get_subscription(i, "stub") for i in ids])
+    assert results["client"]["connections"] == 1, "client didn't reuse its connection"
+    measure("client, cached", lambda: [vecna_api.get_subscription(i, "stub") for i in ids])
+    assert results["client, cached"]["requests"] == 0, "cached responses were requested again"
+    measure("client, revalidated", lambda: [vecna_api.get_subscription(i, "stub", ttl=0) for i in ids])
+    assert vecna_api.cache_stats()["revalidated"] == n_subscriptions, "responses were not revalidated with their ETag"
+    bulk_ids = [f"b{i}" for i in range(n_subscriptions)]
+    measure("client, bulk", lambda: vecna_api.get_subscriptions(bulk_ids, "stub"))
+    assert results["client, bulk"]["connections"] <= vecna_api.VECNA_API_WORKERS, "bulk mode opened more connections than workers"
+
+    assert json.loads(vecna_api.get_subscription("flaky", "stub"))["id"] == "flaky" and counts["by_id"]["flaky"] == 3, "503 was not retried"
+    vecna_api.VECNA_API_TIMEOUT, timeout = (1, 0.5), vecna_api.VECNA_API_TIMEOUT
+    t = time.perf_counter()
+    try:
+        vecna_api.get_subscription("slow", "stub")
+        raise AssertionError("hung request didn't time out")
+    except requests.RequestException as e:
+        logging.info(f"Hung request gave up after {time.perf_counter() - t:.1f}s and {counts['by_id']['slow']} attempts: {type(e).__name__}")
+    finally:
+        vecna_api.VECNA_API_TIMEOUT = timeout
+        server.shutdown()
+    logging.info(f"Cache: {vecna_api.cache_stats()}")
+    return results
+
+def benchmark_s3(n_objects=200, object_bytes=20000, csv_rows=200000):
+    """ Compare the shared S3 client (s3.py) with a new client per request, on moto's in-process S3 stand-in
+
+    Fails if concurrent, ranged, streamed or JSON reads return different data than plain get_object, or if the
+    streamed CSV differs from the CSV read from bytes.
+
+    Args:
+        n_objects (int): Number of JSON objects fetched
+        object_bytes (int): Approximate size of each object
+        csv_rows (int): Rows of the CSV snapshot read with load_csv_s3
+
+    Returns:
+        dict: Seconds of each mode
+    """
+    import io
+    import boto3
+    from moto import mock_aws
+    import s3
+    from tools.tools import load_csv_s3, load_json_s3, load_jsons_s3
+
+    os.environ.update({"AWS_ACCESS_KEY_ID": "testing", "AWS_SECRET_ACCESS_KEY": "testing", "AWS_DEFAULT_REGION": s3.S3_REGION})
+    results = {}
+    with mock_aws():
+        s3._client = None
+        bucket = "benchmark"
+        setup = boto3.client("s3", region_name=s3.S3_REGION)
+        setup.create_bucket(Bucket=bucket)
+        keys = [f"events/{i}.json" for i in range(n_objects)]
+        rng = random.Random(0)
+        bodies = {k: json.dumps({"id": k, "events": [{"code": rng.choice(["VD", "VA", "DS", "LO"]), "ts": rng.randrange(10**12)} for _ in range(object_bytes // 35)]}).encode() for k in keys}
+        for k, body in bodies.items():
+            setup.put_object(Bucket=bucket, Key=k, Body=body)
+        frame = _export_frame(csv_rows)
+        setup.put_object(Bucket=bucket, Key="snapshots/snapshot.csv", Body=frame.to_csv(index=False, sep="|").encode())
+
+        t = time.perf_counter()
+        legacy = {k: boto3.client("s3", region_name=s3.S3_REGION).get_object(Bucket=bucket, Key=k)["Body"].read() for k in keys}
+        results["new client by request"] = time.perf_counter() - t
+        t = time.perf_counter()
+        shared = {k: s3.get_object(bucket, k) for k in keys}
+        results["shared client"] = time.perf_counter() - t
+        t = time.perf_counter()
+        concurrent = s3.get_objects(bucket, keys)
+        results["shared client, concurrent"] = time.perf_counter() - t
+        assert legacy == shared == concurrent == bodies, "objects differ"
+
+        key = keys[0]
+        assert s3.get_object(bucket, key, (10, 99)) == bodies[key][10:100], "ranged read differs"
+        assert b"".join(s3.stream_object(bucket, key, chunk_bytes=1000)) == bodies[key], "streamed read differs"
+        assert load_json_s3(bucket, "0.json", "events/") == json.loads(bodies[key]), "JSON differs"
+        jsons = load_jsons_s3(bucket, ["0.json", "1.json", "missing.json"], "events/")
+        assert jsons["1.json"] == json.loads(bodies[keys[1]]) and isinstance(jsons["missing.json"], Exception), "concurrent JSONs differ"
+
+        t = time.perf_counter()
+        expected = pd.read_csv(io.BytesIO(setup.get_object(Bucket=bucket, Key="snapshots/snapshot.csv")["Body"].read()), sep="|")
+        results["csv from bytes"] = time.perf_counter() - t
+        t = time.perf_counter()
+        streamed = load_csv_s3(bucket, "snapshots/", "snapshot.csv")
+        results["csv streamed"] = time.perf_counter() - t
+        pd.testing.assert_frame_equal(streamed, expected)
+
+        with tempfile.TemporaryDirectory() as cache_dir:
+            t = time.perf_counter()
+            cold = {k: s3.get_object_cached(bucket, k, cache_dir) for k in keys}
+            results["disk cache, cold"] = time.perf_counter() - t
+            t = time.perf_counter()
+            warm = {k: s3.get_object_cached(bucket, k, cache_dir) for k in keys}
+            results["disk cache, warm"] = time.perf_counter() - t
+            assert cold == warm == bodies, "cached objects differ"
+            stats = s3.disk_cache_stats(cache_dir)
+            assert stats["misses"] == stats["hits"] == n_objects and stats["bytes_saved"] == sum(map(len, bodies.values())), "cache counters are wrong"
+            logging.info(f"Disk cache: {stats['files']} files, {stats['bytes'] / 2**20:.1f} MiB compressed, {stats['bytes_saved'] / 2**20:.1f} MiB not downloaded")
+            # Read again from disk after a restart, within a budget of half the cached bytes
+            s3._disk_caches.pop(cache_dir)
+            budget = stats["bytes"] // 2
+            for k in keys:
+                s3.get_object_cached(bucket, k, cache_dir, max_bytes=budget)
+            stats = s3.disk_cache_stats(cache_dir)
+            assert stats["hits"] > n_objects and stats["bytes"] <= budget and stats["evictions"] > 0, "cache was not reused or not evicted"
+        s3._client = None
+
+    for name, seconds in results.items():
+        logging.info(f"{name}: {seconds:.2f}s")
+    logging.info(f"{n_objects} objects of {object_bytes / 1000:.0f} KB and a CSV of {csv_rows} rows: reads are identical")
+    return results
+
+def benchmark_snapshot_catalog(n_snapshots=2500, n_new=30):
+    """ Compare the snapshot catalog (load.load_snapshot_catalog) with listing the first page of keys, on moto
+
+    Fails if the catalog misses snapshots, if reads within its ttl call S3, or if a refresh lists more than the new
+    snapshots.
+
+    Args:
+        n_snapshots (int): Daily snapshots in the bucket, more than the 1000 keys of a listing page
+        n_new (int): Snapshots added before the incremental refresh
+
+    Returns:
+        dict: Seconds of each mode
+    """
+    import boto3
+    from moto import mock_aws
+    import s3
+    import load
+
+    os.environ.update({"AWS_ACCESS_KEY_ID": "testing", "AWS_SECRET_ACCESS_KEY": "testing", "AWS_DEFAULT_REGION": s3.S3_REGION})
+    bucket, prefix = "benchmark", "raw/arauco_snapshots/"
+    dates = pd.date_range("2019-01-01", periods=n_snapshots + n_new, freq="D")
+    results = {}
+    with mock_aws():
+        s3._client = None
+        load._snapshot_catalogs.clear()
+        setup = boto3.client("s3", region_name=s3.S3_REGION)
+        setup.create_bucket(Bucket=bucket)
+        # The folder placeholder, which is not a snapshot
+        setup.put_object(Bucket=bucket, Key=prefix, Body=b"")
+        for d in dates[:n_snapshots]:
+            setup.put_object(Bucket=bucket, Key=f"{prefix}{d:%Y%m%d}-arauco_snapshot.csv", Body=f"date|{d:%Y-%m-%d}".encode())
+
+        listed = []
+        s3.client().meta.events.register("before-parameter-build.s3.ListObjectsV2", lambda params, **kwargs: listed.append(params.get("StartAfter")))
+
+        t = time.perf_counter()
+        first_page = setup.list_objects_v2(Bucket=bucket, Prefix=prefix).get("Contents", [])
+        results["first page of keys"] = time.perf_counter() - t
+        t = time.perf_counter()
+        catalog = load.load_snapshot_catalog(bucket, prefix)
+        results["catalog, cold"] = time.perf_counter() - t
+        assert len(first_page) == 1000 and len(catalog) == n_snapshots, "catalog misses snapshots"
+        assert list(catalog["date"]) == list(dates[:n_snapshots]) and catalog["etag"].str.len().eq(32).all() and catalog["size"].gt(0).all(), "catalog is wrong"
+        cold_calls = len(listed)
+
+        t = time.perf_counter()
+        for _ in range(20):
+            load.load_snapshot_catalog(bucket, prefix)
+        results["catalog, 20 reruns"] = time.perf_counter() - t
+        assert len(listed) == cold_calls, "reruns listed S3"
+
+        for d in dates[n_snapshots:]:
+            setup.put_object(Bucket=bucket, Key=f"{prefix}{d:%Y%m%d}-arauco_snapshot.csv", Body=f"date|{d:%Y-%m-%d}".encode())
+        t = time.perf_counter()
+        catalog = load.load_snapshot_catalog(bucket, prefix, ttl=0)
+        results["catalog, incremental refresh"] = time.perf_counter() - t
+        assert list(catalog["date"]) == list(dates), "refresh misses snapshots"
+        assert listed[cold_calls:] == [f"{prefix}{dates[n_snapshots - 1]:%Y%m%d}-arauco_snapshot.csv"], "refresh listed more than the new snapshots"
+
+        load._snapshot_catalogs.clear()
+        s3._client = None
+
+    for name, seconds in results.items():
+        logging.info(f"{name}: {seconds:.3f}s")
+    logging.info(f"{n_snapshots} snapshots listed in {cold_calls} requests, {n_new} new ones in 1 request")
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks for data loading")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+    ingest = subparsers.add_parser("ingest", help="Compare itinerary ingest engines on a synthetic corpus")
+    ingest.add_argument("--itineraries", type=int, default=1000000)
+    ingest.add_argument("--per-file", type=int, default=500)
+    ingest.add_argument("--workers", type=int, default=None)
+    transform = subparsers.add_parser("transform", help="Compare load.load_itinerarios with the original implementation and check both are identical")
+    transform.add_argument("--itineraries", type=int, default=500000)
+    months = subparsers.add_parser("months", help="Check rollups and pages bucket itineraries by month of ETD in UTC, on a corpus with non-UTC offsets near month boundaries")
+    months.add_argument("--itineraries", type=int, default=20000)
+    export = subparsers.add_parser("export", help="Compare peak memory of chunked exports with the in-memory CSV and check the CSV is identical")
+    export.add_argument("--rows", type=int, default=1000000)
+    prisma = subparsers.add_parser("prisma", help="Compare container lookups of OiEvents through the local index with the JSON scan, on a local Postgres")
+    prisma.add_argument("--url", required=True, help="SQLAlchemy URL of a Postgres database, e.g. postgresql+psycopg2://postgres@localhost/postgres")
+    prisma.add_argument("--events", type=int, default=1000000)
+    prisma.add_argument("--containers", type=int, default=50000)
+    prisma.add_argument("--lookups", type=int, default=50)
+    vecna_api = subparsers.add_parser("vecna-api", help="Compare the Vecna back API client with plain requests on a local stub server, and check its timeouts, retries and cache")
+    vecna_api.add_argument("--subscriptions", type=int, default=40)
+    vecna_api.add_argument("--latency", type=float, default=0.05)
+    s3 = subparsers.add_parser("s3", help="Compare the shared S3 client with a client by request on moto, and check concurrent, ranged and streamed reads")
+    s3.add_argument("--objects", type=int, default=200)
+    snapshots = subparsers.add_parser("snapshots", help="Compare the cached S3 snapshot catalog with listing the first page of keys on moto, and check its incremental refresh")
+    snapshots.add_argument("--snapshots", type=int, default=2500)
+    args = parser.parse_args()
+
+    if args.benchmark == "ingest":
+        benchmark_ingest(n_itineraries=args.itineraries, per_file=args.per_file, workers=args.workers)
+    elif args.benchmark == "transform":
+        benchmark_itinerarios_transform(n_itineraries=args.itineraries)
+    elif args.benchmark == "months":
+        check_itinerarios_months(n_itineraries=args.itineraries)
+    elif args.benchmark == "export":
+        benchmark_export(n_rows=args.rows)
+    elif args.benchmark == "prisma":
+        benchmark_events_prisma(args.url, n_events=args.events, n_containers=args.containers, n_lookups=args.lookups)
+    elif args.benchmark == "vecna-api":
+        benchmark_vecna_api(n_subscriptions=args.subscriptions, latency=args.latency)
+    elif args.benchmark == "s3":
+        benchmark_s3(n_objects=args.objects)
+    elif args.benchmark == "snapshots":
+        benchmark_snapshot_catalog(n_snapshots=args.snapshots)
+
+if __name__ == '__main__':
+    main()
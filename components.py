@@ -3,11 +3,15 @@ import pandas as pd
 import load
 import json
 
-def show_shipment_prisma(selected_subscription_id = None, rows_to_highlight = []):
+def show_shipment_prisma(selected_subscription_id = None, rows_to_highlight = [], shipments = None):
+    """Show the Prisma shipment of a subscription, taken from shipments (see load.load_shipments_prisma_batch) when
+    it's there, or else loaded by itself"""
     if selected_subscription_id is None:
         st.write("No hay suscripciones seleccionadas")
     else:
-        shipment_prisma = load.load_shipments_prisma(selected_subscription_id)
+        shipment_prisma = shipments.loc[lambda x: x["subscriptionId"].astype(str) == str(selected_subscription_id)] if shipments is not None else None
+        if shipment_prisma is None or shipment_prisma.empty:
+            shipment_prisma = load.load_shipments_prisma(selected_subscription_id)
         shipment_prisma = shipment_prisma.iloc[0].reset_index().rename(columns={"index":"Problema"})
         
         def color_coding(row):
@@ -15,61 +19,89 @@ def show_shipment_prisma(selected_subscription_id = None, rows_to_highlight = []
         
         st.dataframe(shipment_prisma.style.apply(color_coding, axis=1), height=2000)
 
-def show_data_sources(event_id:str, subscription_id:str, events_s3:bool = False, vecna_db:bool = False, vecna_dynamo:bool = True, vecna_api:bool = True, event_raw=None):
-    # Data sources
+def show_sources(sources: dict, renders: dict, timeouts: dict = load.SOURCE_TIMEOUTS):
+    """Fetch data sources concurrently (see load.fetch_sources) and show each one as soon as it arrives
 
-    sources = []
+    Each source has a placeholder in its container while it loads, and a warning instead of its data if it fails or
+    times out, so a slow source doesn't hold up the others.
+
+    Args:
+        sources (dict): Name of the source -> (loader, *args)
+        renders (dict): Name of the source -> (container, function that shows its result)
+        timeouts (dict): Seconds to wait for each source by name
+    """
+    placeholders = {}
+    for name in sources:
+        with renders[name][0]:
+            placeholders[name] = st.empty()
+        placeholders[name].info(f"Cargando {name}...")
+    for name, result in load.fetch_sources(sources, timeouts):
+        with placeholders[name].container():
+            if isinstance(result, TimeoutError):
+                st.warning(f"{name} no respondió a tiempo")
+            elif isinstance(result, Exception):
+                st.warning(f"{name} no disponible: {result}")
+            else:
+                renders[name][1](result)
+
+def show_event_vecna(event: pd.DataFrame):
+    """Vecna, Vecna Ocean Insights and Vecna Gatehouse JSONs of an event row, side by side"""
+    event_vecna_gh_text = event["vecna_event_gh"].values[0]
+    event_vecna_oi_text = event["vecna_event_oi"].values[0]
+    event_vecna_text = event["vecna_event"].values[0]
+    event_vecna_oi = json.loads(event_vecna_oi_text) if event_vecna_oi_text is not None else {}
+    event_vecna_gh = json.loads(event_vecna_gh_text) if event_vecna_gh_text is not None else {}
+    event_vecna = json.loads(event_vecna_text) if event_vecna_text is not None else {}
+    col1, col2, col3 = st.columns([1,1,1])
+    with col1:
+        st.write("Vecna Ocean Insights")
+        st.json(event_vecna_oi)
+    with col2:
+        st.write("Vecna Gatehouse")
+        st.json(event_vecna_gh)
+    with col3:
+        st.write("Vecna")
+        st.json(event_vecna)
+
+def show_data_sources(event_id:str, subscription_id:str, events_s3:bool = False, vecna_db:bool = False, vecna_dynamo:bool = True, vecna_api:bool = True, event_raw_file=None):
+    # Data sources, fetched concurrently. event_raw_file is the (filename, path) of the raw event in S3, if any
+
+    names = []
     if events_s3:
-        sources += ["Source Event (S3)"]
+        names += ["Source Event (S3)"]
     if vecna_db:
-        sources += ["Vecna (DB)"]
+        names += ["Vecna (DB)"]
     if vecna_dynamo:
-        sources += ["Vecna (Dynamo)"]
+        names += ["Vecna (Dynamo)"]
     if vecna_api:
-        sources += ["Vecna (API)"]
+        names += ["Vecna (API)"]
 
-    tabs = st.tabs(sources)
-    c = 0
+    tabs = dict(zip(names, st.tabs(names)))
+    sources, renders = {}, {}
 
     if events_s3:
-        with tabs[c]:
-            st.write("Evento")
-            if event_raw == {}:
+        if event_raw_file is None:
+            with tabs["Source Event (S3)"]:
+                st.write("Evento")
                 st.warning("File not found")
-            else:
+        else:
+            def show_event_raw(event_raw):
+                st.write("Evento")
                 st.json(event_raw)
-            st.dataframe(pd.DataFrame(event_raw["events"]))
-        c += 1
-        
+                st.dataframe(pd.DataFrame(event_raw["events"]))
+            sources["Source Event (S3)"] = (load.load_event_raw, *event_raw_file)
+            renders["Source Event (S3)"] = (tabs["Source Event (S3)"], show_event_raw)
+
     if vecna_db:
-        event = load.load_event_vecna("prod", event_id)
-        event_vecna_gh_text = event["vecna_event_gh"].values[0]
-        event_vecna_oi_text = event["vecna_event_oi"].values[0]
-        event_vecna_text = event["vecna_event"].values[0]
-        event_vecna_oi = json.loads(event_vecna_oi_text) if event_vecna_oi_text is not None else {}
-        event_vecna_gh = json.loads(event_vecna_gh_text) if event_vecna_gh_text is not None else {}
-        event_vecna = json.loads(event_vecna_text) if event_vecna_text is not None else {}
-        with tabs[c]:
-            col1, col2, col3 = st.columns([1,1,1])
-            with col1:
-                st.write("Vecna Ocean Insights")
-                st.json(event_vecna_oi)
-            with col2:
-                st.write("Vecna Gatehouse")
-                st.json(event_vecna_gh)
-            with col3:
-                st.write("Vecna")
-                st.json(event_vecna)
-        c += 1
+        sources["Vecna (DB)"] = (load.load_event_vecna, "prod", event_id)
+        renders["Vecna (DB)"] = (tabs["Vecna (DB)"], show_event_vecna)
 
     if vecna_api:
-        with tabs[c]:
-            event = load.load_event_vecna_back(subscription_id, "prod")
-            st.json(event)
-        c += 1
+        sources["Vecna (API)"] = (load.load_event_vecna_back, subscription_id, "prod")
+        renders["Vecna (API)"] = (tabs["Vecna (API)"], st.json)
 
     if vecna_dynamo:
-        with tabs[c]:
-            event = load.load_event_dynamo(subscription_id, "prod")
-            st.json(event)
-        c += 1
\ No newline at end of file
+        sources["Vecna (Dynamo)"] = (load.load_event_dynamo, subscription_id, "prod")
+        renders["Vecna (Dynamo)"] = (tabs["Vecna (Dynamo)"], st.json)
+
+    show_sources(sources, renders)
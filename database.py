@@ -1,53 +1,885 @@
 import pandas as pd
 import os
 import json
+import time
+import glob
+import shutil
+import hashlib
 import logging
 import duckdb
+from datetime import datetime, timezone
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 logging.basicConfig(level=logging.INFO)
 
-def load_itinerarios_json_to_dataframe(data_dir="data"):
-    """ Load itineraries from JSON files in directory, and returns DataFrame
+# Structure of each itinerary in the "results" array returned by Project44, in the format
+# expected by DuckDB's json_transform. Fields not listed here are dropped at ingest time.
+ITINERARY_STRUCTURE = {
+    "id": "VARCHAR",
+    "uuid_p2p": "VARCHAR",
+    "p2p_id": "VARCHAR",
+    "alliance": "VARCHAR",
+    "carrier": {"scac": "VARCHAR", "short_name": "VARCHAR"},
+    "pol": {"locode": "VARCHAR", "name": "VARCHAR"},
+    "pod": {"locode": "VARCHAR", "name": "VARCHAR"},
+    "etd": "VARCHAR",
+    "eta": "VARCHAR",
+    "etd_local": "VARCHAR",
+    "eta_local": "VARCHAR",
+    "transit_time": "DOUBLE",
+    "transshipment_count": "INTEGER",
+    "legs": [{
+        "pol": {"locode": "VARCHAR", "name": "VARCHAR"},
+        "pod": {"locode": "VARCHAR", "name": "VARCHAR"},
+        "vessel": {"shipname": "VARCHAR"},
+        "service_name": "VARCHAR",
+    }],
+}
+
+# Ports and carriers shown in itineraries, Arauco's request. Some initial data contained more ports; current data
+# doesn't as we filter at the API level.
+ITINERARIES_POL_NAMES = ["Coronel","Lirquén","San Vicente","Talcahuano","Talcahuano (San Vicente)","San Antonio","Valparaiso"]
+ITINERARIES_CARRIERS = ["CMDU","COSU","EGLV","EVRG","HLCU","SUDU","MSCU","MAEU","ONEY","ZIMU"]
+
+# Whitelist of services allowed for each carrier in itineraries of a month, as rows of year, month, carrier_scac and
+# service_name. Loaded into {table}_allowed_services by ingest_itinerarios.
+ALLOWED_SERVICES = "servicios_in.csv"
+
+# Partitioned Parquet dataset of itineraries, written by --parquet and kept up to date by every ingest once it exists
+ITINERARIES_PARQUET = "itineraries_parquet"
+
+def _json_loads(data):
+    """ Parse JSON with orjson when available, otherwise with the standard library """
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
 
-    The function expectes individual JSON files returned from Project44 API in the specified directory.
+def _json_dumps(obj):
+    """ Serialize JSON with orjson when available, otherwise with the standard library """
+    if orjson is not None:
+        return orjson.dumps(obj).decode("utf-8")
+    return json.dumps(obj)
+
+def list_itinerarios_json_files(data_dir="data"):
+    """ List JSON files in directory and all its sub-directories
 
     Args:
-        json_dir (str): Directory where JSON files are located
-        months (list): List of months to filter itineraries
+        data_dir (str): Directory where JSON files are located
     """
+    paths = []
+    for subdir, dirs, files in os.walk(data_dir):
+        paths += [os.path.join(subdir, f) for f in sorted(files) if f.endswith(".json")]
+    return sorted(paths)
 
-    data = []
+def parse_itinerarios_json_file(path):
+    """ Parse a JSON file returned from Project44 API
 
-    # Iterate over all sub-diretories in the root directory json_dir
-    for subdir, dirs, files in os.walk(data_dir):
-        # Read all json files from directory
-        files = [f for f in files if f.endswith(".json")]
-        for file in files:
-            # Read JSON
-            with open(f"{subdir}/{file}") as f:
-                d = json.load(f)
-                if not isinstance(d, dict):
-                    logging.warning(f"JSON file has unrecognized format; parent is not a dictionary: {file}")
-                    continue
-                if "results" not in d.keys():
-                    logging.warning(f"JSON file has unrecognized format; no 'results' key found: {file}")
-                    continue
-                data += [d]
-    results = [i for sublist in [d["results"] for d in data] for i in sublist]
-    return pd.DataFrame(results)
-
-def load_itinerarios_dataframe_to_db(df, database="itineraries.db", table="itineraries"):
-    """ Load itineraries from DataFrame to database
-
-    Args:
-        df (pd.DataFrame): DataFrame with itineraries
+    Runs in a worker process, so it returns the itineraries serialized as JSON strings (cheap to send back
+    to the parent process) together with the content hash of the file and a warning message when the file has
+    an unrecognized format.
+
+    Args:
+        path (str): Path to JSON file
+
+    Returns:
+        tuple: (rows, content_hash, warning), where rows is a list of JSON strings, one per itinerary
+    """
+    file = os.path.basename(path)
+    with open(path, "rb") as f:
+        content = f.read()
+    content_hash = hashlib.blake2b(content, digest_size=16).hexdigest()
+    try:
+        d = _json_loads(content)
+    except ValueError:
+        return [], content_hash, f"JSON file could not be parsed: {file}"
+    if not isinstance(d, dict):
+        return [], content_hash, f"JSON file has unrecognized format; parent is not a dictionary: {file}"
+    if "results" not in d.keys():
+        return [], content_hash, f"JSON file has unrecognized format; no 'results' key found: {file}"
+    return [_json_dumps(r) for r in d["results"]], content_hash, None
+
+def iter_parsed_itinerarios(paths, workers=None):
+    """ Parse JSON files on a process pool, yielding results in file order
+
+    At most two files per worker are in flight at any time, so memory does not grow with the number of files.
+
+    Args:
+        paths (list): Paths to JSON files
+        workers (int): Number of worker processes. Defaults to the number of CPUs
+    """
+    if not paths:
+        return
+    workers = workers or os.cpu_count() or 1
+    paths = iter(paths)
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        pending = deque()
+        for path in paths:
+            pending.append((path, pool.submit(parse_itinerarios_json_file, path)))
+            if len(pending) >= 2 * workers:
+                break
+        while pending:
+            path, future = pending.popleft()
+            yield path, *future.result()
+            path = next(paths, None)
+            if path is not None:
+                pending.append((path, pool.submit(parse_itinerarios_json_file, path)))
+
+def _itinerarios_select(source="batch"):
+    """ SELECT that turns the "itinerary" column of JSON strings in source into typed nested columns
+
+    The "source_file" column of source is kept, so rows can be retracted when their file changes or is deleted.
+    """
+    structure = json.dumps(ITINERARY_STRUCTURE).replace("'", "''")
+    columns = ", ".join([f"struct_extract(r, '{c}') AS \"{c}\"" for c in ITINERARY_STRUCTURE])
+    return f"SELECT {columns}, source_file FROM (SELECT json_transform(itinerary, '{structure}') AS r, source_file FROM {source})"
+
+def _timestamptz(column):
+    """ SQL expression parsing a Project44 timestamp (e.g. 2023-08-01T10:00-04:00) to TIMESTAMPTZ """
+    return f"strptime({column}, ['%Y-%m-%dT%H:%M%z', '%Y-%m-%dT%H:%M:%S%z'])"
+
+def _utc_offset(column):
+    """ SQL expression with the UTC offset, in minutes, of a Project44 timestamp """
+    return f"date_diff('minute', timezone('UTC', {_timestamptz(column)}), strptime(left({column}, 16), '%Y-%m-%dT%H:%M'))"
+
+def _itinerarios_flat_select(source):
+    """ SELECT that flattens typed nested itineraries in source into the columns of the itineraries table """
+    return f"""SELECT
+        coalesce(id, uuid_p2p) AS itinerary_id,
+        id,
+        uuid_p2p,
+        p2p_id,
+        alliance,
+        carrier.scac AS carrier_scac,
+        carrier.short_name AS carrier_short_name,
+        pol.locode AS pol_locode,
+        pol.name AS pol_name,
+        pod.locode AS pod_locode,
+        pod.name AS pod_name,
+        {_timestamptz('etd')} AS etd,
+        {_timestamptz('eta')} AS eta,
+        {_timestamptz('etd_local')} AS etd_local,
+        {_timestamptz('eta_local')} AS eta_local,
+        {_utc_offset('etd_local')} AS etd_local_utc_offset,
+        {_utc_offset('eta_local')} AS eta_local_utc_offset,
+        transit_time,
+        transshipment_count,
+        source_file
+    FROM {source}"""
+
+def _itinerarios_legs_select(source):
+    """ SELECT that unnests the legs of typed nested itineraries in source into the itinerary legs table
+
+    Legs carry the ETD of their itinerary, so date filters can skip row groups of the legs table too.
+    """
+    return f"""SELECT
+        itinerary_id,
+        leg_order,
+        etd,
+        leg.pol.locode AS pol_locode,
+        leg.pol.name AS pol_name,
+        leg.pod.locode AS pod_locode,
+        leg.pod.name AS pod_name,
+        leg.vessel.shipname AS vessel,
+        leg.service_name AS service_name,
+        source_file
+    FROM (
+        SELECT
+            coalesce(id, uuid_p2p) AS itinerary_id,
+            unnest(range(1, len(legs) + 1)) AS leg_order,
+            {_timestamptz('etd')} AS etd,
+            unnest(legs) AS leg,
+            source_file
+        FROM {source}
+    )"""
+
+def _load_allowed_services(con, path=ALLOWED_SERVICES, table="itineraries"):
+    """ Load the services whitelist from a CSV file into {table}_allowed_services
+
+    Returns the (year, month) whose whitelist changed, or None if there was no whitelist table (every month changed).
+    """
+    columns = {"year": "int64", "month": "int64", "carrier_scac": "str", "service_name": "str"}
+    if os.path.exists(path):
+        allowed = pd.read_csv(path, dtype=columns)[list(columns)]
+    else:
+        logging.warning(f"Services whitelist {path} not found; itineraries keep all their services")
+        allowed = pd.DataFrame({c: pd.Series(dtype=t) for c, t in columns.items()})
+
+    con.register("allowed", allowed)
+    existing = [r[0] for r in con.execute("SELECT table_name FROM information_schema.tables").fetchall()]
+    if f"{table}_allowed_services" in existing:
+        changed = con.execute(f"""SELECT DISTINCT year, month FROM (
+            (SELECT * FROM allowed EXCEPT SELECT * FROM {table}_allowed_services)
+            UNION ALL
+            (SELECT * FROM {table}_allowed_services EXCEPT SELECT * FROM allowed))
+            ORDER BY 1, 2""").fetchall()
+    else:
+        changed = None
+    if changed is None or changed:
+        con.execute(f"""CREATE OR REPLACE TABLE {table}_allowed_services AS
+            SELECT DISTINCT year::INTEGER AS year, month::INTEGER AS month, carrier_scac::VARCHAR AS carrier_scac, service_name::VARCHAR AS service_name
+            FROM allowed""")
+    con.unregister("allowed")
+    return changed
+
+def _create_itinerarios_tables(con, table="itineraries", legs_table="itinerary_legs", replace=False):
+    """ Create itineraries table, its legs table and its file manifest
+
+    Args:
+        con (duckdb.DuckDBPyConnection): Connection to database
+        table (str): Table name
+        legs_table (str): Legs table name
+        replace (bool): Drop existing tables and start from scratch
+    """
+    create = "CREATE OR REPLACE TABLE" if replace else "CREATE TABLE IF NOT EXISTS"
+    empty = f"({_itinerarios_select('(SELECT NULL::VARCHAR AS itinerary, NULL::VARCHAR AS source_file WHERE false)')})"
+    con.execute(f"{create} {table} AS {_itinerarios_flat_select(empty)}")
+    con.execute(f"{create} {legs_table} AS {_itinerarios_legs_select(empty)}")
+    con.execute(f"""{create} {table}_manifest (
+        path VARCHAR,
+        size BIGINT,
+        mtime DOUBLE,
+        content_hash VARCHAR,
+        rows INTEGER,
+        ingested_at TIMESTAMP
+    )""")
+
+def _etd_month(column="etd"):
+    """ SQL expression with the first instant of the UTC month of an ETD, as TIMESTAMP """
+    return f"date_trunc('month', timezone('UTC', {column}))"
+
+def _touch_months(con, source, etd, inserted, table="itineraries"):
+    """ Record the months of ETD of rows of source in {table}_touched, a temp table created by ingest_itinerarios
+
+    Args:
+        con (duckdb.DuckDBPyConnection): Connection to database
+        source (str): Relation with the rows
+        etd (str): SQL expression of their ETD, as TIMESTAMPTZ
+        inserted (bool): Whether rows are inserted (True) or deleted
+        table (str): Table name
+    """
+    con.execute(f"INSERT INTO {table}_touched SELECT DISTINCT {_etd_month(etd)}, {inserted} FROM {source} WHERE {etd} IS NOT NULL")
+
+def _months_filter(months, column="etd"):
+    """ SQL condition on the ETD column being in one of months, a list of (year, month), as ranges of ETD so DuckDB
+    skips the row groups of other months """
+    ranges = [month_range(year, month) for year, month in months]
+    return " OR ".join(f"({column} >= '{start.isoformat()}'::TIMESTAMPTZ AND {column} < '{end.isoformat()}'::TIMESTAMPTZ)" for start, end in ranges) or "false"
+
+def _cluster_itinerarios(con, table="itineraries", legs_table="itinerary_legs", months=None):
+    """ Rewrite the rows of months of table and legs_table sorted by ETD, or the whole tables if months is None
+
+    Sorted tables give DuckDB tight per-row-group min/max ETDs (zone maps), so a date range only reads the row groups
+    that overlap it. Merges insert each batch sorted but interleaved with previous rows of the same months, so the rows
+    of the months that got new rows are moved, sorted, to the end of the tables. Deletes keep the order, and rows of
+    other months are not rewritten, so the cost follows the months changed and not the whole history.
+
+    Args:
+        con (duckdb.DuckDBPyConnection): Connection to database
+        table (str): Table name
+        legs_table (str): Legs table name
+        months (list): (year, month) of ETD whose rows are rewritten
+    """
+    for t, order in [(table, "etd, itinerary_id"), (legs_table, "etd, itinerary_id, leg_order")]:
+        if months is None:
+            con.execute(f"CREATE OR REPLACE TABLE {t} AS SELECT * FROM {t} ORDER BY {order}")
+        elif months:
+            where = _months_filter(months)
+            con.execute(f"CREATE OR REPLACE TEMP TABLE {t}_moved AS SELECT * FROM {t} WHERE {where} ORDER BY {order}")
+            con.execute(f"DELETE FROM {t} WHERE {where}")
+            con.execute(f"INSERT INTO {t} SELECT * FROM {t}_moved")
+            con.execute(f"DROP TABLE {t}_moved")
+
+def _merge_itinerarios_source(con, source, table="itineraries", legs_table="itinerary_legs"):
+    """ Merge JSON itineraries from source into table and legs_table
+
+    Rows previously loaded from the same files are retracted, and itineraries already in the table are replaced,
+    keyed on the Project44 itinerary id (id, or uuid_p2p when id is missing). Rows are inserted sorted by ETD so
+    DuckDB zone maps can skip row groups on date filters.
+
+    Args:
+        con (duckdb.DuckDBPyConnection): Connection to database
+        source (str): Relation with columns "itinerary" (JSON) and "source_file"
+        table (str): Table name
+        legs_table (str): Legs table name
+    """
+    con.execute(f"""CREATE OR REPLACE TEMP TABLE {table}_batch AS {_itinerarios_select(source)}
+        QUALIFY row_number() OVER (PARTITION BY coalesce(id, uuid_p2p) ORDER BY source_file DESC) = 1""")
+    _touch_months(con, f"""(SELECT etd FROM {table} WHERE source_file IN (SELECT DISTINCT source_file FROM {table}_batch)
+        OR itinerary_id IN (SELECT coalesce(id, uuid_p2p) FROM {table}_batch))""", "etd", False, table=table)
+    _touch_months(con, f"{table}_batch", _timestamptz("etd"), True, table=table)
+    for t in [table, legs_table]:
+        con.execute(f"DELETE FROM {t} WHERE source_file IN (SELECT DISTINCT source_file FROM {table}_batch)")
+        con.execute(f"DELETE FROM {t} WHERE itinerary_id IN (SELECT coalesce(id, uuid_p2p) FROM {table}_batch)")
+    con.execute(f"INSERT INTO {table} {_itinerarios_flat_select(f'{table}_batch')} ORDER BY etd")
+    con.execute(f"INSERT INTO {legs_table} {_itinerarios_legs_select(f'{table}_batch')} ORDER BY etd")
+    con.execute(f"DROP TABLE {table}_batch")
+
+def _merge_itinerarios_batch(con, rows, source_files, table="itineraries", legs_table="itinerary_legs"):
+    """ Merge a batch of JSON itineraries parsed in Python into table and legs_table
+
+    Args:
+        con (duckdb.DuckDBPyConnection): Connection to database
+        rows (list): Itineraries as JSON strings
+        source_files (list): File each itinerary was read from
+        table (str): Table name
+        legs_table (str): Legs table name
+    """
+    con.register("batch", pd.DataFrame({"itinerary": rows, "source_file": source_files}))
+    _merge_itinerarios_source(con, "batch", table=table, legs_table=legs_table)
+    con.unregister("batch")
+
+def _retract_itinerarios_files(con, paths, table="itineraries", legs_table="itinerary_legs"):
+    """ Delete rows loaded from paths in table and legs_table """
+    con.register("retracted", pd.DataFrame({"path": paths}))
+    _touch_months(con, f"(SELECT etd FROM {table} WHERE source_file IN (SELECT path FROM retracted))", "etd", False, table=table)
+    for t in [table, legs_table]:
+        con.execute(f"DELETE FROM {t} WHERE source_file IN (SELECT path FROM retracted)")
+    con.unregister("retracted")
+
+def _ingest_itinerarios_pool(con, paths, stats, manifest, table="itineraries", legs_table="itinerary_legs", workers=None, batch_size=50000):
+    """ Parse files in paths on a process pool and merge their itineraries into the database in batches
+
+    Args:
+        con (duckdb.DuckDBPyConnection): Connection to database
+        paths (list): Paths to new or changed JSON files
+        stats (dict): os.stat result of each path
+        manifest (dict): (size, mtime, content_hash, rows) of each path previously loaded
+        table (str): Table name
+        legs_table (str): Legs table name
+        workers (int): Number of worker processes. Defaults to the number of CPUs
+        batch_size (int): Number of itineraries inserted at once
+
+    Returns:
+        tuple: (entries, n_rows), with the manifest entries of paths and the number of rows loaded
+    """
+    n_rows, rows, source_files, entries = 0, [], [], []
+    for path, file_rows, content_hash, warning in iter_parsed_itinerarios(paths, workers=workers):
+        st = stats[path]
+        entries += [(path, st.st_size, st.st_mtime, content_hash, len(file_rows))]
+        # Touched but not modified, only the manifest is updated
+        if manifest.get(path, (None, None, None))[2] == content_hash:
+            continue
+        if warning is not None:
+            logging.warning(warning)
+        if not file_rows:
+            _retract_itinerarios_files(con, [path], table=table, legs_table=legs_table)
+            continue
+        rows += file_rows
+        source_files += [path] * len(file_rows)
+        if len(rows) >= batch_size:
+            _merge_itinerarios_batch(con, rows, source_files, table=table, legs_table=legs_table)
+            n_rows += len(rows)
+            rows, source_files = [], []
+    if rows:
+        _merge_itinerarios_batch(con, rows, source_files, table=table, legs_table=legs_table)
+        n_rows += len(rows)
+    return entries, n_rows
+
+def _file_hash(path):
+    """ Content hash of a file, read in chunks """
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+def _ingest_itinerarios_duckdb(con, paths, stats, manifest, table="itineraries", legs_table="itinerary_legs", batch_bytes=16 * 1024 * 1024):
+    """ Read files in paths with DuckDB's JSON reader and merge their itineraries into the database
+
+    Itineraries never go through Python objects: DuckDB reads each file, validates it and unnests its "results"
+    array. Files are staged in batches of about batch_bytes. Each file is read with its own read_json_objects call,
+    as reading many whole-document files in one call is not reliable in the DuckDB versions we use.
+
+    Args:
+        con (duckdb.DuckDBPyConnection): Connection to database
+        paths (list): Paths to new or changed JSON files
+        stats (dict): os.stat result of each path
+        manifest (dict): (size, mtime, content_hash, rows) of each path previously loaded
+        table (str): Table name
+        legs_table (str): Legs table name
+        batch_bytes (int): Approximate size of files staged at once
+
+    Returns:
+        tuple: (entries, n_rows), with the manifest entries of paths and the number of rows loaded
+    """
+    entries, n_rows = [], 0
+    batches, batch, size = [], [], 0
+    for path in paths:
+        batch += [path]
+        size += stats[path].st_size
+        if size >= batch_bytes:
+            batches += [batch]
+            batch, size = [], 0
+    if batch:
+        batches += [batch]
+
+    for batch in batches:
+        hashes = {path: _file_hash(path) for path in batch}
+        # Touched but not modified, only the manifest is updated
+        modified = [path for path in batch if manifest.get(path, (None, None, None))[2] != hashes[path]]
+        rows = dict.fromkeys(modified, 0)
+        if modified:
+            # JSON is kept as VARCHAR in temp tables: storing the JSON type in them crashes DuckDB 0.8.1
+            con.execute(f"CREATE OR REPLACE TEMP TABLE {table}_raw (source_file VARCHAR, json VARCHAR)")
+            for path in modified:
+                literal = path.replace("'", "''")
+                # The reader allocates buffers of twice the maximum object size, so it is sized to the file
+                maximum_object_size = max(stats[path].st_size + 1, 16 * 1024 * 1024)
+                con.execute(f"""INSERT INTO {table}_raw
+                    SELECT '{literal}', json FROM read_json_objects('{literal}', format='unstructured', ignore_errors=true, maximum_object_size={maximum_object_size})""")
+
+            invalid = con.execute(f"""SELECT source_file, CASE
+                    WHEN json IS NULL THEN 'could not be parsed'
+                    WHEN json_type(json) != 'OBJECT' THEN 'has unrecognized format; parent is not a dictionary'
+                    ELSE 'has unrecognized format; no ''results'' key found'
+                END
+                FROM {table}_raw
+                WHERE json IS NULL OR json_type(json) != 'OBJECT' OR json_extract(json, '$.results') IS NULL""").fetchall()
+            for path, reason in invalid:
+                logging.warning(f"JSON file {reason}: {os.path.basename(path)}")
+
+            _retract_itinerarios_files(con, modified, table=table, legs_table=legs_table)
+            source = f"""(SELECT unnest(from_json(json_extract(json, '$.results'), '["VARCHAR"]')) AS itinerary, source_file
+                FROM {table}_raw
+                WHERE json IS NOT NULL AND json_type(json) = 'OBJECT' AND json_extract(json, '$.results') IS NOT NULL)"""
+            con.execute(f"CREATE OR REPLACE TEMP TABLE {table}_unnested AS {source}")
+            rows.update(dict(con.execute(f"SELECT source_file, count(*) FROM {table}_unnested GROUP BY source_file").fetchall()))
+            _merge_itinerarios_source(con, f"{table}_unnested", table=table, legs_table=legs_table)
+            n_rows += sum(rows.values())
+            con.execute(f"DROP TABLE {table}_raw")
+            con.execute(f"DROP TABLE {table}_unnested")
+        for path in batch:
+            st = stats[path]
+            entries += [(path, st.st_size, st.st_mtime, hashes[path], rows.get(path, manifest.get(path, (None, None, None, 0))[3]))]
+    return entries, n_rows
+
+def ingest_itinerarios(data_dir="data", database="itineraries.db", table="itineraries", legs_table="itinerary_legs", workers=None, batch_size=50000, full=False, engine="pool", allowed_services=ALLOWED_SERVICES, parquet_dir=ITINERARIES_PARQUET):
+    """ Load itineraries from JSON files in directory into database
+
+    The function expects individual JSON files returned from Project44 API in the specified directory. Files are
+    parsed on a process pool and itineraries are streamed to the database in batches of batch_size rows, so peak
+    memory is bounded by the batch size and not by the number of files. With engine="duckdb", DuckDB reads and
+    unnests the files itself instead, with the same validation and warnings.
+
+    Itineraries are stored with flat typed columns (carrier, POL and POD codes and names, TIMESTAMPTZ ETD/ETA),
+    and their legs in a child table keyed on itinerary_id, ordered by leg_order. Both tables keep the rows of each
+    month of ETD together and sorted by ETD (only the months that got new rows are rewritten, see
+    _cluster_itinerarios), so date range queries only read the matching row groups.
+
+    Loading is incremental: a manifest table ({table}_manifest) records the path, size, mtime and content hash of
+    each file. Only new or changed files are parsed and merged in, and rows from deleted files are retracted, so
+    re-running on an unchanged directory only costs a stat per file. The services whitelist is reloaded from
+    allowed_services on every run. The monthly transit time rollups of the months with itineraries inserted or deleted,
+    or whose whitelist changed, are refreshed (see refresh_itinerarios_rollups). If the Parquet dataset exists in
+    parquet_dir, the months with itineraries inserted or deleted are exported again (see export_itinerarios_parquet),
+    so the page doesn't read stale partitions.
+
+    Args:
+        data_dir (str): Directory where JSON files are located
         database (str): Database name
         table (str): Table name
+        legs_table (str): Legs table name
+        workers (int): Number of worker processes. Defaults to the number of CPUs
+        batch_size (int): Number of itineraries inserted at once
+        full (bool): Ignore the manifest and rebuild the table from all files
+        engine (str): "pool" to parse files in Python on a process pool, or "duckdb" to read them with DuckDB's
+            JSON reader, bypassing Python objects
+        allowed_services (str): CSV file with the services whitelist (year, month, carrier_scac, service_name)
+        parquet_dir (str): Partitioned Parquet dataset kept up to date, if it exists
+
+    Returns:
+        dict: Number of files parsed, deleted and rows loaded, elapsed seconds, and the result of the Parquet export
+            (None if there is no dataset or nothing changed)
     """
+    start = time.perf_counter()
     con = duckdb.connect(database)
-    con.execute(f"CREATE OR REPLACE TABLE {table} AS SELECT * FROM df")
+
+    # Databases created before the manifest, the legs table or the ETD of legs existed are rebuilt from scratch
+    existing = [r[0] for r in con.execute("SELECT table_name FROM information_schema.tables").fetchall()]
+    legs_columns = [r[0] for r in con.execute(f"SELECT column_name FROM information_schema.columns WHERE table_name = '{legs_table}'").fetchall()]
+    rebuild = full or f"{table}_manifest" not in existing or "etd" not in legs_columns
+    _create_itinerarios_tables(con, table=table, legs_table=legs_table, replace=rebuild)
+
+    manifest = {r[0]: r[1:] for r in con.execute(f"SELECT path, size, mtime, content_hash, rows FROM {table}_manifest").fetchall()}
+    stats = {p: os.stat(p) for p in list_itinerarios_json_files(data_dir)}
+    changed = [p for p, st in stats.items() if manifest.get(p, (None, None))[:2] != (st.st_size, st.st_mtime)]
+    deleted = [p for p in manifest if p not in stats]
+
+    # Rollups are rebuilt for every month with the tables, or refreshed for the months touched and whose whitelist changed
+    rollups = rebuild or f"{table}_transit_times" not in existing or f"{table}_destination_times" not in existing
+
+    con.begin()
+    # Months of ETD of the rows inserted and deleted, see _touch_months
+    con.execute(f"CREATE OR REPLACE TEMP TABLE {table}_touched (month TIMESTAMP, inserted BOOLEAN)")
+    whitelist_months = _load_allowed_services(con, allowed_services, table=table)
+    rollups = rollups or whitelist_months is None
+    if deleted:
+        _retract_itinerarios_files(con, deleted, table=table, legs_table=legs_table)
+        con.register("deleted", pd.DataFrame({"path": deleted}))
+        con.execute(f"DELETE FROM {table}_manifest WHERE path IN (SELECT path FROM deleted)")
+        con.unregister("deleted")
+
+    if engine == "duckdb":
+        entries, n_rows = _ingest_itinerarios_duckdb(con, changed, stats, manifest, table=table, legs_table=legs_table)
+    else:
+        entries, n_rows = _ingest_itinerarios_pool(con, changed, stats, manifest, table=table, legs_table=legs_table, workers=workers, batch_size=batch_size)
+
+    if entries:
+        con.register("entries", pd.DataFrame(entries, columns=["path", "size", "mtime", "content_hash", "rows"]))
+        con.execute(f"DELETE FROM {table}_manifest WHERE path IN (SELECT path FROM entries)")
+        con.execute(f"INSERT INTO {table}_manifest SELECT *, now()::TIMESTAMP FROM entries")
+        con.unregister("entries")
+    if changed or deleted:
+        inserted_months = con.execute(f"SELECT DISTINCT year(month), month(month) FROM {table}_touched WHERE inserted ORDER BY 1, 2").fetchall()
+        _cluster_itinerarios(con, table=table, legs_table=legs_table, months=None if rebuild else inserted_months)
+    touched_months = con.execute(f"SELECT DISTINCT year(month), month(month) FROM {table}_touched").fetchall()
+    rollup_months = sorted(set(touched_months) | set(whitelist_months or []))
+    if rollups or rollup_months:
+        refresh_itinerarios_rollups(con, table=table, legs_table=legs_table, months=None if rollups else rollup_months)
+    con.execute(f"DROP TABLE {table}_touched")
+    con.commit()
     con.close()
 
+    parquet = None
+    if parquet_dir and os.path.isdir(parquet_dir) and (rebuild or touched_months):
+        parquet = export_itinerarios_parquet(database=database, output_dir=parquet_dir, table=table, legs_table=legs_table, rewrite_past=True, months=None if rebuild else touched_months)
+
+    n_files = len(changed)
+    elapsed = time.perf_counter() - start
+    logging.info(f"Ingested {n_files} new or changed files ({n_files/elapsed:.1f} files/s) and {n_rows} itineraries ({n_rows/elapsed:.1f} rows/s) in {elapsed:.2f}s; {len(deleted)} deleted files retracted, {len(stats)-n_files} files unchanged")
+    return {"files": n_files, "deleted": len(deleted), "rows": n_rows, "seconds": elapsed, "parquet": parquet}
+
+def month_range(year, month):
+    """ First instant of a month and of the next one, in UTC """
+    return datetime(year, month, 1, tzinfo=timezone.utc), datetime(year + month // 12, month % 12 + 1, 1, tzinfo=timezone.utc)
+
+def itinerarios_select(start, end, pols=None, pods=None, carriers=None, partitions=None, table="itineraries", legs_table="itinerary_legs"):
+    """ SELECT of the itineraries with ETD in [start, end) as shown in the Itinerarios page, and its parameters
+
+    Carrier, ports, timestamps, transhipments, vessels and services are computed with DuckDB list functions, itineraries
+    are filtered by ITINERARIES_POL_NAMES and ITINERARIES_CARRIERS, and services by the whitelist in
+    {table}_allowed_services of the month of their ETD. The query runs on a connection to the database, also when
+    reading Parquet partitions.
+
+    Args:
+        start (datetime): First ETD, included
+        end (datetime): Last ETD, excluded
+        pols (list): POL locodes to keep. All if None
+        pods (list): POD locodes to keep. All if None
+        carriers (list): Carrier SCACs to keep. All if None
+        partitions (list): Parquet files to read instead of the database tables
+        table (str): Table name
+        legs_table (str): Legs table name
+
+    Returns:
+        tuple: Query and list of parameters
+    """
+    # Filters on ETD, POL, POD and carrier, applied where itineraries are read so DuckDB can skip row groups and
+    # Parquet partitions
+    where, parameters = '"etd" >= ? and "etd" < ?', [start, end]
+    for column, values in [("pol_locode", pols), ("pod_locode", pods), ("carrier_scac", carriers)]:
+        if values is not None:
+            where += f' and "{column}" in (select unnest(?::VARCHAR[]))'
+            parameters += [list(values)]
+
+    # Itineraries, with lists over their legs ordered by leg_order: transhipments, ports of discharge, vessels and
+    # services. From Parquet partitions we take the lists from the legs column; from the database we aggregate the
+    # legs table.
+    if partitions is not None:
+        files = ", ".join(["'" + p.replace("'", "''") + "'" for p in partitions])
+        source = f'''
+select
+    * exclude ("legs")
+    ,list_transform("legs", x -> [x.pol.locode || '-' || x.pod.locode]) as "transhipments"
+    ,list_transform("legs", x -> [x.pol.name || '-' || x.pod.name]) as "transhipments_name"
+    ,list_transform("legs", x -> x.pod.name) as "legs_pod_name"
+    ,list_transform("legs", x -> x.vessel.shipname) as "vessel"
+    ,list_transform("legs", x -> x.service_name) as "service"
+from
+    read_parquet([{files}], hive_partitioning = true)
+where
+    {where}
+'''
+    else:
+        source = f'''
+with "i" as (
+    select
+        *
+    from
+        "{table}"
+    where
+        {where}
+)
+select
+    "i".*
+    ,"l".* exclude ("itinerary_id")
+from
+    "i"
+    left join (
+        select
+            "itinerary_id"
+            ,list_transform("legs", x -> [x.pol_locode || '-' || x.pod_locode]) as "transhipments"
+            ,list_transform("legs", x -> [x.pol_name || '-' || x.pod_name]) as "transhipments_name"
+            ,list_transform("legs", x -> x.pod_name) as "legs_pod_name"
+            ,list_transform("legs", x -> x.vessel) as "vessel"
+            ,list_transform("legs", x -> x.service_name) as "service"
+        from (
+            -- Sorting the aggregated list is much cheaper than an ordered aggregate; leg_order goes first so it is the sort key
+            select
+                "itinerary_id"
+                ,list_sort(list({{
+                    'leg_order': "leg_order", 'pol_locode': "pol_locode", 'pod_locode': "pod_locode",
+                    'pol_name': "pol_name", 'pod_name': "pod_name", 'vessel': "vessel", 'service_name': "service_name"
+                }})) as "legs"
+            from
+                "{legs_table}"
+            where
+                "etd" >= ? and "etd" < ?
+                and "itinerary_id" in (select "itinerary_id" from "i")
+            group by
+                "itinerary_id"
+        )
+    ) as "l" using ("itinerary_id")
+'''
+
+    pol_names = ",".join(["?"] * len(ITINERARIES_POL_NAMES))
+    carriers = ",".join(["?"] * len(ITINERARIES_CARRIERS))
+    if partitions is None:
+        parameters += [start, end]
+
+    # Carriers with allowed services for the month of ETD keep only those services, in order, and itineraries with
+    # none of them are dropped. Other carriers keep all their services.
+    service = '''case when "w"."services" is null then "service" else nullif(list_filter("service", x -> list_contains("w"."services", x)), []) end'''
+    whitelist = f'''
+    left join (
+        select
+            "year" as "w_year"
+            ,"month" as "w_month"
+            ,"carrier_scac" as "w_carrier_scac"
+            ,list("service_name") as "services"
+        from
+            "{table}_allowed_services"
+        group by
+            "year", "month", "carrier_scac"
+    ) as "w" on "w_carrier_scac" = "carrier_scac"
+        and "w_year" = year(timezone('UTC', "etd"))
+        and "w_month" = month(timezone('UTC', "etd"))'''
+    query = f'''
+select
+    *
+from (
+    select
+        "carrier_short_name" as "carrier"
+        ,"pol_locode" as "pol"
+        ,"pod_locode" as "pod"
+        -- Timestamps are stored with time zone; we show ETD/ETA in UTC and local ETD/ETA in local time
+        ,timezone('UTC', "etd") as "etd"
+        ,timezone('UTC', "eta") as "eta"
+        ,timezone('UTC', "etd_local") + interval ("etd_local_utc_offset") minute as "etd_local"
+        ,timezone('UTC', "eta_local") + interval ("eta_local_utc_offset") minute as "eta_local"
+        ,"transit_time"
+        ,"transshipment_count"
+        ,"carrier_scac"
+        ,"pol_name"
+        ,"pod_name"
+        ,"transhipments"
+        ,"transhipments_name"
+        -- Port of each transhipment. If there are no transhipments, first one is "DIRECT", Arauco's request.
+        ,coalesce(case when len("legs_pod_name") > 1 then "legs_pod_name"[1] end, 'DIRECT') as "transhipments_name_1"
+        ,coalesce(case when len("legs_pod_name") > 2 then "legs_pod_name"[2] end, '-') as "transhipments_name_2"
+        ,coalesce(case when len("legs_pod_name") > 3 then "legs_pod_name"[3] end, '-') as "transhipments_name_3"
+        ,coalesce(case when len("legs_pod_name") > 4 then "legs_pod_name"[4] end, '-') as "transhipments_name_4"
+        ,case when len("legs_pod_name") > 5 then "legs_pod_name"[5] end as "transhipments_name_5"
+        ,"vessel"
+        ,{service} as "service"
+        -- First service, to compute average times over it
+        ,({service})[1] as "service_first"
+    from
+        ({source}) as "i"{whitelist}
+    where
+        "pol_name" in ({pol_names})
+        and "carrier_scac" in ({carriers})
+)
+-- delete rows with no services
+where
+    "service" is not null
+'''
+    parameters += ITINERARIES_POL_NAMES + ITINERARIES_CARRIERS
+
+    return query, parameters
+
+def _python_list_literal(column, nested=False):
+    """ SQL expression rendering a list of strings (or of one-string lists, if nested) as Python's str() does """
+    item = "'[''' || x[1] || ''']'" if nested else "'''' || x || ''''"
+    return f"""'[' || coalesce(list_aggregate(list_transform("{column}", x -> {item}), 'string_agg', ', '), '') || ']'"""
+
+def itinerarios_rollup_select(kind, start, end, pols=None, pods=None, carriers=None, partitions=None, table="itineraries", legs_table="itinerary_legs"):
+    """ SELECT of transit time aggregates of the itineraries with ETD in [start, end), and its parameters
+
+    With kind="transit_times", mean, standard deviation and count of transit times by POL, POD, carrier, transhipment
+    path and service, as in the "Tiempos de tránsito" tab. With kind="destination_times", the same by POD, as in the
+    "Tiempos a destino" tab. Means and standard deviations are rounded to 1 decimal.
+
+    Args:
+        kind (str): "transit_times" or "destination_times"
+        start (datetime): First ETD, included
+        end (datetime): Last ETD, excluded
+        pols (list): POL locodes to keep. All if None
+        pods (list): POD locodes to keep. All if None
+        carriers (list): Carrier SCACs to keep. All if None
+        partitions (list): Parquet files to read instead of the database tables
+        table (str): Table name
+        legs_table (str): Legs table name
+
+    Returns:
+        tuple: Query and list of parameters
+    """
+    itinerarios, parameters = itinerarios_select(start, end, pols=pols, pods=pods, carriers=carriers, partitions=partitions, table=table, legs_table=legs_table)
+    if kind == "transit_times":
+        keys = f'''"pol"
+    ,"pod"
+    ,"carrier"
+    ,{_python_list_literal("transhipments", nested=True)} as "transhipments"
+    ,"transhipments_name_1"
+    ,"transhipments_name_2"
+    ,"service_first"
+    ,{_python_list_literal("service")} as "service"'''
+    elif kind == "destination_times":
+        keys = '''"pod"
+    ,"pod_name"'''
+    else:
+        raise ValueError(f"Unknown rollup {kind}")
+    query = f'''
+select
+    {keys}
+    ,round_even(avg("transit_time"), 1) as "transit_time_mean"
+    ,round_even(stddev_samp("transit_time"), 1) as "transit_time_std"
+    ,count("transit_time") as "transit_time_count"
+from
+    ({itinerarios})
+group by all
+order by all
+'''
+    return query, parameters
+
+def refresh_itinerarios_rollups(con, table="itineraries", legs_table="itinerary_legs", months=None):
+    """ Materialize transit time aggregates by month of ETD in {table}_transit_times and {table}_destination_times
+
+    Called by ingest_itinerarios whenever itineraries change, so the Itinerarios page reads a few precomputed rows per
+    month instead of aggregating every itinerary on each visit. Only the months given are aggregated again; months
+    left without itineraries lose their rows. Each month is aggregated by its own query.
+
+    Args:
+        con (duckdb.DuckDBPyConnection): Connection to the database
+        table (str): Table name
+        legs_table (str): Legs table name
+        months (list): (year, month) to refresh. With None, the tables are rebuilt with every month of ETD
+    """
+    kinds = ["transit_times", "destination_times"]
+    existing = [r[0] for r in con.execute("SELECT table_name FROM information_schema.tables").fetchall()]
+    rebuild = months is None or any(f"{table}_{kind}" not in existing for kind in kinds)
+    if rebuild:
+        months = con.execute(f"SELECT DISTINCT year(timezone('UTC', etd)), month(timezone('UTC', etd)) FROM {table} WHERE etd IS NOT NULL ORDER BY 1, 2").fetchall()
+    for kind in kinds:
+        if rebuild:
+            # Created from a month's query with no rows, so the tables have their columns even with no itineraries
+            now = datetime.now(timezone.utc)
+            query, parameters = itinerarios_rollup_select(kind, *month_range(now.year, now.month), table=table, legs_table=legs_table)
+            con.execute(f"CREATE OR REPLACE TABLE {table}_{kind} AS SELECT {now.year} AS year, {now.month} AS month, * FROM ({query}) LIMIT 0", parameters)
+        for year, month in months:
+            query, parameters = itinerarios_rollup_select(kind, *month_range(year, month), table=table, legs_table=legs_table)
+            if not rebuild:
+                con.execute(f"DELETE FROM {table}_{kind} WHERE year = ? AND month = ?", [year, month])
+            con.execute(f"INSERT INTO {table}_{kind} SELECT {year} AS year, {month} AS month, * FROM ({query})", parameters)
+
+def _itinerarios_with_legs_select(table="itineraries", legs_table="itinerary_legs", where="true"):
+    """ SELECT of itineraries matching where, with their legs aggregated back to a list ordered by leg_order """
+    return f"""SELECT
+        i.* EXCLUDE (source_file),
+        l.legs
+    FROM
+        (SELECT * FROM {table} WHERE {where}) AS i
+        LEFT JOIN (
+            SELECT
+                itinerary_id,
+                list({{
+                    'pol': {{'locode': pol_locode, 'name': pol_name}},
+                    'pod': {{'locode': pod_locode, 'name': pod_name}},
+                    'vessel': {{'shipname': vessel}},
+                    'service_name': service_name
+                }} ORDER BY leg_order) AS legs
+            FROM
+                {legs_table}
+            WHERE
+                itinerary_id IN (SELECT itinerary_id FROM {table} WHERE {where})
+            GROUP BY
+                itinerary_id
+        ) AS l USING (itinerary_id)"""
+
+def export_itinerarios_parquet(database="itineraries.db", output_dir="itineraries_parquet", table="itineraries", legs_table="itinerary_legs", rewrite_past=False, months=None):
+    """ Write itineraries from database as a Hive-partitioned Parquet dataset
+
+    The dataset is partitioned by year/month of ETD (UTC) and POL, e.g. itineraries_parquet/year=2023/month=8/pol_locode=CLSAI,
+    and each row carries its legs as a list, so a month can be read without touching any other partition. Each month
+    is written to a temporary directory and then swapped in place. Partitions of past months that already exist are
+    left untouched, so history stays immutable and only current and future months are rewritten. Given months are
+    rewritten (or removed, if they have no itineraries left) whether they are past or not, since their rows changed:
+    ingest_itinerarios passes the months it touched.
+
+    Args:
+        database (str): Database name
+        output_dir (str): Root directory of the Parquet dataset
+        table (str): Table name
+        legs_table (str): Legs table name
+        rewrite_past (bool): Also rewrite partitions of past months
+        months (list): (year, month) of ETD to rewrite, instead of every month
+
+    Returns:
+        dict: Number of months written, skipped and removed
+    """
+    con = duckdb.connect(database, read_only=True)
+    existing = con.execute(f"SELECT DISTINCT year(timezone('UTC', etd)), month(timezone('UTC', etd)) FROM {table} WHERE etd IS NOT NULL ORDER BY 1, 2").fetchall()
+    now = datetime.now(timezone.utc)
+    current = (now.year, now.month)
+
+    written, skipped = 0, 0
+    for year, month in existing if months is None else [m for m in existing if m in set(months)]:
+        path = os.path.join(output_dir, f"year={year}", f"month={month}")
+        if months is None and (year, month) < current and os.path.isdir(path) and not rewrite_past:
+            skipped += 1
+            continue
+        start, end = month_range(year, month)
+        where = f"etd >= '{start.isoformat()}'::TIMESTAMPTZ AND etd < '{end.isoformat()}'::TIMESTAMPTZ"
+        tmp = os.path.join(output_dir, f".tmp-year={year}-month={month}")
+        shutil.rmtree(tmp, ignore_errors=True)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        con.execute(f"COPY ({_itinerarios_with_legs_select(table, legs_table, where)} ORDER BY etd) TO '{tmp}' (FORMAT PARQUET, PARTITION_BY (pol_locode))")
+        if os.path.isdir(path):
+            os.rename(path, tmp + ".old")
+        os.rename(tmp, path)
+        shutil.rmtree(tmp + ".old", ignore_errors=True)
+        written += 1
+    con.close()
+
+    # Months that would be rewritten but are no longer in the database (e.g. their files were deleted) are removed
+    removed = 0
+    for path in glob.glob(os.path.join(output_dir, "year=*", "month=*")):
+        year = int(os.path.basename(os.path.dirname(path)).split("=")[1])
+        month = int(os.path.basename(path).split("=")[1])
+        rewritten = (year, month) >= current or rewrite_past if months is None else (year, month) in months
+        if rewritten and (year, month) not in existing:
+            shutil.rmtree(path)
+            removed += 1
+
+    logging.info(f"Wrote {written} months of itineraries to {output_dir}; {skipped} past months kept unchanged, {removed} removed")
+    return {"written": written, "skipped": skipped, "removed": removed}
+
 def get_itinerarios(database="itineraries.db", table="itineraries"):
     """ Get itineraries from database
 
@@ -61,11 +893,22 @@ def get_itinerarios(database="itineraries.db", table="itineraries"):
     return df
 
 def main():
+    import argparse
+    parser = argparse.ArgumentParser(description="Load Project44 itineraries from data/ into itineraries.db")
+    parser.add_argument("--full", action="store_true", help="Ignore the file manifest and rebuild from all files")
+    parser.add_argument("--engine", choices=["pool", "duckdb"], default="pool", help="Parse JSON on a Python process pool (default) or with DuckDB's JSON reader")
+    parser.add_argument("--parquet", metavar="DIR", nargs="?", const="itineraries_parquet", help="Also write itineraries as a partitioned Parquet dataset to DIR (default: itineraries_parquet)")
+    args = parser.parse_args()
+
     database = "itineraries.db"
-    df = load_itinerarios_json_to_dataframe()
-    load_itinerarios_dataframe_to_db(df, database="itineraries.db")
-    itinerarios = get_itinerarios(database=database)
-    logging.info(f"Loaded {(len(itinerarios))} itineraries to {database}")
+    result = ingest_itinerarios(database=database, full=args.full, engine=args.engine, parquet_dir=args.parquet or ITINERARIES_PARQUET)
+    con = duckdb.connect(database)
+    n = con.execute("SELECT count(*) FROM itineraries").fetchone()[0]
+    con.close()
+    logging.info(f"Loaded {n} itineraries to {database}")
+    # The dataset is kept up to date by the ingest once it exists; --parquet writes it the first time
+    if args.parquet and result["parquet"] is None:
+        export_itinerarios_parquet(database=database, output_dir=args.parquet, rewrite_past=args.full)
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
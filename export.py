@@ -0,0 +1,179 @@
+import io
+import os
+import gzip
+import math
+import tempfile
+from datetime import datetime
+import pandas as pd
+import streamlit as st
+
+# Rows rendered at a time. Exports hold one chunk in memory besides the dataframe and the output file
+EXPORT_CHUNK_ROWS = 50000
+
+# Formats offered by ui_download_button: label -> (file extension, mime type)
+EXPORT_FORMATS = {
+    "CSV": ("csv", "text/csv"),
+    "CSV comprimido (gzip)": ("csv.gz", "application/gzip"),
+    "Parquet": ("parquet", "application/vnd.apache.parquet"),
+    "Excel": ("xlsx", "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"),
+}
+
+# Rows of an Excel sheet, including the header
+XLSX_MAX_ROWS = 1048576
+
+# Largest file offered by ui_download_button. Streamlit keeps the bytes of a download in memory until it's served, so
+# bigger files are refused and a smaller format is suggested instead
+DOWNLOAD_MAX_BYTES = 200 * 1024 * 1024
+
+def _chunks(df: pd.DataFrame, columns: list = None, chunk_rows: int = EXPORT_CHUNK_ROWS):
+    """Slices of chunk_rows rows of df, with only columns. Empty dataframes give one empty slice, for the header
+
+    Args:
+        df (pandas.DataFrame): Dataframe to slice
+        columns (list): Columns to keep. All if None
+        chunk_rows (int): Rows by slice
+    """
+    for i in range(0, max(len(df), 1), chunk_rows):
+        chunk = df.iloc[i:i + chunk_rows]
+        yield chunk if columns is None else chunk[list(columns)]
+
+def write_csv(df: pd.DataFrame, sink, columns: list = None, compress: bool = False, chunk_rows: int = EXPORT_CHUNK_ROWS):
+    """Write df as CSV (";" separated, UTF-8) to a binary file, chunk by chunk
+
+    Args:
+        df (pandas.DataFrame): Dataframe to write
+        sink (file): Binary file to write to
+        columns (list): Columns to write. All if None
+        compress (bool): Compress with gzip
+        chunk_rows (int): Rows rendered at a time
+    """
+    raw = gzip.GzipFile(fileobj=sink, mode="wb", mtime=0) if compress else sink
+    text = io.TextIOWrapper(raw, encoding="utf-8", newline="", write_through=True)
+    for i, chunk in enumerate(_chunks(df, columns, chunk_rows)):
+        chunk.to_csv(text, index=False, sep=";", quotechar='"', header=i == 0)
+    text.flush()
+    # Release sink without closing it
+    text.detach()
+    if compress:
+        raw.close()
+
+def write_parquet(df: pd.DataFrame, sink, columns: list = None, chunk_rows: int = EXPORT_CHUNK_ROWS):
+    """Write df as Parquet to a binary file, one row group by chunk
+
+    Args:
+        df (pandas.DataFrame): Dataframe to write
+        sink (file): Binary file to write to
+        columns (list): Columns to write. All if None
+        chunk_rows (int): Rows by row group
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    # Schema is inferred from the first chunk. Columns with only nulls there take the type of their first value, so
+    # every row group has the same types
+    schema = None
+    for chunk in _chunks(df, columns, chunk_rows):
+        table = pa.Table.from_pandas(chunk, schema=schema, preserve_index=False)
+        if schema is None:
+            schema = table.schema
+            for i, field in enumerate(schema):
+                if pa.types.is_null(field.type) and df[field.name].first_valid_index() is not None:
+                    value = df[field.name].loc[df[field.name].first_valid_index()]
+                    schema = schema.set(i, field.with_type(pa.array([value]).type))
+            table = table.cast(schema)
+            writer = pq.ParquetWriter(sink, schema)
+        writer.write_table(table)
+    writer.close()
+
+def _xlsx_value(value):
+    """Value of a cell: Excel has no NaN nor time zones, and lists are written as text"""
+    if value is None or value is pd.NaT or isinstance(value, float) and math.isnan(value):
+        return None
+    if isinstance(value, datetime) and value.tzinfo is not None:
+        return value.replace(tzinfo=None)
+    if isinstance(value, (list, tuple, dict)):
+        return str(value)
+    return value
+
+def write_xlsx(df: pd.DataFrame, sink, columns: list = None, chunk_rows: int = EXPORT_CHUNK_ROWS):
+    """Write df as an Excel sheet to a binary file, chunk by chunk
+
+    The workbook is written in openpyxl's write-only mode, which streams rows to a temporary file instead of keeping
+    cells in memory.
+
+    Args:
+        df (pandas.DataFrame): Dataframe to write
+        sink (file): Binary file to write to
+        columns (list): Columns to write. All if None
+        chunk_rows (int): Rows converted at a time
+    """
+    from openpyxl import Workbook
+
+    if len(df) + 1 > XLSX_MAX_ROWS:
+        raise ValueError(f"Excel sheets have at most {XLSX_MAX_ROWS - 1} rows, dataframe has {len(df)}")
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet()
+    sheet.append([str(c) for c in (df.columns if columns is None else columns)])
+    for chunk in _chunks(df, columns, chunk_rows):
+        for row in chunk.itertuples(index=False, name=None):
+            sheet.append([_xlsx_value(v) for v in row])
+    workbook.save(sink)
+
+def export_dataframe(df: pd.DataFrame, extension: str = "csv", columns: list = None, chunk_rows: int = EXPORT_CHUNK_ROWS):
+    """Export df to a temporary file, rewound to the start
+
+    Rows are rendered chunk_rows at a time straight to disk, so memory use is a few chunks, not copies of the whole
+    dataframe and of its text.
+
+    Args:
+        df (pandas.DataFrame): Dataframe to export
+        extension (str): Format, one of the extensions in EXPORT_FORMATS
+        columns (list): Columns to export. All if None
+        chunk_rows (int): Rows rendered at a time
+    """
+    sink = tempfile.TemporaryFile()
+    if extension == "csv":
+        write_csv(df, sink, columns=columns, chunk_rows=chunk_rows)
+    elif extension == "csv.gz":
+        write_csv(df, sink, columns=columns, compress=True, chunk_rows=chunk_rows)
+    elif extension == "parquet":
+        write_parquet(df, sink, columns=columns, chunk_rows=chunk_rows)
+    elif extension == "xlsx":
+        write_xlsx(df, sink, columns=columns, chunk_rows=chunk_rows)
+    else:
+        sink.close()
+        raise ValueError(f"Unknown export format: {extension}")
+    sink.seek(0)
+    return sink
+
+def ui_download_button(df: pd.DataFrame, filename: str = "tmp", columns: list = None, formats: list = list(EXPORT_FORMATS)):
+    """Format selector and download button for df
+
+    The file is only written when "Preparar descarga" is pressed, not on every rerun of the page, and the download
+    button is shown on that run. Streamlit reads the finished file into memory to serve it, whatever is passed to
+    st.download_button, so files over DOWNLOAD_MAX_BYTES are not offered: a warning suggests a compressed format.
+
+    Args:
+        df (pandas.DataFrame): Dataframe to download
+        filename (str, optional): Filename to download, without extension. Defaults to "tmp".
+        columns (list, optional): Columns to download. All if None
+        formats (list, optional): Labels of EXPORT_FORMATS to offer. The first one is the default. Excel is left out
+            when df doesn't fit in a sheet
+    """
+    if len(df) + 1 > XLSX_MAX_ROWS:
+        formats = [f for f in formats if EXPORT_FORMATS[f][0] != "xlsx"]
+    col1, col2, _ = st.columns([2,2,6])
+    with col1:
+        label = st.selectbox("Formato", formats, key=f"export_format_{filename}", label_visibility="collapsed")
+    extension, mime = EXPORT_FORMATS[label]
+    with col2:
+        if not st.button("Preparar descarga", key=f"export_prepare_{filename}"):
+            return False
+        with st.spinner("Preparando archivo..."):
+            with export_dataframe(df, extension, columns=columns) as f:
+                size = os.fstat(f.fileno()).st_size
+                data = f.read() if size <= DOWNLOAD_MAX_BYTES else None
+        if data is None:
+            st.warning(f"El archivo pesa {size / 2**20:.0f} MB y el máximo para descargar es {DOWNLOAD_MAX_BYTES / 2**20:.0f} MB. Prueba con CSV comprimido o Parquet.")
+            return False
+        return st.download_button(label="Descargar", data=data, file_name=f"{filename}.{extension}", mime=mime, key=f"export_download_{filename}")
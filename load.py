@@ -1,40 +1,120 @@
 import os
+import time
+import threading
 import streamlit as st
-import json
 import pandas as pd
+from contextlib import contextmanager
 from tools.tools import load_csv_s3
+# Pages and components load raw events as load.load_event_raw
+from tools.tools import load_event_raw  # noqa: F401
 from datetime import datetime
 
-def create_warehouse_engine(env):
+# Connection pools of the database engines, shared by every session of the app. Connections are checked with a ping
+# before being used, and replaced after pool_recycle seconds, before the server or a load balancer drops them.
+ENGINE_POOL = {
+    "pool_size": 5,
+    "max_overflow": 5,
+    "pool_timeout": 30,
+    "pool_recycle": 1800,
+    "pool_pre_ping": True,
+}
+
+# Engines and their checkout statistics by (database, env), created once per process by get_engine
+_engines = {}
+_engines_stats = {}
+_engines_lock = threading.Lock()
+
+def _engine_url(database, env):
+    """URL of database ("warehouse", "warehouse_vecna" or "prisma") in env"""
+    if database == "warehouse":
+        return f"postgresql+psycopg2://{st.secrets['wh_username']}:{st.secrets['wh_password']}@{st.secrets['wh_host']}:{st.secrets['wh_port']}/{st.secrets['wh_db']}"
+    elif database == "warehouse_vecna":
+        return f"postgresql+psycopg2://{st.secrets['wh_vecna_username']}:{st.secrets['wh_vecna_password']}@{st.secrets['wh_vecna_host']}:{st.secrets['wh_vecna_port']}/{st.secrets['wh_vecna_db']}"
+    elif database == "prisma":
+        return f"postgresql+psycopg2://{st.secrets['prisma_username']}:{st.secrets['prisma_password']}@{st.secrets['prisma_host']}:{st.secrets['prisma_port']}/{st.secrets['prisma_database']}"
+    raise ValueError(f"Unknown database: {database}")
+
+def get_engine(database, env="prod"):
+    """Pooled engine of database in env, created on first use and shared by the whole process
+
+    Args:
+        database (str): "warehouse", "warehouse_vecna" or "prisma"
+        env (str): "prod" or "staging"
+    """
     from sqlalchemy import create_engine
-    if env == "prod":
-        conn_bd = f"postgresql://{st.secrets['wh_username']}:{st.secrets['wh_password']}@{st.secrets['wh_host']}:{st.secrets['wh_port']}/{st.secrets['wh_db']}"
-    elif env == "staging":
-        conn_bd = f"postgresql://{st.secrets['wh_username']}:{st.secrets['wh_password']}@{st.secrets['wh_host']}:{st.secrets['wh_port']}/{st.secrets['wh_db']}"
-    return create_engine(conn_bd).raw_connection()
+
+    key = (database, env)
+    with _engines_lock:
+        if key not in _engines:
+            _engines[key] = create_engine(_engine_url(database, env), **ENGINE_POOL)
+            _engines_stats[key] = {"checkouts": 0, "timeouts": 0, "wait_seconds": 0.0, "max_wait_seconds": 0.0}
+        return _engines[key]
+
+@contextmanager
+def connection(database, env="prod"):
+    """Connection from the pool of database in env, returned to the pool on exit
+
+    Time waited for the connection is recorded for engine_pool_stats.
+
+    Args:
+        database (str): "warehouse", "warehouse_vecna" or "prisma"
+        env (str): "prod" or "staging"
+    """
+    from sqlalchemy.exc import TimeoutError
+
+    engine = get_engine(database, env)
+    stats = _engines_stats[(database, env)]
+    t = time.perf_counter()
+    try:
+        con = engine.connect()
+    except TimeoutError:
+        with _engines_lock:
+            stats["timeouts"] += 1
+        raise
+    wait = time.perf_counter() - t
+    with _engines_lock:
+        stats["checkouts"] += 1
+        stats["wait_seconds"] += wait
+        stats["max_wait_seconds"] = max(stats["max_wait_seconds"], wait)
+    try:
+        yield con
+    finally:
+        con.close()
+
+def engine_pool_stats() -> pd.DataFrame:
+    """Connections in use and idle, and checkouts and time waited for them, by engine created in this process"""
+    with _engines_lock:
+        rows = [{
+            "database": database,
+            "env": env,
+            "size": engine.pool.size(),
+            "in_use": engine.pool.checkedout(),
+            "idle": engine.pool.checkedin(),
+            "overflow": max(engine.pool.overflow(), 0),
+            **_engines_stats[(database, env)],
+        } for (database, env), engine in _engines.items()]
+    stats = pd.DataFrame(rows, columns=["database", "env", "size", "in_use", "idle", "overflow", "checkouts", "timeouts", "wait_seconds", "max_wait_seconds"])
+    stats["mean_wait_seconds"] = stats["wait_seconds"] / stats["checkouts"].where(stats["checkouts"] > 0)
+    return stats
+
+def create_warehouse_engine(env):
+    """Pooled engine of Warehouse (see get_engine)"""
+    return get_engine("warehouse", env)
 
 def create_warehouse_vecna_engine(env):
-    from sqlalchemy import create_engine
-    conn_bd = f"postgresql://{st.secrets['wh_vecna_username']}:{st.secrets['wh_vecna_password']}@{st.secrets['wh_vecna_host']}:{st.secrets['wh_vecna_port']}/{st.secrets['wh_vecna_db']}"
-    return create_engine(conn_bd).raw_connection()
+    """Pooled engine of Warehouse Vecna (see get_engine)"""
+    return get_engine("warehouse_vecna", env)
 
 def create_prisma_engine():
-    from sqlalchemy import create_engine
-    conn_bd = f"postgresql://{st.secrets['prisma_username']}:{st.secrets['prisma_password']}@{st.secrets['prisma_host']}:{st.secrets['prisma_port']}/{st.secrets['prisma_database']}"
-    return create_engine(conn_bd).raw_connection()
+    """Pooled engine of Prisma (see get_engine)"""
+    return get_engine("prisma")
 
-@st.cache_data(ttl=3600)
+@st.cache_data(ttl=600)
 def load_subscriptions(env) -> pd.DataFrame:
-    """Load subscriptions from Warehouse Vecna"""
-    
-    warehouse_engine = create_warehouse_vecna_engine(env)
-    
-    if env == "prod":
-        schema = "public"
-        subscriptions_table = "prod_vecna_subscription"
-    elif env == "staging":
-        schema = "staging"
-        subscriptions_table = "dev_vecna_subscription"
+    """Load subscriptions from the local mirror of Warehouse Vecna, after fetching the new ones (see mirror.py)"""
+    from mirror import sync_table, read_mirror
+
+    sync_table("subscriptions", env)
 
     # All Vecna subscriptions
     query = f'''
@@ -52,7 +132,7 @@ with subs as (
                 when "subscription_booking" != 'NOT AVAILABLE' then "subscription_booking"
             end as "subscription_doc"
         from
-            {schema}.{subscriptions_table}
+            "{env}_subscriptions"
     )
 )
 select
@@ -63,24 +143,11 @@ where
     --row_number = 1 and
     subscription_created_at >= '2023-01-14';
     '''
-    subscriptions = pd.read_sql_query(query, warehouse_engine)
+    subscriptions = read_mirror(query, arrow=True)
     return subscriptions
 
-@st.cache_data(ttl=3600)
-def load_events(env) -> pd.DataFrame:
-    """Load events from Warehouse Vecna"""
-    
-    warehouse_engine = create_warehouse_vecna_engine(env)
-    
-    if env == "prod":
-        schema = "public"
-        events_table = "prod_vecna_event_consolidated"
-    elif env == "staging":
-        schema = "staging"
-        events_table = "dev_vecna_event_consolidated"
-
-    # All Vecna events
-    query = f'''
+# Vecna events as read from the mirror by the pages, with the document of their subscription
+_EVENTS_MIRROR_QUERY = '''
 select
     "vecna_event_id"
     ,"vecna_event_container"
@@ -99,24 +166,78 @@ select
     ,"raw_event_gh"
     ,"raw_event_oi"
 from
-    {schema}.{events_table}
+    "{env}_events"
 where "vecna_event_created_at" >= '2023-03-14'
-    '''
-    events = pd.read_sql_query(query, warehouse_engine)
+'''
+
+@st.cache_data(ttl=600)
+def load_events(env) -> pd.DataFrame:
+    """Load events from the local mirror of Warehouse Vecna, after fetching the new ones (see mirror.py)"""
+    from mirror import sync_table, read_mirror
+
+    sync_table("events", env)
+
+    # All Vecna events
+    query = _EVENTS_MIRROR_QUERY.format(env=env)
+    events = read_mirror(query, arrow=True)
     return events
 
-@st.cache_data(ttl=3600)
+# Columns of the events looked up through load_events_index
+EVENTS_INDEX_COLUMNS = ["subscription_id", "subscription_bl", "subscription_container", "subscription_booking"]
+
+@st.cache_resource(ttl=600)
+def load_events_index(env):
+    """Index of the events of the local mirror by subscription id, BL, container and booking (see tools.FrameIndex)
+
+    The index and its events are shared by every session, without copying them, and built again when the events are
+    refreshed, every 10 minutes like load_events. Lookups return copies of the rows, so they can be modified.
+
+    Args:
+        env (str): "prod" or "staging"
+    """
+    from tools.tools import FrameIndex
+
+    return FrameIndex(load_events(env), EVENTS_INDEX_COLUMNS)
+
+@st.cache_data(ttl=600)
+def load_subscription_stats(env) -> pd.DataFrame:
+    """Load statistics of the events of each subscription document, aggregated in the local mirror (see load_events)
+
+    They are computed once per refresh of the mirror, instead of grouping every event on each rerun of a page.
+    Columns are the document, its number of events, first and last event creation times, distinct containers, and
+    events with a raw Gatehouse and a raw Ocean Insights event.
+
+    Args:
+        env (str): "prod" or "staging"
+    """
+    from mirror import sync_table, read_mirror
+
+    sync_table("events", env)
+
+    query = f'''
+select
+    "subscription_doc"
+    ,count("subscription_id") as "events"
+    ,min("vecna_event_created_at") as "first"
+    ,max("vecna_event_created_at") as "last"
+    ,count(distinct "vecna_event_container") as "containers"
+    ,count(*) filter (where coalesce("raw_event_gh", '') not in ('', 'subscription')) as "events_gh"
+    ,count(*) filter (where coalesce("raw_event_oi", '') not in ('', 'subscription')) as "events_oi"
+from
+({_EVENTS_MIRROR_QUERY.format(env=env)})
+where "subscription_doc" is not null
+group by
+    "subscription_doc"
+    '''
+    stats = read_mirror(query)
+    return stats
+
+@st.cache_data(ttl=600)
 def load_containers_by_subscription(env) -> pd.DataFrame:
-    """Load events from Warehouse Vecna"""
-    
-    warehouse_engine = create_warehouse_vecna_engine(env)
-    
-    if env == "prod":
-        schema = "public"
-        events_table = "prod_vecna_event_consolidated"
-    elif env == "staging":
-        schema = "staging"
-        events_table = "dev_vecna_event_consolidated"
+    """Load containers of each subscription from the local mirror of Warehouse Vecna events (see mirror.py)"""
+    from mirror import sync_table, read_mirror
+
+    sync_table("events", env)
 
     # All Vecna events
     query = f'''
@@ -124,51 +245,230 @@ select distinct
     "subscription_id"
     ,"vecna_event_container"
 from
-    {schema}.{events_table}
+    "{env}_events"
 where "vecna_event_created_at" >= '2023-01-01'
     '''
-    containers_by_subscription = pd.read_sql_query(query, warehouse_engine)
+    containers_by_subscription = read_mirror(query)
     return containers_by_subscription
 
 
+# Tables of Vecna events by environment, as schema and table
+VECNA_EVENTS_TABLE = {"prod": "public.prod_vecna_event_consolidated", "staging": "staging.dev_vecna_event_consolidated"}
+# Columns of Vecna events by type of document
+VECNA_DOCUMENT_COLUMNS = {"mbl": "subscription_bl", "container": "subscription_container", "booking": "subscription_booking"}
+
+# Executions of prepared statements by (database, env, statement name), see prepared_statement_stats
+_prepared_stats = {}
+
+def query_prepared(database, env, query, parameters=()) -> pd.DataFrame:
+    """Run query with bound parameters as a server-side prepared statement, and return the result as a dataframe
+
+    query uses Postgres placeholders ($1, $2...). It is prepared once on each pooled connection, which remembers the
+    statements prepared on it, and later calls only execute it with the new parameters, so the server doesn't parse
+    and plan it again. Parameters are never formatted into the query text.
+
+    Args:
+        database (str): "warehouse", "warehouse_vecna" or "prisma"
+        env (str): "prod" or "staging"
+        query (str): Query with $1, $2... placeholders
+        parameters (tuple): Parameters, lists for array placeholders
+    """
+    import hashlib
+    from sqlalchemy.exc import DBAPIError
+
+    name = "q_" + hashlib.sha1(query.encode()).hexdigest()[:16]
+    key = (database, env, name)
+    with _engines_lock:
+        stats = _prepared_stats.setdefault(key, {"query": " ".join(query.split()), "prepares": 0, "executions": 0, "seconds": 0.0})
+    placeholders = ", ".join(["%s"] * len(parameters))
+    execute = f"EXECUTE {name} ({placeholders})" if parameters else f"EXECUTE {name}"
+
+    with connection(database, env) as con:
+        # Statements prepared on this DBAPI connection. The info dictionary lives as long as the connection, so it's
+        # emptied when the pool recycles or replaces it
+        prepared = con.info.setdefault("prepared_statements", set())
+        for attempt in range(2):
+            t = time.perf_counter()
+            try:
+                if name not in prepared:
+                    con.exec_driver_sql(f"PREPARE {name} AS {query}")
+                    prepared.add(name)
+                    with _engines_lock:
+                        stats["prepares"] += 1
+                result = con.exec_driver_sql(execute, tuple(parameters)) if parameters else con.exec_driver_sql(execute)
+                df = pd.DataFrame.from_records(result.fetchall(), columns=list(result.keys()), coerce_float=True)
+                break
+            except DBAPIError as e:
+                con.rollback()
+                # The statement was deallocated in the server (e.g. by DISCARD ALL): prepare it again, once
+                if attempt or getattr(e.orig, "pgcode", None) != "26000":
+                    raise
+                prepared.discard(name)
+        with _engines_lock:
+            stats["executions"] += 1
+            stats["seconds"] += time.perf_counter() - t
+    return df
+
+def prepared_statement_stats() -> pd.DataFrame:
+    """Prepares (cache misses, one per connection) and executions of each prepared statement in this process"""
+    with _engines_lock:
+        rows = [{"database": database, "env": env, "name": name, **stats} for (database, env, name), stats in _prepared_stats.items()]
+    stats = pd.DataFrame(rows, columns=["database", "env", "name", "query", "prepares", "executions", "seconds"])
+    stats["hit_rate"] = 1 - stats["prepares"] / stats["executions"].where(stats["executions"] > 0)
+    stats["mean_seconds"] = stats["seconds"] / stats["executions"].where(stats["executions"] > 0)
+    return stats
+
+# Rows fetched at a time by read_sql_arrow, and size of the Arrow result above which it stops fetching
+FETCH_CHUNK_ROWS = 50000
+FETCH_MAX_BYTES = 2 * 1024 ** 3
+
+def _arrow_column(type_code):
+    """Arrow type of a Postgres column by type OID, and the conversion of its values (None to keep them)"""
+    import pyarrow as pa
+
+    if type_code == 16:
+        return pa.bool_(), None
+    if type_code in (20, 21, 23):
+        return pa.int64(), None
+    if type_code in (700, 701):
+        return pa.float64(), None
+    if type_code == 1700:
+        # Numerics arrive as Decimal; as pandas.read_sql_query(coerce_float=True), they become floats
+        return pa.float64(), lambda v: None if v is None else float(v)
+    if type_code == 1082:
+        return pa.date32(), None
+    if type_code == 1114:
+        return pa.timestamp("us"), None
+    if type_code == 1184:
+        return pa.timestamp("us", tz="UTC"), None
+    if type_code in (25, 1042, 1043, 2950, 114, 3802):
+        # JSON is kept as text (read_sql_arrow doesn't parse it), to have the same type in every chunk
+        return pa.string(), None
+    return None, None
+
+def read_sql_arrow(database, env, query, parameters=None, chunk_rows=FETCH_CHUNK_ROWS, max_bytes=FETCH_MAX_BYTES):
+    """Run query with a server-side cursor and return the result as an Arrow table, fetching chunk_rows at a time
+
+    Each chunk of rows is converted to an Arrow record batch as it arrives, so Python objects only exist for one
+    chunk at a time, instead of for the whole result as with pandas.read_sql_query. Arrow types come from the types
+    of the result columns, so every chunk has the same schema.
+
+    Args:
+        database (str): "warehouse", "warehouse_vecna" or "prisma"
+        env (str): "prod" or "staging"
+        query (str): Query, with psycopg2 placeholders (%(name)s)
+        parameters (dict): Parameters of the query
+        chunk_rows (int): Rows fetched from the server at a time
+        max_bytes (int): Size of the result at which fetching stops with a MemoryError, before the process runs out
+            of memory
+
+    Returns:
+        pyarrow.Table: Result
+    """
+    import uuid
+    import pyarrow as pa
+    from psycopg2.extras import register_default_json, register_default_jsonb
+
+    batches, size, schema, converters = [], 0, None, None
+    with connection(database, env) as con:
+        cursor = con.connection.dbapi_connection.cursor(name=f"arrow_{uuid.uuid4().hex}")
+        cursor.itersize = chunk_rows
+        register_default_json(cursor, loads=lambda s: s)
+        register_default_jsonb(cursor, loads=lambda s: s)
+        try:
+            cursor.execute(query, parameters)
+            while True:
+                rows = cursor.fetchmany(chunk_rows)
+                if schema is None:
+                    # Named cursors describe the result after the first fetch
+                    columns = [_arrow_column(d.type_code) for d in cursor.description]
+                    converters = [c for _, c in columns]
+                    schema = pa.schema([(d.name, t) for d, (t, _) in zip(cursor.description, columns)]) if all(t for t, _ in columns) else None
+                if not rows:
+                    break
+                values = [v if c is None else [c(x) for x in v] for v, c in zip(zip(*rows), converters)]
+                del rows
+                if schema is not None:
+                    batch = pa.RecordBatch.from_arrays([pa.array(v, type=f.type) for v, f in zip(values, schema)], schema=schema)
+                else:
+                    # Some types have no fixed Arrow type: they are inferred from the first chunk
+                    batch = pa.RecordBatch.from_arrays([pa.array(v, type=t) for v, (t, _) in zip(values, columns)], names=[d.name for d in cursor.description])
+                    schema = batch.schema
+                size += batch.nbytes
+                if size > max_bytes:
+                    raise MemoryError(f"Result of query exceeds {max_bytes} bytes after {sum(b.num_rows for b in batches) + batch.num_rows} rows")
+                batches.append(batch)
+        finally:
+            cursor.close()
+    if not batches:
+        return pa.Table.from_batches([], schema=schema or pa.schema([(d.name, pa.null()) for d in cursor.description]))
+    return pa.Table.from_batches(batches)
+
 @st.cache_data(ttl=3600)
 def load_shipments_prisma(subscriptionId) -> pd.DataFrame:
-    prisma_engine = create_prisma_engine()
 
-    query = f'''
+    query = '''
 select
     *
 from
     "public"."vw_arauco_wide"
 where
-    "subscriptionId" = '{subscriptionId}'
+    "subscriptionId" = $1
     '''
-    return pd.read_sql_query(query, prisma_engine)
+    return query_prepared("prisma", "prod", query, (subscriptionId,))
 
-def load_events_vecna(doctype, doc, env):
+@st.cache_data(ttl=3600, show_spinner=False)
+def load_shipments_prisma_batch(subscription_ids: tuple) -> pd.DataFrame:
+    """Load shipments of several subscriptions from Prisma in one query (see load_shipments_prisma)
+
+    Args:
+        subscription_ids (tuple): Subscription ids
+    """
+    query = '''
+select
+    *
+from
+    "public"."vw_arauco_wide"
+where
+    "subscriptionId"::text = any($1::text[])
+    '''
+    return query_prepared("prisma", "prod", query, (list(subscription_ids),))
 
-    if doctype == "mbl":
-        where = f"where \"subscription_bl\" = '{doc}'"
-    elif doctype == "container":
-        where = f"where \"subscription_container\" = '{doc}'"
-    elif doctype == "booking":
-        where = f"where \"subscription_booking\" = '{doc}'"
+def load_events_vecna(doctype, doc, env):
 
-    warehouse_engine = create_warehouse_vecna_engine(env)
     query = f'''
         select
             *
         from
             "public"."prod_vecna_event_consolidated"
-        {where}
+        where
+            "{VECNA_DOCUMENT_COLUMNS[doctype]}" = $1
         '''
-    events = pd.read_sql_query(query, warehouse_engine)
+    events = query_prepared("warehouse_vecna", env, query, (doc,))
     return events
 
-@st.cache_data(ttl=3600)
-def load_events_prisma(container, _date):
-    prisma_engine = create_prisma_engine()
+@st.cache_data(ttl=3600, show_spinner=False)
+def load_events_vecna_batch(doctype, docs: tuple, env) -> pd.DataFrame:
+    """Load events of several documents of a type in one query (see load_events_vecna)
+
+    Args:
+        doctype (str): "mbl", "container" or "booking"
+        docs (tuple): Documents
+        env (str): "prod" or "staging"
+    """
     query = f'''
+        select
+            *
+        from
+            "public"."prod_vecna_event_consolidated"
+        where
+            "{VECNA_DOCUMENT_COLUMNS[doctype]}" = any($1::text[])
+        '''
+    events = query_prepared("warehouse_vecna", env, query, (list(docs),))
+    return events
+
+# Prisma OiEvents of containers created from a date, newest first
+_EVENTS_PRISMA_QUERY = '''
 select
     "a"."body"
     ,"a"."container_number"
@@ -180,76 +480,283 @@ from
         ,"body"::json -> 'shipment' ->> 'container_number' as "container_number"
         ,"createdAt" as "createdAt"
     from "OiEvent"
-    where "createdAt" >= '{_date}'
+    where "createdAt" >= $1
     order by "createdAt" desc
 ) as "a"
 where
-    "a"."container_number" = '{container}'
+    {container_filter}
 order by
     "a"."createdAt" desc
 '''
-    events = pd.read_sql_query(query, prisma_engine)
-    return events
+
+# OiEvents by id, for the ids found in the local container index
+_EVENTS_PRISMA_BY_ID_QUERY = '''
+select
+    "body"::json as "body"
+    ,"body"::json -> 'shipment' ->> 'container_number' as "container_number"
+    ,"createdAt" as "createdAt"
+from "OiEvent"
+where "id" = any($1)
+order by "createdAt" desc
+'''
+
+def _oi_event_ids(containers: list, date) -> list:
+    """Ids of the Prisma OiEvents of containers created at or after date, from the local container index
+
+    The index (table prod_oi_event_containers of the mirror, see mirror.py) is brought up to date first, at most every
+    MIRROR_LOOKUP_SYNC_INTERVAL and only with the OiEvents created since the last sync: OiEvents are never updated, so
+    full reconciles are left to "python mirror.py". Returns None if the index doesn't go back to date, or doesn't
+    exist yet.
+
+    Args:
+        containers (list): Container numbers
+        date (str): First creation date of events
+    """
+    import duckdb
+    from datetime import timedelta
+    from mirror import MIRROR_TABLES, MIRROR_LOOKUP_SYNC_INTERVAL, sync_table, read_mirror
+
+    since = pd.Timestamp(date)
+    if since.tzinfo is not None:
+        since = since.tz_convert(None)
+    if since < pd.Timestamp(MIRROR_TABLES["oi_event_containers"]["since"]):
+        return None
+    sync_table("oi_event_containers", "prod", reconcile=timedelta.max, min_interval=MIRROR_LOOKUP_SYNC_INTERVAL)
+    query = '''
+        select
+            "id"
+        from
+            "prod_oi_event_containers"
+        where
+            "container_number" in (select unnest(?::VARCHAR[]))
+            and "createdAt" >= ?
+        '''
+    try:
+        return read_mirror(query, [list(containers), since.to_pydatetime()])["id"].tolist()
+    except duckdb.CatalogException:
+        # Being built by another request
+        return None
 
 @st.cache_data(ttl=3600)
-def load_event_vecna(env, vecna_event_id, subscription_id=None, event_created_at=None, event_container=None):
+def load_events_prisma(container, date):
+    """Load Prisma OiEvents of a container created at or after date, newest first
+
+    Ids are looked up in the local container index and only those rows are fetched by primary key, instead of
+    extracting the container from the JSON body of every OiEvent since date.
 
-    if env == "prod":
-        schema = "public"
-        event_table = "prod_vecna_event_consolidated"
-    elif env == "staging":
-        schema = "staging"
-        event_table = "dev_vecna_event_consolidated"
+    Args:
+        container (str): Container number
+        date (str): First creation date of events
+    """
+    ids = _oi_event_ids([container], date)
+    if ids is None:
+        query = _EVENTS_PRISMA_QUERY.format(container_filter='"a"."container_number" = $2')
+        return query_prepared("prisma", "prod", query, (date, container))
+    events = query_prepared("prisma", "prod", _EVENTS_PRISMA_BY_ID_QUERY, (ids,))
+    return events
+
+@st.cache_data(ttl=3600, show_spinner=False)
+def load_event_vecna(env, vecna_event_id, subscription_id=None, event_created_at=None, event_container=None):
 
-    warehouse_engine = create_warehouse_vecna_engine(env)
     query = f'''
         select
             *
         from
-            {schema}.{event_table}
+            {VECNA_EVENTS_TABLE[env]}
         where
-            "vecna_event_id" = '{vecna_event_id}'
+            "vecna_event_id" = $1
         '''
-            #("vecna_event_id" = '{vecna_event_id}' or "vecna_event_id" is null)
-            #and "subscription_id" = '{subscription_id}'
-            #and "vecna_event_created_at" = '{event_created_at}'
-            #and "vecna_event_container" = '{event_container}'
+            #("vecna_event_id" = $1 or "vecna_event_id" is null)
+            #and "subscription_id" = $2
+            #and "vecna_event_created_at" = $3
+            #and "vecna_event_container" = $4
         #'''
-    event = pd.read_sql_query(query, warehouse_engine)
+    event = query_prepared("warehouse_vecna", env, query, (vecna_event_id,))
     return event
 
-def load_event_raw(filename, path):
-    import io, boto3
-    bucket = "prod-track-sources-s3stack-dumpbucketbe480749-wch2mlfw0oh0"
-    
-    s3 = boto3.client('s3',
-        aws_access_key_id=st.secrets["aws_access_key_id"],
-        aws_secret_access_key=st.secrets["aws_secret_access_key"],
-        region_name='us-east-1')
+@st.cache_data(ttl=3600, show_spinner=False)
+def load_events_vecna_by_subscription(env, subscription_id) -> pd.DataFrame:
+    """Load every Vecna event of a subscription, with its payloads, in one query
 
-    obj = s3.get_object(Bucket=bucket, Key=path+filename)
+    The event detail of the Vecna Explorer is then a lookup in this dataframe instead of a query by event.
 
-    if len(obj) != 0:
-        j = json.load(io.BytesIO(obj['Body'].read()))
-    else:
-        j = {}
-    return j
+    Args:
+        env (str): "prod" or "staging"
+        subscription_id (str): Vecna subscription id
+    """
+    query = f'''
+        select
+            *
+        from
+            {VECNA_EVENTS_TABLE[env]}
+        where
+            "subscription_id" = $1
+        '''
+    events = query_prepared("warehouse_vecna", env, query, (subscription_id,))
+    return events
+
+# Threads running loaders in the background (prefetch) and concurrently (fetch_sources), shared by every session
+LOADER_WORKERS = 8
+_loader_executor = None
+# Background loads started by prefetch, by loader and arguments, while they run
+_prefetches = {}
+_prefetch_lock = threading.Lock()
+
+def _submit(loader, *args):
+    """Run loader(*args) in the shared loader threads, within the Streamlit context of the calling script"""
+    global _loader_executor
+    from concurrent.futures import ThreadPoolExecutor
+    from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+    from streamlit.runtime.scriptrunner.script_run_context import SCRIPT_RUN_CONTEXT_ATTR_NAME
+
+    ctx = get_script_run_ctx()
+
+    def run():
+        thread = threading.current_thread()
+        if ctx is not None:
+            add_script_run_ctx(thread, ctx)
+        try:
+            return loader(*args)
+        finally:
+            # Threads are reused by other sessions
+            setattr(thread, SCRIPT_RUN_CONTEXT_ATTR_NAME, None)
+
+    with _engines_lock:
+        if _loader_executor is None:
+            _loader_executor = ThreadPoolExecutor(max_workers=LOADER_WORKERS, thread_name_prefix="loader")
+    return _loader_executor.submit(run)
+
+def prefetch(loader, *args):
+    """Run a cached loader in a background thread, so its result is already cached when the page asks for it
+
+    Calls of the loader with the same arguments while it runs wait for it instead of querying again (st.cache_data
+    computes each value once), and a prefetch of arguments already being loaded is not started twice. Errors are
+    ignored here: the page gets them when it calls the loader.
+
+    The loader runs within the script context of the page, which st.cache_data needs to store its result, so it must
+    not show anything: it has to be decorated with show_spinner=False, or its spinner would be drawn on the page from
+    the background thread.
+
+    Args:
+        loader (function): Function decorated with st.cache_data
+        args: Arguments of the loader
+
+    Returns:
+        concurrent.futures.Future: Result of the loader
+    """
+    key = (loader.__qualname__, args)
+    with _prefetch_lock:
+        if key in _prefetches:
+            return _prefetches[key]
+        future = _submit(loader, *args)
+        _prefetches[key] = future
+
+    def done(_):
+        with _prefetch_lock:
+            _prefetches.pop(key, None)
+    future.add_done_callback(done)
+    return future
+
+# Seconds a data source is waited for by fetch_sources, by default and by source name
+SOURCE_TIMEOUT = 15
+SOURCE_TIMEOUTS = {"Vecna (API)": 10, "Vecna (Dynamo)": 5}
+
+# Calls of a data source that may still be running, from earlier reruns that timed out, before fetch_sources stops
+# calling it, so a source that hangs can't take every loader thread
+SOURCE_MAX_RUNNING = 2
+
+# Calls, errors, timeouts and seconds of each data source fetched by fetch_sources, see data_source_stats
+_source_stats = {}
+# Calls of each data source running or waiting for a loader thread
+_source_running = {}
+
+def fetch_sources(sources: dict, timeouts: dict = SOURCE_TIMEOUTS):
+    """Run the loaders of several data sources concurrently and yield their results as they arrive
+
+    Each source is given its own timeout: a source that fails or doesn't answer in time yields its exception (a
+    TimeoutError if it timed out) instead of a result, without holding up the others. A source that timed out is
+    cancelled if it's still waiting for a thread, and otherwise keeps running in the background, so a cached loader is
+    still cached for the next rerun. A source with SOURCE_MAX_RUNNING calls still running isn't called again until they
+    finish, and times out right away. Seconds taken by each source are recorded for data_source_stats.
+
+    Loaders run within the script context of the page (see prefetch), so cached loaders must not show a spinner.
+
+    Args:
+        sources (dict): Name of the source -> (loader, *args)
+        timeouts (dict): Seconds to wait for each source by name, SOURCE_TIMEOUT for the others
+
+    Yields:
+        tuple: Name of the source and its result, or the exception it raised
+    """
+    from concurrent.futures import wait, FIRST_COMPLETED
+
+    start = time.perf_counter()
+    futures, deadlines, busy = {}, {}, []
+    for name, (loader, *args) in sources.items():
+        with _engines_lock:
+            _source_stats.setdefault(name, {"calls": 0, "errors": 0, "timeouts": 0, "seconds": 0.0, "max_seconds": 0.0})
+            if _source_running.get(name, 0) >= SOURCE_MAX_RUNNING:
+                _source_stats[name]["timeouts"] += 1
+                busy.append(name)
+                continue
+            _source_running[name] = _source_running.get(name, 0) + 1
+
+        def record(future, name=name):
+            seconds = time.perf_counter() - start
+            with _engines_lock:
+                _source_running[name] -= 1
+                if future.cancelled():
+                    return
+                stats = _source_stats[name]
+                stats["calls"] += 1
+                stats["errors"] += future.exception() is not None
+                stats["seconds"] += seconds
+                stats["max_seconds"] = max(stats["max_seconds"], seconds)
+        future = _submit(loader, *args)
+        future.add_done_callback(record)
+        futures[future] = name
+        deadlines[future] = start + timeouts.get(name, SOURCE_TIMEOUT)
+
+    for name in busy:
+        yield name, TimeoutError(f"{name} still has {SOURCE_MAX_RUNNING} calls running")
+
+    pending = set(futures)
+    while pending:
+        done, pending = wait(pending, timeout=max(0, min(deadlines[f] for f in pending) - time.perf_counter()), return_when=FIRST_COMPLETED)
+        for future in done:
+            yield futures[future], future.exception() or future.result()
+        for future in [f for f in pending if deadlines[f] <= time.perf_counter()]:
+            pending.discard(future)
+            future.cancel()
+            name = futures[future]
+            with _engines_lock:
+                _source_stats[name]["timeouts"] += 1
+            yield name, TimeoutError(f"{name} didn't answer in {timeouts.get(name, SOURCE_TIMEOUT)} s")
+
+def data_source_stats() -> pd.DataFrame:
+    """Calls, errors, timeouts and seconds of each data source fetched by fetch_sources in this process"""
+    with _engines_lock:
+        rows = [{"source": name, **stats} for name, stats in _source_stats.items()]
+    stats = pd.DataFrame(rows, columns=["source", "calls", "errors", "timeouts", "seconds", "max_seconds"])
+    stats["mean_seconds"] = stats["seconds"] / stats["calls"].where(stats["calls"] > 0)
+    return stats
 
 def load_event_vecna_back(subscription_id, env):
-    import requests
-
-    if env == "prod":
-        endpoint = f"https://vecna.klog.co/subscriptions/{subscription_id}"
-        token = "Y2xkYWl4a3R0MDAwZDM3NnF0YW1qd2U5bjp4ZGM3ZDN0aDNnWWV0ZUMwVXViM29m="
-    elif env == "staging":
-        endpoint = f"https://staging.vecna.klog.co/subscriptions/{subscription_id}"
-        token = "Y2w4NHVhNzU5MDAwMTA5bDNnYTVjOXl1dDpETVNLQURLTUxTUUE="
-
-    response = requests.get(
-        endpoint,
-        headers={'Authorization': f'Token {token}'}
-    )
-    return response.text
+    """Subscription from the Vecna back API, through the pooled and cached client (see vecna_api.get_subscription)"""
+    import vecna_api
+
+    return vecna_api.get_subscription(subscription_id, env)
+
+def load_events_vecna_back(subscription_ids: tuple, env) -> dict:
+    """Subscriptions from the Vecna back API, fetched concurrently (see vecna_api.get_subscriptions)
+
+    Args:
+        subscription_ids (tuple): Vecna subscription ids
+        env (str): "prod" or "staging"
+    """
+    import vecna_api
+
+    return vecna_api.get_subscriptions(subscription_ids, env)
 
 def load_event_dynamo(subscription_id, env):
     return {}
@@ -429,24 +936,271 @@ def load_data_quality(client="Arauco") -> pd.DataFrame:
 
     return data
 
+# Snapshots of the Arauco data quality report in S3. Their listing is refreshed with the new keys at most every
+# SNAPSHOT_CATALOG_TTL seconds, and read again in full every SNAPSHOT_CATALOG_RECONCILE seconds
+SNAPSHOT_BUCKET = "klog-lake"
+SNAPSHOT_PREFIX = "raw/arauco_snapshots/"
+SNAPSHOT_CATALOG_TTL = 600
+SNAPSHOT_CATALOG_RECONCILE = 24 * 3600
+
+# Catalogs by (bucket, prefix): objects, their snapshots, and time of the last refresh and of the last full listing
+_snapshot_catalogs = {}
+_snapshot_catalogs_lock = threading.Lock()
+
+def load_snapshot_catalog(bucket=SNAPSHOT_BUCKET, prefix=SNAPSHOT_PREFIX, ttl=SNAPSHOT_CATALOG_TTL, reconcile=SNAPSHOT_CATALOG_RECONCILE) -> pd.DataFrame:
+    """Load the catalog of daily snapshots (files YYYYMMDD-*.csv) in bucket under prefix, oldest first
+
+    The listing is kept in memory and shared by every session. After ttl seconds only the keys after the newest known
+    one are listed (snapshots are named by date, so new ones come last in key order), and every reconcile seconds the
+    whole prefix is listed again, to catch rewritten or deleted files. Reruns in between don't call S3.
+
+    Args:
+        bucket (str): Bucket
+        prefix (str): Prefix of the snapshots
+        ttl (float): Seconds between refreshes of the listing
+        reconcile (float): Seconds between full listings
+
+    Returns:
+        pandas.DataFrame: Date, key, size, ETag and last modification of each snapshot
+    """
+    import s3
+
+    with _snapshot_catalogs_lock:
+        now = time.monotonic()
+        catalog = _snapshot_catalogs.get((bucket, prefix))
+        if catalog is None or now - catalog["full"] >= reconcile:
+            catalog = {"objects": s3.list_objects(bucket, prefix), "snapshots": None, "refreshed": now, "full": now}
+            _snapshot_catalogs[(bucket, prefix)] = catalog
+        elif now - catalog["refreshed"] >= ttl:
+            last = catalog["objects"][-1]["key"] if catalog["objects"] else None
+            new = s3.list_objects(bucket, prefix, start_after=last)
+            if new:
+                catalog["objects"] = catalog["objects"] + new
+                catalog["snapshots"] = None
+            catalog["refreshed"] = now
+
+        # Parsed only when the listing changed
+        if catalog["snapshots"] is None:
+            snapshots = pd.DataFrame(catalog["objects"], columns=["key", "size", "etag", "last_modified"])
+            snapshots.insert(0, "date", pd.to_datetime(snapshots["key"].str.rsplit("/", n=1).str[-1].str.split("-").str[0], format="%Y%m%d", errors="coerce"))
+            # Other files under the prefix, like the folder itself, are not snapshots
+            catalog["snapshots"] = snapshots.dropna(subset=["date"]).reset_index(drop=True)
+        return catalog["snapshots"].copy()
+
 @st.cache_data(ttl=3600)
 def load_data_quality_historic(date, client="Arauco") -> pd.DataFrame:
     if client == "Arauco":
-        data = load_csv_s3("klog-lake","raw/arauco_snapshots/",f"{date.strftime('%Y%m%d')}-arauco_snapshot.csv")
+        data = load_csv_s3(SNAPSHOT_BUCKET,SNAPSHOT_PREFIX,f"{date.strftime('%Y%m%d')}-arauco_snapshot.csv")
     return data
 
+# Partitioned Parquet dataset written by "python database.py --parquet"
+ITINERARIES_PARQUET = "itineraries_parquet"
+# On-disk cache of transformed itineraries, kept across restarts (see _itinerarios_cached_table)
+ITINERARIES_CACHE = os.path.join(".cache", "itinerarios")
+
+def _itinerarios_partitions(start: datetime, end: datetime, parquet_dir: str = ITINERARIES_PARQUET) -> list:
+    """Parquet files of the months overlapping [start, end), or None if the dataset doesn't have all of them
+
+    Args:
+        start (datetime): First ETD, included
+        end (datetime): Last ETD, excluded
+        parquet_dir (str): Partitioned Parquet dataset written by database.py
+    """
+    import glob
+    from database import month_range
+
+    files = []
+    year, month = start.year, start.month
+    while month_range(year, month)[0] < end:
+        month_files = glob.glob(f"{parquet_dir}/year={year}/month={month}/*/*.parquet")
+        if not month_files:
+            return None
+        files += month_files
+        year, month = year + month // 12, month % 12 + 1
+    return files
+
+def _itinerarios_version(database: str = "itineraries.db", files: list = None) -> tuple:
+    """Version of the itineraries read from database and files: mtime and size of the database, which change every time
+    database.py writes it, and path, mtime and size of each file, which change when the Parquet partitions are written
+    again. Cached itineraries are keyed on it, in memory and on disk
+
+    Args:
+        database (str): DuckDB database written by database.py
+        files (list): Other files read, like Parquet partitions
+    """
+    stat = os.stat(database)
+    return (stat.st_mtime_ns, stat.st_size, tuple((f, os.stat(f).st_mtime_ns, os.stat(f).st_size) for f in sorted(files or [])))
+
+def _itinerarios_cached_table(query: str, parameters: list, database: str = "itineraries.db", cache_dir: str = ITINERARIES_CACHE, files: list = None):
+    """Run an itineraries query on database and return its result as an Arrow table, cached on disk
+
+    Results are written as Arrow IPC files in cache_dir/<version>/<hash of query, parameters and files>.arrow, where
+    version is the mtime and size of database, and files are the Parquet partitions read by the query with their
+    mtime and size (see _itinerarios_version). So the cache survives restarts and is shared by every process on the machine, and cached files are memory-mapped
+    instead of re-running the query. When a new version of the database is cached, files of previous versions are
+    deleted.
+
+    Args:
+        query (str): Query
+        parameters (list): Parameters of the query
+        database (str): DuckDB database written by database.py
+        cache_dir (str): Directory of the cache
+        files (list): Other files read by the query, like Parquet partitions
+    """
+    import duckdb, hashlib, shutil
+    import pyarrow as pa
+
+    mtime, size, files = _itinerarios_version(database, files)
+    version = f"{mtime}-{size}"
+    path = os.path.join(cache_dir, version, hashlib.sha1(repr((query, parameters, files)).encode()).hexdigest() + ".arrow")
+    if os.path.exists(path):
+        return pa.ipc.open_file(pa.memory_map(path)).read_all()
+
+    con = duckdb.connect(database, read_only=True)
+    table = con.execute(query, parameters).arrow()
+    con.close()
+
+    # Evict previous versions, then write to a temporary file and move it in place, so readers never see partial files
+    if os.path.isdir(cache_dir):
+        for old in os.listdir(cache_dir):
+            if old != version:
+                shutil.rmtree(os.path.join(cache_dir, old), ignore_errors=True)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with pa.OSFile(tmp, "wb") as sink, pa.ipc.new_file(sink, table.schema) as writer:
+        writer.write_table(table)
+    os.replace(tmp, path)
+    return table
+
+def load_itinerarios_range(start: datetime, end: datetime, pols: list = None, pods: list = None, carriers: list = None, database: str = "itineraries.db", parquet_dir: str = ITINERARIES_PARQUET) -> pd.DataFrame:
+    """Load itineraries with ETD in [start, end) from database and transform them to a dataframe
+
+    Carrier, ports, timestamps, transhipments, vessels and services are computed in the query built by
+    database.itinerarios_select, so no row-wise Python runs over the itineraries. Tables are sorted by ETD, so only the
+    row groups of the range are read. Results are cached in memory by arguments and version of the data read (see
+    _itinerarios_version), like the on-disk cache, so an ingest or export is seen on the next rerun.
+
+    Args:
+        start (datetime): First ETD, included. Naive datetimes are UTC
+        end (datetime): Last ETD, excluded. Naive datetimes are UTC
+        pols (list): POL locodes to keep. All if None
+        pods (list): POD locodes to keep. All if None
+        carriers (list): Carrier SCACs to keep. All if None
+        database (str): DuckDB database written by database.py
+        parquet_dir (str): Partitioned Parquet dataset written by database.py, read instead of database when it has every month of the range
+    """
+    from datetime import timezone
+
+    start, end = [t if t.tzinfo else t.replace(tzinfo=timezone.utc) for t in [start, end]]
+    # If the partitioned Parquet dataset has these months, we read only their partitions; otherwise we query the database
+    partitions = _itinerarios_partitions(start, end, parquet_dir)
+    return _load_itinerarios_range(start, end, pols, pods, carriers, database, partitions, _itinerarios_version(database, partitions))
+
 @st.cache_data(ttl=3600)
-def load_itinerarios():
-    # Read all json files from data directory
-    data_dir = "data/"
-    files = [f for f in os.listdir(data_dir) if os.path.isfile(os.path.join(data_dir, f)) and f.endswith(".json")]
-    data = []
-    for file in files:
-        # Read JSON
-        with open(data_dir+file) as f:
-            d = json.load(f)
-            if "results" not in d.keys():
-                continue
-            data += [d]
-    results = [i for sublist in [d["results"] for d in data] for i in sublist]
-    return pd.DataFrame(results)
\ No newline at end of file
+def _load_itinerarios_range(start: datetime, end: datetime, pols: list, pods: list, carriers: list, database: str, partitions: list, version: tuple) -> pd.DataFrame:
+    """load_itinerarios_range of the given partitions (None to read database), cached by version of the data"""
+    from database import itinerarios_select
+
+    query, parameters = itinerarios_select(start, end, pols=pols, pods=pods, carriers=carriers, partitions=partitions)
+
+    # Get the result from the on-disk cache, or from database. Lists are converted from Arrow, which is much faster than
+    # fetchdf for nested lists.
+    table = _itinerarios_cached_table(query, parameters, database, files=partitions)
+    list_columns = ["transhipments", "transhipments_name", "vessel", "service"]
+    df = table.drop(list_columns).to_pandas()
+    for column in list_columns:
+        df[column] = pd.Series(table.column(column).to_pylist(), dtype=object)
+    df = df[table.column_names]
+    for datetime_column in ["etd", "eta", "etd_local", "eta_local"]:
+        df[datetime_column] = df[datetime_column].astype("datetime64[ns]")
+
+    return df
+
+def load_itinerarios(month: int, year: int = 2023, database: str = "itineraries.db", parquet_dir: str = ITINERARIES_PARQUET) -> pd.DataFrame:
+    """Load itineraries of a month from database and transform them to a dataframe (see load_itinerarios_range)
+
+    Args:
+        month (int): Month to filter itineraries
+        year (int): Year to filter itineraries
+        database (str): DuckDB database written by database.py
+        parquet_dir (str): Partitioned Parquet dataset written by database.py, read instead of database when it has the month
+    """
+    from database import month_range
+
+    start, end = month_range(year, month)
+    return load_itinerarios_range(start, end, database=database, parquet_dir=parquet_dir)
+
+def load_itinerarios_rollup(kind: str, start: datetime, end: datetime, pols: list = None, pods: list = None, carriers: list = None, database: str = "itineraries.db") -> pd.DataFrame:
+    """Load transit time aggregates of itineraries with ETD in [start, end)
+
+    Whole months without POL/POD/carrier filters are read from the aggregates materialized by database.py when
+    itineraries are loaded; other ranges are aggregated on the fly. Results are cached in memory by arguments and version
+    of the database (see _itinerarios_version).
+
+    Args:
+        kind (str): "transit_times" (by POL, POD, carrier, transhipments and service) or "destination_times" (by POD)
+        start (datetime): First ETD, included. Naive datetimes are UTC
+        end (datetime): Last ETD, excluded. Naive datetimes are UTC
+        pols (list): POL locodes to keep. All if None
+        pods (list): POD locodes to keep. All if None
+        carriers (list): Carrier SCACs to keep. All if None
+        database (str): DuckDB database written by database.py
+    """
+    return _load_itinerarios_rollup(kind, start, end, pols, pods, carriers, database, _itinerarios_version(database))
+
+@st.cache_data(ttl=3600)
+def _load_itinerarios_rollup(kind: str, start: datetime, end: datetime, pols: list, pods: list, carriers: list, database: str, version: tuple) -> pd.DataFrame:
+    """load_itinerarios_rollup, cached by version of the database"""
+    import duckdb
+    from datetime import timezone
+    from database import itinerarios_rollup_select, month_range
+
+    start, end = [t if t.tzinfo else t.replace(tzinfo=timezone.utc) for t in [start, end]]
+    con = duckdb.connect(database, read_only=True)
+    existing = [r[0] for r in con.execute("select table_name from information_schema.tables").fetchall()]
+    whole_month = (start, end) == month_range(start.year, start.month)
+    if whole_month and pols is None and pods is None and carriers is None and f"itineraries_{kind}" in existing:
+        df = con.execute(f'select * exclude ("year", "month") from "itineraries_{kind}" where "year" = ? and "month" = ? order by all', [start.year, start.month]).fetchdf()
+    else:
+        query, parameters = itinerarios_rollup_select(kind, start, end, pols=pols, pods=pods, carriers=carriers)
+        df = con.execute(query, parameters).fetchdf()
+    con.close()
+    return df
+
+def load_itinerarios_options(database: str = "itineraries.db") -> dict:
+    """Load the range of ETDs (as dates, in UTC) and the POLs, PODs and carriers of itineraries, to build filters
+
+    Results are cached in memory by version of the database (see _itinerarios_version).
+
+    Args:
+        database (str): DuckDB database written by database.py
+    """
+    return _load_itinerarios_options(database, _itinerarios_version(database))
+
+@st.cache_data(ttl=3600)
+def _load_itinerarios_options(database: str, version: tuple) -> dict:
+    """load_itinerarios_options, cached by version of the database"""
+    import duckdb
+    from database import ITINERARIES_POL_NAMES, ITINERARIES_CARRIERS
+
+    con = duckdb.connect(database, read_only=True)
+    etd = con.execute('''select cast(min(timezone('UTC', "etd")) as date), cast(max(timezone('UTC', "etd")) as date) from "itineraries"''').fetchone()
+    options = {"etd": etd}
+    for column, name in [("pol", "pol_name"), ("pod", "pod_name"), ("carrier", "carrier_short_name")]:
+        key = "carrier_scac" if column == "carrier" else f"{column}_locode"
+        options[column] = dict(con.execute(f'''
+select
+    "{key}"
+    ,min("{name}")
+from
+    "itineraries"
+where
+    "pol_name" in (select unnest(?::VARCHAR[]))
+    and "carrier_scac" in (select unnest(?::VARCHAR[]))
+group by
+    "{key}"
+order by
+    "{key}"
+''', [ITINERARIES_POL_NAMES, ITINERARIES_CARRIERS]).fetchall())
+    con.close()
+    return options
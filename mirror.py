@@ -0,0 +1,239 @@
+import time
+import logging
+import threading
+import duckdb
+import pandas as pd
+from datetime import datetime, timedelta
+
+logging.basicConfig(level=logging.INFO)
+
+# Local DuckDB mirror of Warehouse Vecna tables, and indexes of Prisma tables, kept up to date by sync_table
+MIRROR_DATABASE = "vecna_mirror.db"
+
+# Mirrored tables: source database (Warehouse Vecna if not given), source table by environment, columns (or select,
+# a SELECT list of expressions), watermark column (rows are fetched from the last value of this column) and first
+# watermark mirrored. Mirror tables are named {env}_{name}.
+MIRROR_TABLES = {
+    "subscriptions": {
+        "source": {"prod": "public.prod_vecna_subscription", "staging": "staging.dev_vecna_subscription"},
+        "columns": None,
+        "watermark": "subscription_created_at",
+        "since": "2023-01-14",
+    },
+    "events": {
+        "source": {"prod": "public.prod_vecna_event_consolidated", "staging": "staging.dev_vecna_event_consolidated"},
+        "columns": [
+            "vecna_event_id",
+            "vecna_event_container",
+            "subscription_id",
+            "subscription_type",
+            "subscription_bl",
+            "subscription_booking",
+            "subscription_container",
+            "subscription_carrier_code",
+            "vecna_event_created_at",
+            "raw_event_gh",
+            "raw_event_oi",
+        ],
+        "watermark": "vecna_event_created_at",
+        "since": "2023-01-01",
+    },
+    # Container of each Prisma OiEvent, extracted from its JSON body once, when the event is mirrored. Lookups by
+    # container read the ids here and fetch only those rows from Prisma (see load.load_events_prisma)
+    "oi_event_containers": {
+        "database": "prisma",
+        "source": {"prod": '"OiEvent"'},
+        "select": '''"id", "body"::json -> 'shipment' ->> 'container_number' AS "container_number", "createdAt"''',
+        "watermark": "createdAt",
+        "since": "2023-01-01",
+    },
+}
+
+# Incremental syncs fetch again the rows of this period before the watermark, to catch rows committed late
+MIRROR_LOOKBACK = timedelta(hours=1)
+# Tables are fetched in full again after this period, to catch updates and deletes of older rows
+MIRROR_RECONCILE = timedelta(hours=24)
+# Lookups in page requests sync their index at most this often (see load._oi_event_ids)
+MIRROR_LOOKUP_SYNC_INTERVAL = timedelta(minutes=10)
+
+# One connection by database, shared by the threads of the process (DuckDB doesn't allow a database to be opened
+# twice with different settings in a process). Writes are serialized by the lock; reads use cursors. Syncs of a
+# table are serialized by its own lock, held while its rows are fetched
+_connections = {}
+_lock = threading.RLock()
+_table_locks = {}
+
+def mirror_connection(database=MIRROR_DATABASE):
+    """ Connection to the mirror database, opened once per process """
+    with _lock:
+        if database not in _connections:
+            _connections[database] = duckdb.connect(database)
+            _connections[database].execute("""CREATE TABLE IF NOT EXISTS mirror_state (
+                table_name VARCHAR,
+                watermark VARCHAR,
+                last_sync TIMESTAMP,
+                last_full_sync TIMESTAMP,
+                rows BIGINT
+            )""")
+        return _connections[database]
+
+def read_mirror(query, parameters=None, database=MIRROR_DATABASE, arrow=False):
+    """ Run query on the mirror database and return the result as a dataframe
+
+    Args:
+        query (str): Query
+        parameters (list): Parameters of the query
+        database (str): Mirror database
+        arrow (bool): Return an Arrow-backed dataframe (pd.ArrowDtype columns), built from the Arrow result without
+            converting it to Python objects. Text columns take a fraction of the memory of object columns. Timestamps
+            stay datetime64, whose missing values (NaT) still behave as datetimes, e.g. in st_aggrid
+    """
+    cursor = mirror_connection(database).cursor()
+    try:
+        cursor.execute(query, parameters or [])
+        if arrow:
+            import pyarrow as pa
+            return cursor.fetch_arrow_table().to_pandas(types_mapper=lambda t: None if pa.types.is_timestamp(t) else pd.ArrowDtype(t))
+        return cursor.fetchdf()
+    finally:
+        cursor.close()
+
+def _fetch_rows(name, env, since):
+    """ Rows of a mirrored table in its source database with watermark at or after since, as an Arrow table
+
+    Rows are fetched in chunks with a server-side cursor (see load.read_sql_arrow), so a full sync of a large table
+    doesn't hold it as Python objects.
+    """
+    from load import read_sql_arrow
+
+    spec = MIRROR_TABLES[name]
+    if "select" in spec:
+        columns = spec["select"]
+    else:
+        columns = ", ".join(f'"{c}"' for c in spec["columns"]) if spec["columns"] else "*"
+    query = f'SELECT {columns} FROM {spec["source"][env]} WHERE "{spec["watermark"]}" >= %(since)s'
+    return read_sql_arrow(spec.get("database", "warehouse_vecna"), env, query, {"since": since})
+
+def _table_lock(table):
+    """ Lock of one mirror table, so it isn't fetched twice at once while other tables sync """
+    with _lock:
+        return _table_locks.setdefault(table, threading.Lock())
+
+def _write(con, statements):
+    """ Run statements, a function of the connection, in a transaction, rolled back if they fail
+
+    The connection is shared by the whole process, so a transaction left open would make every later begin() fail.
+    """
+    con.begin()
+    try:
+        statements(con)
+        con.commit()
+    except Exception:
+        con.rollback()
+        raise
+
+def sync_table(name, env="prod", database=MIRROR_DATABASE, full=False, reconcile=MIRROR_RECONCILE, min_interval=None):
+    """ Bring the mirror of a Warehouse Vecna or Prisma table up to date
+
+    Only rows with the watermark column at or after the last mirrored watermark (minus MIRROR_LOOKBACK) are fetched.
+    They replace the mirrored rows of that period, so rows fetched twice are not duplicated. Every reconcile period,
+    or when the table doesn't exist or its columns changed, the whole table is fetched again and replaced.
+
+    Rows are fetched holding only the lock of the table, so other tables sync and the mirror is read meanwhile; the
+    connection lock is taken to read the watermark and to write the fetched rows. With min_interval, used by lookups
+    in page requests, the sync is skipped if the table was synced within that period or is being synced.
+
+    Args:
+        name (str): Mirrored table, a key of MIRROR_TABLES
+        env (str): "prod" or "staging"
+        database (str): Mirror database
+        full (bool): Fetch the whole table, whenever the last full sync was
+        reconcile (timedelta): Time between full syncs
+        min_interval (timedelta): Skip the sync if the last one was within this period, or if one is running
+
+    Returns:
+        dict: Rows fetched, whether the sync was full, and elapsed seconds, or None if the sync was skipped
+    """
+    spec = MIRROR_TABLES[name]
+    table = f"{env}_{name}"
+    watermark = spec["watermark"]
+    start = time.perf_counter()
+    now = datetime.utcnow()
+
+    table_lock = _table_lock((database, table))
+    if not table_lock.acquire(blocking=min_interval is None):
+        return None
+    try:
+        with _lock:
+            con = mirror_connection(database)
+            state = con.execute("SELECT last_full_sync, last_sync FROM mirror_state WHERE table_name = ?", [table]).fetchone()
+            tables = [r[0] for r in con.execute("SELECT table_name FROM information_schema.tables").fetchall()]
+            last = con.execute(f'SELECT max("{watermark}") FROM "{table}"').fetchone()[0] if state and table in tables else None
+        if min_interval is not None and last is not None and now - state[1] < min_interval:
+            return None
+        full = full or last is None or now - state[0] >= reconcile
+
+        if not full:
+            since = last - MIRROR_LOOKBACK
+            rows = _fetch_rows(name, env, since)
+
+            def replace_period(con):
+                con.execute(f'DELETE FROM "{table}" WHERE "{watermark}" >= ?', [since])
+                if len(rows):
+                    con.register("batch", rows)
+                    con.execute(f'INSERT INTO "{table}" BY NAME SELECT * FROM batch')
+                    con.unregister("batch")
+
+            try:
+                with _lock:
+                    _write(con, replace_period)
+            except duckdb.Error as e:
+                logging.warning(f"Incremental sync of {table} failed ({e}), fetching the whole table")
+                full = True
+
+        if full:
+            rows = _fetch_rows(name, env, spec["since"])
+
+            def replace_table(con):
+                # Sorted by watermark, so incremental deletes and date filters only touch the last row groups
+                con.register("batch", rows)
+                try:
+                    con.execute(f'CREATE OR REPLACE TABLE "{table}" AS SELECT * FROM batch ORDER BY "{watermark}"')
+                finally:
+                    con.unregister("batch")
+
+            with _lock:
+                _write(con, replace_table)
+
+        def update_state(con):
+            last = con.execute(f'SELECT max("{watermark}") FROM "{table}"').fetchone()[0]
+            last_full_sync = now if full else state[0]
+            con.execute("DELETE FROM mirror_state WHERE table_name = ?", [table])
+            con.execute("INSERT INTO mirror_state VALUES (?, ?, ?, ?, ?)", [table, None if last is None else str(last), now, last_full_sync, len(rows)])
+
+        with _lock:
+            _write(con, update_state)
+    finally:
+        table_lock.release()
+
+    elapsed = time.perf_counter() - start
+    logging.info(f"Synced {table}: {len(rows)} rows fetched ({'full' if full else 'incremental'}) in {elapsed:.2f}s")
+    return {"rows": len(rows), "full": full, "seconds": elapsed}
+
+def mirror_state(database=MIRROR_DATABASE):
+    """ Watermark, last syncs and rows fetched by the last sync of each mirrored table """
+    return read_mirror("SELECT * FROM mirror_state ORDER BY table_name", database=database)
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description="Sync the local mirror of Warehouse Vecna and Prisma tables into vecna_mirror.db")
+    parser.add_argument("--env", choices=["prod", "staging"], default="prod")
+    parser.add_argument("--full", action="store_true", help="Fetch whole tables instead of rows after the watermark")
+    args = parser.parse_args()
+
+    for name, spec in MIRROR_TABLES.items():
+        if args.env in spec["source"]:
+            sync_table(name, env=args.env, full=args.full)
+
+if __name__ == '__main__':
+    main()
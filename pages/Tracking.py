@@ -2,10 +2,11 @@ import streamlit as st
 import pandas as pd
 from datetime import datetime
 from st_aggrid import AgGrid, GridOptionsBuilder, JsCode
-from tools.tools import list_files_s3, load_csv_s3, agrid_options, agrid_options_raw, setup_ambient
+from tools.tools import load_csv_s3, agrid_options, agrid_options_raw, agrid_server_side, setup_ambient
 import altair as alt
 import components
 import load
+from export import ui_download_button
 
 # Comment: change line below to submit changes to github
 # Commited on 201306301000
@@ -150,8 +151,9 @@ col1_a, col2_a = st.columns([1,2])
 
 # Choose between current data / historic
 with col1_a:
-    historic_data = list_files_s3("klog-lake","raw/arauco_snapshots/")
-    historic_data_choice = [datetime.strptime(f.split("/")[-1].split("-")[0],"%Y%m%d") for f in historic_data[1:]]
+    # Listing of the snapshots, cached and refreshed with the new ones only
+    historic_data = load.load_snapshot_catalog()
+    historic_data_choice = [d.to_pydatetime() for d in historic_data["date"]]
     data_source = st.selectbox(
         "Fuente de datos",
         ["Actual"]+historic_data_choice,
@@ -606,7 +608,24 @@ with tab5:
     data_quality_main = data_quality_wide_filtered[data_quality_columns_selected+["Total W"]]
     # Sum over all columns that start with W
 
-    selected_entregas = AgGrid(data_quality_main, agrid_options(data_quality_main, 15), columns_auto_size_mode=1, allow_unsafe_jscode=1, allow_unsafe_html=1)
+    ui_download_button(data_quality_main, filename="entregas")
+    # Only the page shown is sent to the browser
+    selected_entregas = agrid_server_side(data_quality_main, 15, key="data_quality_main", columns_auto_size_mode=1, allow_unsafe_jscode=1, allow_unsafe_html=1)
+
+    # Events (Arauco) or shipments of the MBLs of the page are loaded in one query in the background, so selecting a
+    # row reads them from the cache. MBLs found in the index of the mirror don't need the warehouse
+    page_mbls, page_mbls_missing, page_subscription_ids = [], (), ()
+    if selected_entregas and isinstance(selected_entregas["data"], pd.DataFrame) and "MBL" in selected_entregas["data"]:
+        page_mbls = list(selected_entregas["data"]["MBL"].dropna().unique())
+    if page_mbls and ARAUCO:
+        events_index = load.load_events_index("prod")
+        indexed_mbls = set(events_index.dataframe["subscription_bl"].iloc[events_index.positions("subscription_bl", page_mbls)])
+        page_mbls_missing = tuple(m for m in page_mbls if m not in indexed_mbls)
+        if page_mbls_missing:
+            load.prefetch(load.load_events_vecna_batch, "mbl", page_mbls_missing, "prod")
+    elif page_mbls:
+        page_subscription_ids = tuple(data_quality_wide_filtered.loc[lambda x: x["MBL"].isin(page_mbls), "subscriptionId"].astype(str).unique())
+        load.prefetch(load.load_shipments_prisma_batch, page_subscription_ids)
 
     if selected_entregas and len(selected_entregas["selected_rows"])>0:
         selected_entrega = selected_entregas["selected_rows"][0]["Entrega"]
@@ -619,23 +638,26 @@ with tab5:
 
         if ARAUCO:
         
-            events_rows = load.load_events_vecna("mbl",selected_mbl,"prod")
+            # Events of the MBL from the in-memory index of the mirror, or from the warehouse if it has none
+            events_rows = load.load_events_index("prod").lookup("subscription_bl", selected_mbl)
+            if events_rows.empty and selected_mbl in page_mbls_missing:
+                events_rows = load.load_events_vecna_batch("mbl", page_mbls_missing, "prod").loc[lambda x: x["subscription_bl"] == selected_mbl]
+            elif events_rows.empty:
+                events_rows = load.load_events_vecna("mbl",selected_mbl,"prod")
             
-            # Vecna S3
-            if events_rows["raw_event_oi"].values[0] and events_rows["raw_event_oi"].values[0] != "subscription":
-                event_raw = load.load_event_raw(events_rows["raw_event_oi"].values[0], "oceaninsights/")
+            # Vecna S3: the raw Gatehouse event, fetched with the other sources
+            raw_event_gh = events_rows["raw_event_gh"].iloc[0]
+            if pd.notna(raw_event_gh) and raw_event_gh and raw_event_gh != "subscription":
+                event_raw_file = (raw_event_gh, "ghmaritime/")
             else:
-                event_raw = {}
-            if events_rows["raw_event_gh"].values[0] and events_rows["raw_event_gh"].values[0] != "subscription":
-                event_raw = load.load_event_raw(events_rows["raw_event_gh"].values[0], "ghmaritime/")
-            else:
-                event_raw = {}
+                event_raw_file = None
             
             if AMBIENT == "dev":
-                components.show_data_sources(selected_entregas, selected_subscription_id, vecna_dynamo=False, events_s3=True, event_raw=event_raw)
+                components.show_data_sources(selected_entregas, selected_subscription_id, vecna_dynamo=False, events_s3=True, event_raw_file=event_raw_file)
             elif AMBIENT == "prod":
-                components.show_data_sources(selected_entregas, selected_subscription_id, vecna_dynamo=False, events_s3=False, event_raw=event_raw)
+                components.show_data_sources(selected_entregas, selected_subscription_id, vecna_dynamo=False, events_s3=False, event_raw_file=event_raw_file)
 
         if not ARAUCO:
 
-            components.show_shipment_prisma(selected_subscription_id, rows_to_highlight=["TR1 Puerto","TR2 Puerto"])
+            shipments = load.load_shipments_prisma_batch(page_subscription_ids) if selected_subscription_id in page_subscription_ids else None
+            components.show_shipment_prisma(selected_subscription_id, rows_to_highlight=["TR1 Puerto","TR2 Puerto"], shipments=shipments)
@@ -1,9 +1,8 @@
 import streamlit as st
 from st_aggrid import AgGrid, GridOptionsBuilder
 import pandas as pd
-import json
 import load, components
-from tools.tools import setup_ambient
+from tools.tools import setup_ambient, agrid_server_side
 
 ARAUCO = True
 
@@ -30,16 +29,10 @@ env = st.selectbox("Ambiente", options=["prod","staging"])
 
 subscriptions = load.load_subscriptions(env)
 
-events = load.load_events(env)
+# Events by subscription document, aggregated once per refresh of the data
+subscription_stats = load.load_subscription_stats(env)
 
-subscriptions = subscriptions.merge(events.groupby("subscription_doc").agg(
-    {"subscription_id":"count"
-    ,"vecna_event_created_at":"max"
-        }), on="subscription_doc", how="left").rename(columns={
-    "subscription_id_x":"subscription_id"
-    ,"subscription_id_y":"events"
-    ,"vecna_event_created_at":"last"
-    })
+subscriptions = subscriptions.merge(subscription_stats, on="subscription_doc", how="left")
 
 col1, col2 = st.columns([1,1])
 with col1:
@@ -60,6 +53,10 @@ subscriptions_table_columns = {
     ,"response_api_oi_creation":"response_oi"
     ,"response_api_gh_creation":"response_gh"
     ,"events":"events"
+    ,"containers":"containers"
+    ,"events_gh":"events_gh"
+    ,"events_oi":"events_oi"
+    ,"first":"first"
     ,"last":"last"
     }
 
@@ -67,7 +64,16 @@ subscriptions_table = subscriptions[subscriptions_table_columns.keys()].rename(c
 if selected_mbl:
     subscriptions_table = subscriptions_table.replace("NOT AVAILABLE","")
     subscriptions_table = subscriptions_table.loc[lambda x: x["doc"].isin(selected_mbl)]
-selected_subscription = AgGrid(subscriptions_table, agrid_options(subscriptions_table, 15), columns_auto_size_mode=1)
+# Only the page shown is sent to the browser
+selected_subscription = agrid_server_side(subscriptions_table, 15, key="subscriptions", columns_auto_size_mode=1)
+
+# Vecna back responses of the subscriptions of the page are fetched in the background, so they open from the cache
+if selected_subscription and isinstance(selected_subscription["data"], pd.DataFrame) and "id" in selected_subscription["data"]:
+    load.prefetch(load.load_events_vecna_back, tuple(selected_subscription["data"]["id"]), env)
+
+# Payloads of every event of the selected subscription are loaded in the background, so event clicks are lookups
+if selected_subscription and len(selected_subscription["selected_rows"]) != 0:
+    load.prefetch(load.load_events_vecna_by_subscription, env, selected_subscription["selected_rows"][0]["id"])
 
 st.write("#### Events")
 
@@ -79,9 +85,8 @@ if len(selected_subscription["selected_rows"]) == 0:
 
 else:
 
-    events = load.load_events(env)
-
     selected_subscription_id = selected_subscription["selected_rows"][0]["id"]
+    events = load.load_events_index(env).lookup("subscription_id", selected_subscription_id)
     events_table_columns = {
         "subscription_id":"subscription_id"
         ,"subscription_doc":"subscription_doc"
@@ -91,7 +96,6 @@ else:
         ,"raw_event_oi":"raw_event_oi"
     }
     events_table = events[events_table_columns.keys()].rename(columns=events_table_columns)
-    events_table = events_table.loc[lambda x: x["subscription_id"] == selected_subscription_id]
     events_table.sort_values(by="created_at", ascending=False, inplace=True)
     selected_event = AgGrid(events_table, agrid_options(events_table, 15), columns_auto_size_mode=1)
 
@@ -102,28 +106,23 @@ if selected_event and len(selected_event["selected_rows"]) != 0:
     selected_event_created_at = selected_event["selected_rows"][0]["created_at"]
     selected_event_doc = selected_event["selected_rows"][0]["subscription_doc"]
 
-    #event = load_event_vecna(env, selected_event_id, selected_event_subscription_id, selected_event_created_at, selected_event_container)
-    event = load.load_event_vecna(env, selected_event_id)
-    event_vecna_gh_text = event["vecna_event_gh"].values[0]
-    event_vecna_oi_text = event["vecna_event_oi"].values[0]
-    event_vecna_text = event["vecna_event"].values[0]
-
-    # Vecna events
+    selected_event_raw_oi = selected_event["selected_rows"][0]["raw_event_oi"]
+    selected_event_raw_gh = selected_event["selected_rows"][0]["raw_event_gh"]
 
-    event_vecna_oi = json.loads(event_vecna_oi_text) if event_vecna_oi_text is not None else {}
-    event_vecna_gh = json.loads(event_vecna_gh_text) if event_vecna_gh_text is not None else {}
-    event_vecna = json.loads(event_vecna_text) if event_vecna_text is not None else {}
+    def load_selected_event(env, subscription_id, vecna_event_id):
+        # Row of the event among the events of its subscription (prefetched), or from the warehouse if it isn't there
+        #event = load_event_vecna(env, selected_event_id, selected_event_subscription_id, selected_event_created_at, selected_event_container)
+        event = load.load_events_vecna_by_subscription(env, subscription_id)
+        event = event.loc[lambda x: x["vecna_event_id"] == vecna_event_id]
+        if event.empty:
+            event = load.load_event_vecna(env, vecna_event_id)
+        return event
 
-    # Raw events
-
-    if event["raw_event_oi"].values[0] and event["raw_event_oi"].values[0] != "subscription":
-        event_oi_raw = load.load_event_raw(event["raw_event_oi"].values[0], "oceaninsights/")
-    else:
-        event_oi_raw = {}
-    if event["raw_event_gh"].values[0] and event["raw_event_gh"].values[0] != "subscription":
-        event_gh_raw = load.load_event_raw(event["raw_event_gh"].values[0], "ghmaritime/")
-    else:
-        event_gh_raw = {}
+    def show_event_raw(event_raw):
+        if event_raw == {}:
+            st.warning("File not found")
+        else:
+            st.json(event_raw)
 
     exp = st.expander("JSONs", expanded=False)
 
@@ -131,46 +130,44 @@ if selected_event and len(selected_event["selected_rows"]) != 0:
 
         tab1, tab2, tab3, tab4 = st.tabs(["Vecna","Raw", "Vecna Back", "Dynamo"])
 
-        with tab1:
-
-            col1, col2, col3 = st.columns([1,1,1])
-            with col1:
-                st.write("Vecna Ocean Insights")
-                st.json(event_vecna_oi)
-            with col2:
-                st.write("Vecna Gatehouse")
-                st.json(event_vecna_gh)
-            with col3:
-                st.write("Vecna")
-                st.json(event_vecna)
-        
         with tab2:
-        
+
             col1, col2 = st.columns([1,1])
             with col1:
                 st.write("Ocean Insights")
-                if event_oi_raw == {}:
-                    st.warning("File not found")
-                else:
-                    st.json(event_oi_raw)
             with col2:
                 st.write("Gatehouse")
-                if event_gh_raw == {}:
-                    st.warning("File not found")
-                else:
-                    st.json(event_gh_raw)
 
-        with tab3:
-
-            event = load.load_event_vecna_back(selected_event_subscription_id, env)
-            st.json(event)
-
-        with tab4:
+        # Every source is fetched at the same time, and shown as soon as it arrives
+        sources = {
+            "Vecna (DB)": (load_selected_event, env, selected_event_subscription_id, selected_event_id),
+            "Vecna (API)": (load.load_event_vecna_back, selected_event_subscription_id, env),
+            "Vecna (Dynamo)": (load.load_event_dynamo, selected_event_subscription_id, env),
+        }
+        renders = {
+            "Vecna (DB)": (tab1, components.show_event_vecna),
+            "Vecna (API)": (tab3, st.json),
+            "Vecna (Dynamo)": (tab4, st.json),
+        }
+
+        # Raw events
+        for name, raw_event, path, col in [("Raw Ocean Insights", selected_event_raw_oi, "oceaninsights/", col1), ("Raw Gatehouse", selected_event_raw_gh, "ghmaritime/", col2)]:
+            if raw_event and raw_event != "subscription":
+                sources[name] = (load.load_event_raw, raw_event, path)
+                renders[name] = (col, show_event_raw)
+            else:
+                with col:
+                    st.warning("File not found")
 
-            event = load.load_event_dynamo(selected_event_subscription_id, env)
-            st.json(event)
+        components.show_sources(sources, renders)
     #
 
+with st.expander("Índice de eventos"):
+    # Events of the mirror and their index by subscription and documents, shared by every session. Expanders run
+    # also when collapsed, so the index is only built here when asked for; otherwise the first event lookup builds it
+    if st.checkbox("Mostrar memoria del índice", key="events_index_memory"):
+        st.dataframe(load.load_events_index(env).memory_usage(), hide_index=True)
+
 st.write("### Shipment")
 
 if selected_subscription and len(selected_subscription["selected_rows"]) != 0:
@@ -0,0 +1,243 @@
+import os
+import json
+import threading
+import streamlit as st
+
+# Bucket of the raw events received from Ocean Insights and Gatehouse
+EVENTS_BUCKET = "prod-track-sources-s3stack-dumpbucketbe480749-wch2mlfw0oh0"
+S3_REGION = "us-east-1"
+
+# Connections kept open by the shared client, at least as many as S3_WORKERS. Requests are retried with the standard
+# backoff of botocore, and fail after the connect and read timeouts instead of hanging the page
+S3_MAX_POOL_CONNECTIONS = 32
+S3_RETRIES = 4
+S3_CONNECT_TIMEOUT = 5
+S3_READ_TIMEOUT = 30
+# Objects fetched at a time by get_objects
+S3_WORKERS = 16
+# Bytes read at a time by stream_object
+S3_CHUNK_BYTES = 1024 ** 2
+
+# On-disk cache of write-once objects (see get_object_cached): directory and size budget of the compressed files
+S3_CACHE_DIR = os.path.join(".cache", "s3")
+S3_CACHE_BYTES = 512 * 1024 ** 2
+
+_client = None
+_lock = threading.Lock()
+# Files of the disk cache (hash of bucket/key -> path and compressed bytes, least recently used first), by cache
+# directory, and statistics
+_disk_caches = {}
+_disk_cache_stats = {"hits": 0, "misses": 0, "bytes_saved": 0, "bytes_stored": 0, "evictions": 0}
+_disk_cache_lock = threading.Lock()
+
+def _credentials():
+    """AWS keys from the Streamlit secrets, or none to use the default chain of boto3 (environment, profile, role)"""
+    try:
+        return {"aws_access_key_id": st.secrets["aws_access_key_id"], "aws_secret_access_key": st.secrets["aws_secret_access_key"]}
+    except (FileNotFoundError, KeyError):
+        return {}
+
+def client():
+    """S3 client shared by the whole process, created on first use
+
+    Creating a client loads the service model and resolves credentials and endpoints, which takes longer than most
+    requests, so it's done once. Clients are thread safe, and the connection pool is sized for concurrent requests.
+    """
+    global _client
+    import boto3
+    from botocore.config import Config
+
+    with _lock:
+        if _client is None:
+            config = Config(
+                max_pool_connections=S3_MAX_POOL_CONNECTIONS,
+                retries={"max_attempts": S3_RETRIES, "mode": "standard"},
+                connect_timeout=S3_CONNECT_TIMEOUT,
+                read_timeout=S3_READ_TIMEOUT,
+                tcp_keepalive=True,
+            )
+            _client = boto3.session.Session().client("s3", region_name=S3_REGION, config=config, **_credentials())
+        return _client
+
+def list_objects(bucket, prefix, start_after=None):
+    """Key, size, ETag and last modification of every object in bucket under prefix, in key order
+
+    The listing is read page by page (1000 objects each), so it is complete however many objects there are.
+
+    Args:
+        bucket (str): Bucket
+        prefix (str): Prefix of the keys
+        start_after (str): Only list keys after this one, to read only the objects added since a previous listing
+    """
+    kwargs = {"StartAfter": start_after} if start_after else {}
+    objects = []
+    for page in client().get_paginator("list_objects_v2").paginate(Bucket=bucket, Prefix=prefix, **kwargs):
+        objects += [{"key": f["Key"], "size": f["Size"], "etag": f["ETag"].strip('"'), "last_modified": f["LastModified"]} for f in page.get("Contents", [])]
+    return objects
+
+def list_keys(bucket, prefix):
+    """Keys of every object in bucket under prefix (see list_objects)
+
+    Args:
+        bucket (str): Bucket
+        prefix (str): Prefix of the keys
+    """
+    return [o["key"] for o in list_objects(bucket, prefix)]
+
+def open_object(bucket, key, byte_range=None):
+    """Body of an object, as a file-like object read from the network as it is consumed
+
+    Args:
+        bucket (str): Bucket
+        key (str): Key of the object
+        byte_range (tuple): First and last byte to read, both included. The whole object if None
+    """
+    kwargs = {"Range": f"bytes={byte_range[0]}-{byte_range[1]}"} if byte_range else {}
+    return client().get_object(Bucket=bucket, Key=key, **kwargs)["Body"]
+
+def get_object(bucket, key, byte_range=None):
+    """Bytes of an object, or of a range of it (see open_object)"""
+    body = open_object(bucket, key, byte_range)
+    try:
+        return body.read()
+    finally:
+        body.close()
+
+def stream_object(bucket, key, chunk_bytes=S3_CHUNK_BYTES):
+    """Chunks of chunk_bytes of an object, for objects too large to hold in memory
+
+    Args:
+        bucket (str): Bucket
+        key (str): Key of the object
+        chunk_bytes (int): Bytes by chunk
+    """
+    body = open_object(bucket, key)
+    try:
+        yield from body.iter_chunks(chunk_bytes)
+    finally:
+        body.close()
+
+def get_json(bucket, key):
+    """Object parsed as JSON, {} if it's empty"""
+    data = get_object(bucket, key)
+    return json.loads(data) if data else {}
+
+def get_objects(bucket, keys, workers=S3_WORKERS):
+    """Bytes of several objects, fetched workers at a time with the shared client
+
+    Args:
+        bucket (str): Bucket
+        keys (list): Keys of the objects
+        workers (int): Requests at a time
+
+    Returns:
+        dict: Key -> bytes of the object, or the exception raised fetching it
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    from botocore.exceptions import BotoCoreError, ClientError
+
+    def get(key):
+        try:
+            return get_object(bucket, key)
+        except (BotoCoreError, ClientError) as e:
+            return e
+
+    keys = list(dict.fromkeys(keys))
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(keys)))) as executor:
+        return dict(zip(keys, executor.map(get, keys)))
+
+def _disk_cache(cache_dir):
+    """Files of the disk cache in cache_dir, least recently used first, read from disk on first use"""
+    from collections import OrderedDict
+
+    if cache_dir not in _disk_caches:
+        files = []
+        for root, _, names in os.walk(cache_dir):
+            for name in names:
+                if name.endswith(".gz"):
+                    stat = os.stat(os.path.join(root, name))
+                    files += [(stat.st_mtime, name.split("-", 1)[0], os.path.join(root, name), stat.st_size)]
+        _disk_caches[cache_dir] = OrderedDict((name, (path, size)) for _, name, path, size in sorted(files))
+    return _disk_caches[cache_dir]
+
+def get_object_cached(bucket, key, cache_dir=S3_CACHE_DIR, max_bytes=S3_CACHE_BYTES):
+    """Bytes of a write-once object, from a local disk cache or else from S3
+
+    Objects are stored gzipped in cache_dir/<hash of bucket/key>-<ETag>.gz, so an object is downloaded once and then
+    read from disk, also after a restart. As objects are never rewritten, cached files are used without asking S3 for
+    the ETag. When the files exceed max_bytes, the least recently used ones are deleted.
+
+    Args:
+        bucket (str): Bucket
+        key (str): Key of the object
+        cache_dir (str): Directory of the cache
+        max_bytes (int): Size budget of the cached (compressed) files
+    """
+    import gzip, hashlib
+
+    name = hashlib.sha1(f"{bucket}/{key}".encode()).hexdigest()
+    directory = os.path.join(cache_dir, name[:2])
+    with _disk_cache_lock:
+        files = _disk_cache(cache_dir)
+        path = files[name][0] if name in files else None
+        if path is not None:
+            files.move_to_end(name)
+            _evict(files, max_bytes)
+    if path is not None:
+        try:
+            with gzip.open(path, "rb") as f:
+                data = f.read()
+            # The modification time orders files by last use when the cache is read again from disk
+            os.utime(path)
+            with _disk_cache_lock:
+                _disk_cache_stats["hits"] += 1
+                _disk_cache_stats["bytes_saved"] += len(data)
+            return data
+        except OSError:
+            # Evicted by another process, or a partial file: download it again
+            with _disk_cache_lock:
+                files.pop(name, None)
+
+    response = client().get_object(Bucket=bucket, Key=key)
+    data = response["Body"].read()
+    etag = response.get("ETag", "").strip('"').replace("/", "_") or "none"
+    path = os.path.join(directory, f"{name}-{etag}.gz")
+    os.makedirs(directory, exist_ok=True)
+    # Written to a temporary file and moved in place, so readers never see partial files
+    tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(gzip.compress(data, compresslevel=6, mtime=0))
+    os.replace(tmp, path)
+    size = os.path.getsize(path)
+
+    with _disk_cache_lock:
+        _disk_cache_stats["misses"] += 1
+        _disk_cache_stats["bytes_stored"] += size
+        # A file of the same object with another ETag was evicted by this process but not deleted by another one
+        if name in files and files[name][0] != path:
+            try:
+                os.remove(files[name][0])
+            except OSError:
+                pass
+        files[name] = (path, size)
+        files.move_to_end(name)
+        _evict(files, max_bytes)
+    return data
+
+def _evict(files, max_bytes):
+    """Delete the least recently used files of a disk cache until they fit in max_bytes, keeping the last one used"""
+    total = sum(size for _, size in files.values())
+    while total > max_bytes and len(files) > 1:
+        _, (path, size) = files.popitem(last=False)
+        total -= size
+        _disk_cache_stats["evictions"] += 1
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+def disk_cache_stats(cache_dir=S3_CACHE_DIR):
+    """Files and compressed bytes in the disk cache, and its hits, misses, bytes not downloaded, stored and evictions"""
+    with _disk_cache_lock:
+        files = _disk_cache(cache_dir)
+        return {"files": len(files), "bytes": sum(s for _, s in files.values()), **_disk_cache_stats}
@@ -1,7 +1,8 @@
 import streamlit as st
 import json
+import numpy as np
 import pandas as pd
-from st_aggrid import GridOptionsBuilder
+from st_aggrid import AgGrid, GridOptionsBuilder
 
 # Config
 
@@ -21,54 +22,217 @@ def agrid_options(dataframe, page_size):
     grid_options_builder.configure_selection("single")
     return grid_options_builder.build()
 
-def list_files_s3(bucket:str, path:str):
-    """List files in S3"""
-    import boto3
-    s3 = boto3.client('s3',
-        aws_access_key_id=st.secrets["aws_access_key_id"],
-        aws_secret_access_key=st.secrets["aws_secret_access_key"],
-        region_name='us-east-1')
+# Operators of AG Grid number and date filters, as pandas.Series methods
+AGRID_COMPARISONS = {
+    "equals": "eq",
+    "notEqual": "ne",
+    "lessThan": "lt",
+    "lessThanOrEqual": "le",
+    "greaterThan": "gt",
+    "greaterThanOrEqual": "ge",
+}
 
-    response = s3.list_objects_v2(Bucket=bucket, Prefix=path)
-    files = [f["Key"] for f in response["Contents"]]
-    return files
+def _agrid_filter_mask(series: pd.Series, model: dict) -> pd.Series:
+    """Rows of series that pass an AG Grid filter model (text, number, date or set filter, or a combination)"""
+    if "conditions" in model:
+        masks = [_agrid_filter_mask(series, condition) for condition in model["conditions"]]
+        return np.logical_and.reduce(masks) if model.get("operator", "AND") == "AND" else np.logical_or.reduce(masks)
+    kind, operator = model.get("filterType"), model.get("type")
 
-def load_csv_s3(bucket:str, path:str, filename:str):
-    """Load csv file from S3"""
-    import io, boto3
-    s3 = boto3.client('s3',
-        aws_access_key_id=st.secrets["aws_access_key_id"],
-        aws_secret_access_key=st.secrets["aws_secret_access_key"],
-        region_name='us-east-1')
+    if kind == "set":
+        values = model.get("values") or []
+        return series.astype(str).isin([str(v) for v in values if v is not None]) & series.notna() | series.isna() & (None in values)
+    if kind == "number":
+        values = pd.to_numeric(series, errors="coerce")
+    elif kind == "date":
+        # Dates are compared by day, as the grid's date filter does
+        values = pd.to_datetime(series, errors="coerce")
+        if values.dt.tz is not None:
+            values = values.dt.tz_localize(None)
+        values = values.dt.normalize()
+    else:
+        values = series.astype(str).str.lower().where(series.notna())
 
-    obj = s3.get_object(Bucket=bucket, Key=path+filename)
+    if operator == "blank":
+        return values.isna() | (values == "") if kind == "text" or kind is None else values.isna()
+    if operator == "notBlank":
+        return ~(values.isna() | (values == "")) if kind == "text" or kind is None else values.notna()
+    if kind == "number" or kind == "date":
+        low, high = (model.get("filter"), model.get("filterTo")) if kind == "number" else [pd.Timestamp(model[d]).normalize() if model.get(d) else None for d in ["dateFrom", "dateTo"]]
+        if operator == "inRange":
+            return (values > low) & (values < high)
+        return getattr(values, AGRID_COMPARISONS[operator])(low).fillna(False).astype(bool)
 
-    if len(obj) != 0:
-        df = pd.read_csv(io.BytesIO(obj['Body'].read()), sep="|")
-    else:
-        df = pd.DataFrame()
+    text = str(model.get("filter", "")).lower()
+    if operator == "equals":
+        return (values == text).fillna(False)
+    if operator == "notEqual":
+        return (values != text) | values.isna()
+    if operator == "startsWith":
+        return values.str.startswith(text).fillna(False).astype(bool)
+    if operator == "endsWith":
+        return values.str.endswith(text).fillna(False).astype(bool)
+    if operator == "notContains":
+        return ~values.str.contains(text, regex=False).fillna(False).astype(bool)
+    return values.str.contains(text, regex=False).fillna(False).astype(bool)
+
+def agrid_query(dataframe: pd.DataFrame, filter_model: dict = None, sort_model: list = None) -> np.ndarray:
+    """Positions of the rows of dataframe that pass the grid filters, in the grid sort order
+
+    Args:
+        dataframe (pandas.DataFrame): Whole table of the grid
+        filter_model (dict): AG Grid filter model, by column
+        sort_model (list): AG Grid sort model, a list of {"colId", "sort"}
+    """
+    mask = np.ones(len(dataframe), dtype=bool)
+    for column, model in (filter_model or {}).items():
+        if column in dataframe.columns:
+            mask &= np.asarray(_agrid_filter_mask(dataframe[column], model), dtype=bool)
+    positions = np.flatnonzero(mask)
+
+    sort_model = [s for s in sort_model or [] if s.get("colId") in dataframe.columns and s.get("sort") in ("asc", "desc")]
+    if sort_model and len(positions):
+        # Only the sort columns of the filtered rows are copied. Text and lists are sorted as text, empty values first
+        keys = dataframe.iloc[positions][[s["colId"] for s in sort_model]].reset_index(drop=True)
+        keys.columns = range(len(sort_model))
+        order = keys.sort_values(
+            list(keys.columns),
+            ascending=[s["sort"] == "asc" for s in sort_model],
+            na_position="first",
+            kind="stable",
+            key=lambda s: s.astype(str).where(s.notna()) if s.dtype == object else s,
+        ).index
+        positions = positions[order]
+    return positions
+
+def agrid_server_side(dataframe: pd.DataFrame, page_size: int, key: str, **kwargs):
+    """AgGrid that only sends the current page of dataframe to the browser
+
+    Sorting and filters set in the grid are applied to the whole dataframe in the server, on the rerun they trigger,
+    and pages are chosen with a selector under the grid. Returns as AgGrid, so selected rows have every column of
+    dataframe shown in the grid.
+
+    Args:
+        dataframe (pandas.DataFrame): Whole table, usually cached
+        page_size (int): Rows by page
+        key (str): Unique key of the grid, to keep its filters, sorting and page across reruns
+        **kwargs: Other parameters of AgGrid
+    """
+    # Filters and sorting of the last grid event, kept by Streamlit under the key of the grid
+    grid_response = st.session_state.get(key) or {}
+    if isinstance(grid_response, str):
+        grid_response = json.loads(grid_response)
+    grid_state = grid_response.get("gridState") or {}
+    filter_model = (grid_state.get("filter") or {}).get("filterModel") or {}
+    sort_model = (grid_state.get("sort") or {}).get("sortModel") or []
+    positions = agrid_query(dataframe, filter_model, sort_model)
+
+    # New filters or sorting go back to the first page
+    pages = max((len(positions) + page_size - 1) // page_size, 1)
+    query = json.dumps([filter_model, sort_model], sort_keys=True, default=str)
+    if st.session_state.get(f"{key}_query") != query or st.session_state.get(f"{key}_page", 1) > pages:
+        st.session_state[f"{key}_query"] = query
+        st.session_state[f"{key}_page"] = 1
+
+    grid = st.container()
+    col1, col2, _ = st.columns([1,2,5])
+    with col1:
+        page = st.number_input("Página", min_value=1, max_value=pages, step=1, key=f"{key}_page", label_visibility="collapsed")
+    with col2:
+        st.caption(f"Página {page} de {pages} ({len(positions)} filas)")
+
+    page_rows = dataframe.iloc[positions[(page - 1) * page_size:page * page_size]]
+    grid_options_builder = agrid_options_raw(page_rows, page_size)
+    grid_options_builder.configure_pagination(enabled=False)
+    # Text filters instead of set filters, which would only list the values of the page
+    grid_options_builder.configure_default_column(floatingFilter=True, selectable=False, filterable="agTextColumnFilter")
+    grid_options = grid_options_builder.build()
+    # Show the filters and sorting that were applied, also if the grid is built again
+    grid_options["initialState"] = {"filter": {"filterModel": filter_model}, "sort": {"sortModel": sort_model}}
+    with grid:
+        return AgGrid(page_rows, grid_options, key=key, **kwargs)
+
+class FrameIndex:
+    """Index of the rows of a dataframe by the values of some of its columns
+
+    For each column, rows are sorted by value (keeping their order within a value) and the offsets of each value are
+    kept in an array, so the rows of a value are a slice found with a hash lookup, instead of a scan of the column.
+    The dataframe must not be modified while it is indexed.
+
+    Args:
+        dataframe (pandas.DataFrame): Dataframe to index
+        columns (list): Columns to index
+    """
+
+    def __init__(self, dataframe: pd.DataFrame, columns: list):
+        self.dataframe = dataframe
+        self._columns = {}
+        for column in columns:
+            # Codes of missing values are -1, so they are sorted first and left out of the slices
+            codes, values = pd.factorize(dataframe[column])
+            order = np.argsort(codes, kind="stable").astype(np.int32 if len(codes) < 2**31 else np.int64)
+            offsets = np.concatenate([[0], np.cumsum(np.bincount(codes[codes >= 0], minlength=len(values)))]) + np.count_nonzero(codes < 0)
+            self._columns[column] = (pd.Index(values), order, offsets)
+
+    def positions(self, column: str, values: list) -> np.ndarray:
+        """Positions of the rows with any of values in column, in the order of the dataframe for each value
+
+        Args:
+            column (str): Indexed column
+            values (list): Values to look up
+        """
+        index, order, offsets = self._columns[column]
+        codes = index.get_indexer(list(values))
+        return np.concatenate([order[offsets[c]:offsets[c + 1]] for c in codes if c >= 0] or [order[:0]])
+
+    def lookup(self, column: str, value) -> pd.DataFrame:
+        """Rows with value in column
+
+        Args:
+            column (str): Indexed column
+            value: Value to look up
+        """
+        return self.dataframe.iloc[self.positions(column, [value])]
+
+    def memory_usage(self) -> pd.DataFrame:
+        """Keys and bytes of the index of each column, and of the indexed dataframe (column "*")"""
+        rows = [{"column": "*", "keys": len(self.dataframe), "bytes": int(self.dataframe.memory_usage(deep=True).sum())}]
+        for column, (index, order, offsets) in self._columns.items():
+            rows += [{"column": column, "keys": len(index), "bytes": int(index.memory_usage(deep=True) + order.nbytes + offsets.nbytes)}]
+        return pd.DataFrame(rows, columns=["column", "keys", "bytes"])
+
+def list_files_s3(bucket:str, path:str):
+    """List files in S3"""
+    import s3
+    return s3.list_keys(bucket, path)
+
+def load_csv_s3(bucket:str, path:str, filename:str):
+    """Load csv file from S3, parsed as it is downloaded"""
+    import s3
+    body = s3.open_object(bucket, path+filename)
+    try:
+        df = pd.read_csv(body, sep="|")
+    finally:
+        body.close()
     return df
 
 def load_json_s3(bucket:str, filename:str, path:str):
     """Load file from S3"""
-    import io, boto3
-    s3 = boto3.client('s3',
-        aws_access_key_id=st.secrets["aws_access_key_id"],
-        aws_secret_access_key=st.secrets["aws_secret_access_key"],
-        region_name='us-east-1')
+    import s3
+    return s3.get_json(bucket, path+filename)
 
-    obj = s3.get_object(Bucket=bucket, Key=path+filename)
-
-    if len(obj) != 0:
-        j = json.load(io.BytesIO(obj['Body'].read()))
-    else:
-        j = {}
-    return j
+def load_jsons_s3(bucket:str, filenames:list, path:str):
+    """Load several files from S3 concurrently. Files that couldn't be loaded are the exception raised"""
+    import s3
+    objects = s3.get_objects(bucket, [path+f for f in filenames])
+    return {f: objects[path+f] if isinstance(objects[path+f], Exception) else json.loads(objects[path+f]) if objects[path+f] else {} for f in filenames}
 
 def load_event_raw(filename, path):
-
-
-    return load_json_s3(bucket="prod-track-sources-s3stack-dumpbucketbe480749-wch2mlfw0oh0", filename=filename, path=path)
+    """Load a raw Ocean Insights ("oceaninsights/") or Gatehouse ("ghmaritime/") event. They are never rewritten, so
+    they are kept in the local disk cache of S3 objects"""
+    import s3
+    data = s3.get_object_cached(s3.EVENTS_BUCKET, path+filename)
+    return json.loads(data) if data else {}
 
 def delete_page(main_script_path_str, page_name):
     from streamlit.source_util import (
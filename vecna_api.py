@@ -0,0 +1,131 @@
+import time
+import threading
+from collections import OrderedDict
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util import Retry
+
+# Vecna back API by environment: base URL and token
+VECNA_API = {
+    "prod": ("https://vecna.klog.co", "Y2xkYWl4a3R0MDAwZDM3NnF0YW1qd2U5bjp4ZGM3ZDN0aDNnWWV0ZUMwVXViM29m="),
+    "staging": ("https://staging.vecna.klog.co", "Y2w4NHVhNzU5MDAwMTA5bDNnYTVjOXl1dDpETVNLQURLTUxTUUE="),
+}
+
+# Seconds to connect and to wait for each read of a response
+VECNA_API_TIMEOUT = (3.05, 10)
+# Retries of failed connections and of responses with these statuses, waiting 0.5, 1, 2... seconds between them
+VECNA_API_RETRIES = 3
+VECNA_API_BACKOFF = 0.5
+VECNA_API_RETRY_STATUSES = [429, 500, 502, 503, 504]
+# Seconds a response is served from the cache without asking the API; after that it is revalidated with its ETag
+VECNA_API_CACHE_TTL = 300
+VECNA_API_CACHE_ENTRIES = 2000
+# Requests at a time of get_subscriptions, and keep-alive connections by environment
+VECNA_API_WORKERS = 8
+
+# Sessions by environment, responses by (environment, subscription id) and statistics, shared by the whole process
+_sessions = {}
+_cache = OrderedDict()
+_stats = {"hits": 0, "revalidated": 0, "misses": 0, "errors": 0, "seconds": 0.0}
+_lock = threading.Lock()
+
+def session(env="prod"):
+    """Keep-alive session to the Vecna back API of env, created on first use and shared by the whole process
+
+    Its connection pool keeps VECNA_API_WORKERS connections open, so requests after the first one don't pay a new
+    TLS handshake, and failed connections and VECNA_API_RETRY_STATUSES responses are retried with backoff.
+
+    Args:
+        env (str): "prod" or "staging"
+    """
+    with _lock:
+        if env not in _sessions:
+            retries = Retry(
+                total=VECNA_API_RETRIES,
+                backoff_factor=VECNA_API_BACKOFF,
+                status_forcelist=VECNA_API_RETRY_STATUSES,
+                allowed_methods=["GET"],
+                raise_on_status=False,
+            )
+            s = requests.Session()
+            s.mount("http://", HTTPAdapter(pool_connections=1, pool_maxsize=VECNA_API_WORKERS, max_retries=retries))
+            s.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=VECNA_API_WORKERS, max_retries=retries))
+            s.headers["Authorization"] = f"Token {VECNA_API[env][1]}"
+            _sessions[env] = s
+        return _sessions[env]
+
+def get_subscription(subscription_id, env="prod", ttl=VECNA_API_CACHE_TTL):
+    """Subscription from the Vecna back API, as the text of the response
+
+    Responses are cached for ttl seconds. After that, the API is asked again with the ETag of the cached response, and
+    a 304 Not Modified keeps it for another ttl without downloading it again.
+
+    Args:
+        subscription_id (str): Vecna subscription id
+        env (str): "prod" or "staging"
+        ttl (float): Seconds a cached response is used without asking the API
+
+    Raises:
+        requests.RequestException: The API didn't answer in time or, after retries, with an error
+    """
+    key = (env, str(subscription_id))
+    with _lock:
+        cached = _cache.get(key)
+        if cached is not None:
+            _cache.move_to_end(key)
+            if time.monotonic() - cached["fetched"] < ttl:
+                _stats["hits"] += 1
+                return cached["text"]
+
+    headers = {"If-None-Match": cached["etag"]} if cached is not None and cached["etag"] else {}
+    start = time.perf_counter()
+    try:
+        response = session(env).get(f"{VECNA_API[env][0]}/subscriptions/{subscription_id}", headers=headers, timeout=VECNA_API_TIMEOUT)
+        if response.status_code != 304:
+            response.raise_for_status()
+    except requests.RequestException:
+        with _lock:
+            _stats["errors"] += 1
+        raise
+
+    with _lock:
+        _stats["seconds"] += time.perf_counter() - start
+        if response.status_code == 304:
+            _stats["revalidated"] += 1
+            cached["fetched"] = time.monotonic()
+            return cached["text"]
+        _stats["misses"] += 1
+        _cache[key] = {"text": response.text, "etag": response.headers.get("ETag"), "fetched": time.monotonic()}
+        _cache.move_to_end(key)
+        while len(_cache) > VECNA_API_CACHE_ENTRIES:
+            _cache.popitem(last=False)
+    return response.text
+
+def get_subscriptions(subscription_ids, env="prod", workers=VECNA_API_WORKERS, ttl=VECNA_API_CACHE_TTL):
+    """Subscriptions from the Vecna back API, fetched workers at a time (see get_subscription)
+
+    Args:
+        subscription_ids (list): Vecna subscription ids
+        env (str): "prod" or "staging"
+        workers (int): Requests at a time
+        ttl (float): Seconds a cached response is used without asking the API
+
+    Returns:
+        dict: Subscription id -> text of the response, or the exception raised fetching it
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    def get(subscription_id):
+        try:
+            return get_subscription(subscription_id, env, ttl)
+        except requests.RequestException as e:
+            return e
+
+    subscription_ids = list(dict.fromkeys(subscription_ids))
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(subscription_ids)))) as executor:
+        return dict(zip(subscription_ids, executor.map(get, subscription_ids)))
+
+def cache_stats():
+    """Cached responses, cache hits, revalidations (304), misses, errors and seconds of requests in this process"""
+    with _lock:
+        return {"entries": len(_cache), **_stats}